@@ -0,0 +1,12 @@
+"""
+Timing helpers shared by the hexmap benchmarks.  Each benchmark module can be
+run directly, e.g. ``python -m benchmarks.grid``.
+"""
+import timeit
+
+def best( statement, number=1000, repeat=5 ):
+	"""Returns the best time, in seconds, of a single call to statement."""
+	return min( timeit.repeat( statement, number=number, repeat=repeat ) ) / number
+
+def report( name, seconds ):
+	print( "%-40s %12.3f us" % ( name, seconds * 1e6 ) )
@@ -0,0 +1,46 @@
+"""
+Benchmarks Grid.find and MapUnit.position against the number of units on the
+map.  Both should stay flat as the unit count grows.  Also compares a
+SpatialGrid proximity query with scanning every unit.
+"""
+import random
+
+from benchmarks import best, report
+from hexmap.map import Map, Grid, SpatialGrid, MapUnit
+
+class Unit( MapUnit ):
+	def paint( self, surface ):
+		pass
+
+def run():
+	for count in ( 100, 1000, 10000 ):
+		m = Map( ( count, count ) )
+		m.units = Grid()
+		units = []
+		for row in range( count ):
+			unit = Unit( m.units )
+			m.units[ ( row, 0 ) ] = unit
+			units.append( unit )
+		last = units[-1]
+
+		report( "Grid.find (%d units)" % count, best( lambda: m.units.find( last ) ) )
+		report( "MapUnit.position (%d units)" % count, best( lambda: last.position ) )
+
+def run_spatial( size=500, radius=5 ):
+	m = Map( ( size, size ) )
+	cells = m.cells()
+	rng = random.Random( 0 )
+	for count in ( 1000, 10000, 100000 ):
+		units = SpatialGrid( size=8 )
+		for cell in rng.sample( cells, count ):
+			units[ cell ] = Unit( units )
+		center = cells[ len( cells ) // 2 ]
+
+		scan = lambda: [ ( cell, unit ) for cell, unit in units.iteritems() if m.distance( center, cell ) <= radius ]
+		report( "Scan within %d (%d units)" % ( radius, count ), best( scan, number=1, repeat=3 ) )
+		report( "SpatialGrid.units_within %d (%d units)" % ( radius, count ), best( lambda: units.units_within( center, radius ), number=100 ) )
+		report( "SpatialGrid.nearest 5 (%d units)" % count, best( lambda: units.nearest( center, 5 ), number=100 ) )
+
+if __name__ == '__main__':
+	run()
+	run_spatial()
@@ -0,0 +1,48 @@
+"""
+Compares the memory use and full layer update time of a Grid and a
+DenseLayer covering every cell of a map, and the memory held by a
+ChunkedLayer on a very large, sparsely written map.
+"""
+import sys
+
+from benchmarks import best, report
+from hexmap.map import Map, Grid
+from hexmap.layer import DenseLayer, ChunkedLayer
+
+def grid_bytes( grid ):
+	"""Approximate size of a Grid: the dict table plus its key tuples."""
+	return sys.getsizeof( grid ) + sum( sys.getsizeof( key ) for key in grid )
+
+def run( size=1000 ):
+	m = Map( ( size, size ) )
+	cells = m.cells()
+
+	grid = Grid( default=0, multi=True )
+	for cell in cells:
+		grid[ cell ] = 1
+	dense = DenseLayer( m, default=0, palette=[ 1 ] )
+	dense.fill( 1 )
+
+	print( "%-40s %12.1f MB" % ( "Grid (%dx%d)" % ( size, size ), grid_bytes( grid ) / 1e6 ) )
+	print( "%-40s %12.1f MB" % ( "DenseLayer (%dx%d)" % ( size, size ), dense.nbytes / 1e6 ) )
+
+	def update_grid():
+		for cell in cells:
+			grid[ cell ] = 0
+	report( "Grid full update (%dx%d)" % ( size, size ), best( update_grid, number=1, repeat=1 ) )
+	report( "DenseLayer.fill (%dx%d)" % ( size, size ), best( lambda: dense.fill( 0 ), number=10, repeat=3 ) )
+
+def run_chunked( size=20000, limit=16 ):
+	m = Map( ( size, size ) )
+	layer = ChunkedLayer( m, size=64, default=0, dtype='uint8', limit=limit )
+	cells = [ ( row + ( col + 1 ) // 2, col ) for row in range( 0, size, 997 ) for col in range( 0, size, 991 ) ]
+
+	def write():
+		for cell in cells:
+			layer[ cell ] = 1
+	report( "ChunkedLayer sparse writes (%dx%d)" % ( size, size ), best( write, number=1, repeat=3 ) / len( cells ) )
+	print( "%-40s %12.1f MB" % ( "ChunkedLayer resident (%d chunks)" % len( layer.resident ), layer.nbytes / 1e6 ) )
+
+if __name__ == '__main__':
+	run( *[ int( arg ) for arg in sys.argv[1:] ] )
+	run_chunked()
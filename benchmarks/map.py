@@ -0,0 +1,101 @@
+"""
+Benchmarks of Map queries.
+"""
+import numpy
+
+from benchmarks import best, report
+from hexmap.map import Map, Adjacency, Grid, PackedGrid, Vision, pack
+
+def run():
+	m = Map( ( 200, 200 ) )
+	cells = m.cells()
+	rng = numpy.random.RandomState( 0 )
+	starts = numpy.array( cells )[ rng.randint( 0, len( cells ), 20000 ) ]
+	dests = numpy.array( cells )[ rng.randint( 0, len( cells ), 20000 ) ]
+	pairs = zip( map( tuple, starts.tolist() ), map( tuple, dests.tolist() ) )
+
+	report( "Map.distance x 20000", best( lambda: [ m.distance( a, b ) for a, b in pairs ], number=1 ) )
+	report( "Map.distances (20000)", best( lambda: m.distances( starts, dests ), number=10 ) )
+	report( "Map.direction x 20000", best( lambda: [ m.direction( a, b ) for a, b in pairs ], number=1 ) )
+	report( "Map.directions_between (20000)", best( lambda: m.directions_between( starts, dests, rng=0 ), number=10 ) )
+	report( "Map.distances pairwise (200x200)", best( lambda: m.distances( starts[:200], dests[:200], pairwise=True ), number=10 ) )
+
+	for radius in ( 2, 6, 12 ):
+		report( "Map.spread radius %d" % radius, best( lambda: m.spread( ( 150, 100 ), radius ), number=100 ) )
+
+def run_fov( size=1000, observers=200, radius=8 ):
+	m = Map( ( size, size ) )
+	rng = numpy.random.RandomState( 0 )
+	walls = Grid( default=False )
+	for cell in numpy.array( m.cells() )[ rng.randint( 0, size * size, size * size // 10 ) ].tolist():
+		walls[ tuple( cell ) ] = True
+	positions = [ ( size // 2 + row, col ) for row, col in rng.randint( 0, size // 2, ( observers, 2 ) ).tolist() ]
+
+	report( "Map.visible radius %d" % radius, best( lambda: m.visible( positions[0], radius, walls ), number=10 ) )
+
+	vision = Vision( m, radius, walls, fog=Grid( default=0, multi=True ), visible=2, seen=1 )
+	for key, cell in enumerate( positions ):
+		vision.update( key, cell )
+	moves = [ ( key, ( row + 1, col ) ) for key, ( row, col ) in enumerate( positions ) ]
+	def turn():
+		for key, cell in moves:
+			vision.update( key, cell )
+		for key, cell in enumerate( positions ):
+			vision.update( key, cell )
+	report( "Vision.update x %d observers (per turn)" % observers, best( turn, number=1, repeat=3 ) / 2 )
+
+def run_packed( size=200 ):
+	m = Map( ( size, size ) )
+	cells = m.cells()[::7]
+	keys = [ pack( cell ) for cell in cells ]
+	grid = Grid( default=0 )
+	packed = PackedGrid( default=0 )
+	for cell, key in zip( cells, keys ):
+		grid[ cell ] = 1
+		packed[ key ] = 1
+
+	def walk( grid, cells ):
+		total = 0
+		for cell in cells:
+			for neighbor in m.neighbors( cell ):
+				total += grid[ neighbor ]
+		return total
+	report( "Map.neighbors tuple x %d" % len( cells ), best( lambda: [ m.neighbors( c ) for c in cells ], number=10 ) )
+	report( "Map.neighbors packed x %d" % len( keys ), best( lambda: [ m.neighbors( k ) for k in keys ], number=10 ) )
+	report( "Grid neighbor sum x %d" % len( cells ), best( lambda: walk( grid, cells ), number=10 ) )
+	report( "PackedGrid neighbor sum x %d" % len( keys ), best( lambda: walk( packed, keys ), number=10 ) )
+
+def run_shapes( size=200 ):
+	m = Map( ( size, size ) )
+	origins = m.cells()[::97]
+	edges = [ ( 0, col ) for col in range( size ) ]
+	for name, query in ( ( "spread 3", lambda cell: m.spread( cell, 3 ) ), ( "cone 4", lambda cell: m.cone( cell, 1, 4 ) ),
+			( "slice 4", lambda cell: m.slice( cell, 1, 4 ) ), ( "line 6", lambda cell: m.line( cell, 2, 6 ) ) ):
+		report( "Map.%s x %d" % ( name, len( origins ) ), best( lambda: [ query( cell ) for cell in origins ], number=10 ) )
+		report( "Map.%s x %d on the edge" % ( name, len( edges ) ), best( lambda: [ query( cell ) for cell in edges ], number=10 ) )
+	m.shape_memo_size = len( origins )
+	report( "Map.cone 4 x %d memoized" % len( origins ), best( lambda: [ m.cone( cell, 1, 4 ) for cell in origins ], number=10 ) )
+
+def run_adjacency( size=200 ):
+	m = Map( ( size, size ) )
+	cells = m.cells()[::7]
+	report( "Adjacency build %dx%d" % ( size, size ), best( lambda: Adjacency( m.size ).lists, number=1, repeat=3 ) )
+	report( "Map.cells %dx%d" % ( size, size ), best( m.cells, number=10 ) )
+	report( "Map.neighbors x %d" % len( cells ), best( lambda: [ m.neighbors( cell ) for cell in cells ], number=10 ) )
+	m.adjacency_limit = 0
+	m._lists = None
+	report( "Map.cells %dx%d without tables" % ( size, size ), best( m.cells, number=10 ) )
+	report( "Map.neighbors x %d without tables" % len( cells ), best( lambda: [ m.neighbors( cell ) for cell in cells ], number=10 ) )
+
+def run_ascii( size=1000 ):
+	m = Map( ( size, size ) )
+	report( "Map.ascii %dx%d" % ( size, size ), best( lambda: m.ascii(), number=1, repeat=3 ) )
+	report( "Map.ascii window 40x40", best( lambda: m.ascii( rows=( 500, 540 ), cols=( 500, 540 ) ), number=100 ) )
+
+if __name__ == '__main__':
+	run()
+	run_fov()
+	run_packed()
+	run_shapes()
+	run_adjacency()
+	run_ascii()
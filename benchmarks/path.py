@@ -0,0 +1,69 @@
+"""
+Benchmarks Map.find_path, Map.reachable, Map.flow_field and Map.batch on a large map
+with a random movement cost layer.
+"""
+import sys
+
+import numpy
+
+from benchmarks import best, report
+from hexmap.map import Map
+from hexmap.layer import DenseLayer
+
+def run( size=500 ):
+	m = Map( ( size, size ) )
+	rng = numpy.random.RandomState( 0 )
+	terrain = DenseLayer( m, default=1.0, dtype=float )
+	terrain.array[:] = rng.choice( [ 1.0, 1.0, 1.0, 2.0, 3.0, numpy.inf ], size=terrain.array.shape )
+
+	start = ( size // 2, 0 )
+	for length in ( 10, 50, 200 ):
+		goal = ( size // 2 + length // 2, length )
+		terrain[ start ] = terrain[ goal ] = 1.0
+		report( "Map.find_path open (%d steps, %dx%d)" % ( length, size, size ),
+			best( lambda: m.find_path( start, goal ), number=3, repeat=3 ) )
+		report( "Map.find_path terrain (%d steps, %dx%d)" % ( length, size, size ),
+			best( lambda: m.find_path( start, goal, cost=terrain ), number=3, repeat=3 ) )
+
+	center = ( size, size // 2 )
+	for budget in ( 5, 10, 20 ):
+		report( "Map.reachable (budget %d)" % budget,
+			best( lambda: m.reachable( center, budget, cost=terrain ), number=3, repeat=3 ) )
+
+def run_flow( size=200, units=500 ):
+	m = Map( ( size, size ) )
+	rng = numpy.random.RandomState( 0 )
+	terrain = DenseLayer( m, default=1.0, dtype=float )
+	terrain.array[:] = rng.choice( [ 1.0, 1.0, 1.0, 2.0, 3.0, numpy.inf ], size=terrain.array.shape )
+	goal = ( size, size // 2 )
+	terrain[ goal ] = 1.0
+	cells = m.cells()
+	starts = [ cells[ n ] for n in rng.randint( 0, len( cells ), units ) ]
+
+	report( "Map.find_path x %d units (%dx%d)" % ( units, size, size ),
+		best( lambda: [ m.find_path( start, goal, cost=terrain ) for start in starts ], number=1, repeat=1 ) )
+	def flow():
+		terrain.version += 1
+		return m.flow_field( [ goal ], cost=terrain )
+	report( "Map.flow_field (%dx%d)" % ( size, size ), best( flow, number=1, repeat=3 ) )
+	field = m.flow_field( [ goal ], cost=terrain )
+	report( "FlowField.step x %d units" % units, best( lambda: [ field.step( start ) for start in starts ], number=10 ) )
+
+def run_batch( size=200, queries=400, processes=None ):
+	m = Map( ( size, size ) )
+	rng = numpy.random.RandomState( 0 )
+	m.terrain = DenseLayer( m, default=1.0, dtype=float )
+	m.terrain.array[:] = rng.choice( [ 1.0, 1.0, 1.0, 2.0, 3.0 ], size=m.terrain.array.shape )
+	cells = m.cells()
+	pairs = [ ( cells[ a ], cells[ b ] ) for a, b in rng.randint( 0, len( cells ), ( queries, 2 ) ) ]
+	batch = [ ( 'find_path', pair, { 'cost': 'terrain' } ) for pair in pairs ]
+
+	report( "Map.find_path x %d serial" % queries,
+		best( lambda: [ m.find_path( a, b, cost=m.terrain ) for a, b in pairs ], number=1, repeat=1 ) )
+	list( m.batch( batch[:1], processes ) )		# Start the workers
+	report( "Map.batch find_path x %d" % queries, best( lambda: list( m.batch( batch, processes ) ), number=1, repeat=1 ) )
+
+if __name__ == '__main__':
+	run( *[ int( arg ) for arg in sys.argv[1:] ] )
+	run_flow()
+	run_batch()
@@ -0,0 +1,114 @@
+"""
+Benchmarks of the Render draw paths, run headless under SDL's dummy video
+driver.
+"""
+import os
+os.environ.setdefault( 'SDL_VIDEODRIVER', 'dummy' )
+
+import numpy
+import pygame
+
+from benchmarks import best, report
+from hexmap.instrument import Profiler, RingBuffer
+from hexmap.map import Map, MapUnit
+from hexmap.render import Camera, Compositor, Geometry, RenderGrid, RenderFog, RenderUnits
+
+def run( size=40, radius=16 ):
+	m = Map( ( size, size ) )
+	grid = RenderGrid( m, radius=radius )
+	fog = RenderFog( m, radius=radius )
+	cells = m.cells()
+
+	def draw_grid():
+		grid.invalidate()
+		grid.draw()
+	def draw_fog():
+		fog.invalidate()
+		fog.draw()
+	def draw_fog_dirty():
+		for cell in cells[:10]:
+			m.fog[ cell ] = fog.SEEN
+		fog.draw()
+
+	report( "Geometry build (%dx%d, r=%d)" % ( size, size, radius ),
+		best( lambda: Geometry( m.size, radius ).points, number=1 ) )
+	report( "RenderGrid.draw full (%dx%d)" % ( size, size ), best( draw_grid, number=3 ) )
+	report( "RenderGrid.draw cached (%dx%d)" % ( size, size ), best( grid.draw, number=100 ) )
+	report( "RenderFog.draw full (%dx%d)" % ( size, size ), best( draw_fog, number=3 ) )
+	report( "RenderFog.draw 10 dirty (%dx%d)" % ( size, size ), best( draw_fog_dirty, number=100 ) )
+	report( "Render.get_surface", best( lambda: fog.get_surface( cells[ len( cells ) // 2 ] ) ) )
+
+	width, height = grid.get_size()
+	points = numpy.random.RandomState( 0 ).randint( 0, min( width, height ), ( 10000, 2 ) )
+	point = tuple( points[0].tolist() )
+	report( "Render.get_cell", best( lambda: grid.get_cell( point ) ) )
+	report( "Render.get_cells (10000 points)", best( lambda: grid.get_cells( points ), number=10 ) )
+	report( "Geometry.lookup build (%dx%d, r=%d)" % ( size, size, radius ),
+		best( lambda: Geometry( m.size, radius ).lookup, number=1 ) )
+	grid.build_lookup()
+	report( "Render.get_cell lookup", best( lambda: grid.get_cell( point ) ) )
+	report( "Render.get_cells lookup (10000 points)", best( lambda: grid.get_cells( points ), number=10 ) )
+	grid.lookup = None
+
+class Unit( MapUnit ):
+	def paint( self, surface ):
+		surface.fill( pygame.Color( 200, 200, 200 ) )
+
+def run_instrument( size=40, radius=16 ):
+	"""A frame of draws and queries without a profiler, with one enabled, and after disabling it."""
+	m = Map( ( size, size ) )
+	grid, units, fog = RenderGrid( m, radius=radius ), RenderUnits( m, radius=radius ), RenderFog( m, radius=radius )
+	cells = m.cells()
+	for cell in cells[::5]:
+		m.units[ cell ] = Unit( m.units )
+
+	def frame():
+		grid.draw()
+		units.draw()
+		for cell in cells[:10]:
+			m.fog[ cell ] = fog.SEEN
+		fog.draw()
+		for cell in cells[::50]:
+			m.spread( cell, 2 )
+	profiler = Profiler( RingBuffer() )
+
+	report( "Frame (%dx%d)" % ( size, size ), best( frame, number=10 ) )
+	profiler.enable()
+	report( "Frame profiled (%dx%d)" % ( size, size ), best( lambda: ( frame(), profiler.frame() ), number=10 ) )
+	profiler.disable()
+	report( "Frame after disabling (%dx%d)" % ( size, size ), best( frame, number=10 ) )
+
+def run_compositor( size=200, radius=16, frames=20 ):
+	"""
+	Time the main thread spends per frame drawing the layers itself, and
+	asking a Compositor for frames while the layers draw on its thread.
+	"""
+	m = Map( ( size, size ) )
+	camera = Camera( ( 800, 600 ) )
+	layers = [ RenderGrid( m, radius=radius, camera=camera ), RenderUnits( m, radius=radius, camera=camera ),
+		RenderFog( m, radius=radius, camera=camera ) ]
+	for cell in m.cells()[::5]:
+		m.units[ cell ] = Unit( m.units )
+	window = pygame.Surface( camera.size )
+
+	def sequential():
+		camera.pan( 1, 0 )
+		window.fill( pygame.Color( 'white' ) )
+		for layer in layers:
+			layer.draw()
+			window.blit( layer, ( 0, 0 ) )
+	report( "Frame drawn on the main thread", best( sequential, number=frames, repeat=3 ) )
+
+	with Compositor( layers ) as compositor:
+		def threaded():
+			compositor.update( camera.pan, 1, 0 )
+			compositor.request()
+			compositor.present( window )
+		report( "Main thread per frame with a Compositor", best( threaded, number=frames, repeat=3 ) )
+		elapsed = best( lambda: ( compositor.request(), compositor.wait(), compositor.present( window ) ), number=frames, repeat=1 )
+		report( "Compositor frame, request to present", elapsed )
+
+if __name__ == '__main__':
+	run()
+	run_instrument()
+	run_compositor()
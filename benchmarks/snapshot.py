@@ -0,0 +1,49 @@
+"""
+Compares saving and restoring a map's layers with pickle and with a binary
+snapshot, on a map of a million cells.
+"""
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+
+import numpy
+
+from benchmarks import best, report
+from hexmap.map import Map, Grid
+from hexmap.layer import DenseLayer
+from hexmap import snapshot
+
+def run( size=1000 ):
+	m = Map( ( size, size ) )
+	cells = m.cells()
+	rng = numpy.random.RandomState( 0 )
+	m.terrain = DenseLayer( m, default=1.0, dtype=float )
+	m.terrain.array[:] = rng.choice( [ 1.0, 2.0, 3.0 ], size=m.terrain.array.shape )
+	m.fog = Grid( default=0, multi=True )
+	for cell in cells[::3]:
+		m.fog[ cell ] = 1
+
+	directory = tempfile.mkdtemp()
+	try:
+		pickled = os.path.join( directory, 'map.pickle' )
+		binary = os.path.join( directory, 'map.snapshot' )
+		def dump():
+			with open( pickled, 'wb' ) as output:
+				pickle.dump( ( m.terrain.array, dict( m.fog ) ), output, pickle.HIGHEST_PROTOCOL )
+		def restore():
+			with open( pickled, 'rb' ) as source:
+				return pickle.load( source )
+
+		report( "pickle save (%dx%d)" % ( size, size ), best( dump, number=1, repeat=1 ) )
+		report( "pickle load (%dx%d)" % ( size, size ), best( restore, number=1, repeat=3 ) )
+		report( "snapshot.save (%dx%d)" % ( size, size ), best( lambda: snapshot.save( m, binary ), number=1, repeat=1 ) )
+		report( "snapshot.load (%dx%d)" % ( size, size ), best( lambda: snapshot.load( binary ), number=1, repeat=3 ) )
+		print( "%-40s %12.1f MB" % ( "pickle file", os.path.getsize( pickled ) / 1e6 ) )
+		print( "%-40s %12.1f MB" % ( "snapshot file", os.path.getsize( binary ) / 1e6 ) )
+	finally:
+		shutil.rmtree( directory )
+
+if __name__ == '__main__':
+	run( *[ int( arg ) for arg in sys.argv[1:] ] )
@@ -0,0 +1,33 @@
+"""
+Measures the time to import each hexmap module in a fresh interpreter, and
+whether doing so loads pygame.  hexmap.map and hexmap.layer should stay
+usable on servers without pygame.
+"""
+import os
+import subprocess
+import sys
+
+SCRIPT = """
+import sys, time
+start = time.time()
+import %s
+print( "%%r %%r" %% ( time.time() - start, 'pygame' in sys.modules ) )
+"""
+
+def measure( module, repeat=5 ):
+	"""Returns the best import time of module, in seconds, and whether it loaded pygame."""
+	times = []
+	for n in range( repeat ):
+		output = subprocess.check_output( [ sys.executable, '-c', SCRIPT % module ],
+			env=dict( os.environ, PYGAME_HIDE_SUPPORT_PROMPT='1' ) )
+		seconds, pygame = output.split()[-2:]
+		times.append( float( seconds ) )
+	return min( times ), pygame == 'True'
+
+def run():
+	for module in ( 'numpy', 'hexmap.map', 'hexmap.layer', 'hexmap.batch', 'hexmap.instrument', 'hexmap.render' ):
+		seconds, pygame = measure( module )
+		print( "%-40s %12.1f ms%s" % ( "import %s" % module, seconds * 1e3, "  (loads pygame)" if pygame else "" ) )
+
+if __name__ == '__main__':
+	run()
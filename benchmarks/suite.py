@@ -0,0 +1,203 @@
+"""
+The headless benchmark suite: times every Map query, the Grid operations and
+each Render layer's draw and get_cell across a matrix of map sizes and radii,
+under SDL's dummy video driver.  Results are written as JSON and compared to
+a stored baseline, failing when a case slows down by more than a threshold.
+
+	python -m benchmarks --save				# record benchmarks/baseline.json
+	python -m benchmarks --threshold 0.25	# compare against it
+"""
+import os
+os.environ.setdefault( 'SDL_VIDEODRIVER', 'dummy' )
+
+import argparse
+import json
+import platform
+import sys
+
+import pygame
+
+from benchmarks import best
+from hexmap.map import Map, Grid, SpatialGrid, MapUnit
+from hexmap.render import RenderGrid, RenderFog, RenderUnits
+
+BASELINE = os.path.join( os.path.dirname( __file__ ), 'baseline.json' )
+SIZES = ( 10, 50, 200 )
+RADII = ( 8, 16, 32 )
+
+class Unit( MapUnit ):
+	color = pygame.Color( 200, 200, 200 )
+	def paint( self, surface ):
+		surface.fill( self.color )
+
+class Sprite( Unit ):
+	cache_key = 'sprite'
+
+def map_cases( size ):
+	"""Yields ( name, statement, number ) for the Map queries on a size x size map."""
+	m = Map( ( size, size ) )
+	cells = m.cells()
+	center = cells[ len( cells ) // 2 ]
+	far = cells[-1]
+	radius = max( size // 10, 1 )
+	walls = Grid( default=False )
+	for cell in cells[::7]:
+		walls[ cell ] = True
+	walls[ center ] = False
+
+	yield "Map.distance", lambda: m.distance( center, far ), 10000
+	yield "Map.distances", lambda: m.distances( cells, [ far ] * len( cells ) ), 10
+	yield "Map.direction", lambda: m.direction( center, far ), 10000
+	yield "Map.directions_between", lambda: m.directions_between( cells, [ far ] * len( cells ), rng=0 ), 10
+	yield "Map.ascii", lambda: m.ascii(), 1
+	yield "Map.valid_cell", lambda: m.valid_cell( center ), 10000
+	yield "Map.neighbors", lambda: m.neighbors( center ), 10000
+	yield "Map.ring", lambda: list( m.ring( center, radius ) ), 1000
+	yield "Map.range", lambda: list( m.range( center, radius ) ), 100
+	yield "Map.spread", lambda: m.spread( center, radius ), 100
+	yield "Map.cone", lambda: m.cone( center, 0, radius ), 100
+	yield "Map.slice", lambda: m.slice( center, 0, radius ), 100
+	yield "Map.line", lambda: m.line( center, 0, radius ), 1000
+	yield "Map.cells", lambda: m.cells(), 1
+	yield "Map.find_path", lambda: m.find_path( cells[0], far, blocked=walls.__getitem__ ), 1
+	yield "Map.reachable", lambda: m.reachable( center, radius, blocked=walls.__getitem__ ), 10
+	yield "Map.flow_field", lambda: m.flow_field( [ center ], blocked=walls.__getitem__ ), 1
+	yield "Map.visible", lambda: m.visible( center, radius, walls ), 10
+	yield "Map.fov", lambda: m.fov( cells[::max( len( cells ) // 10, 1 )], radius, walls ), 1
+
+def grid_cases( size ):
+	"""Yields the Grid operations with one unit in every column of the map."""
+	m = Map( ( size, size ) )
+	units = Grid()
+	for col in range( size ):
+		units[ ( col, col ) ] = Unit( units )
+	last = units[ ( size - 1, size - 1 ) ]
+	spare = Unit( units )
+
+	def move():
+		units[ ( 0, 0 ) ] = spare
+		del units[ ( 0, 0 ) ]
+
+	yield "Grid.__getitem__", lambda: units[ ( 0, 0 ) ], 10000
+	yield "Grid.__setitem__/__delitem__", move, 10000
+	yield "Grid.find", lambda: units.find( last ), 10000
+	yield "Grid.find_all", lambda: units.find_all( last ), 10000
+	yield "MapUnit.position", lambda: last.position, 10000
+
+	spatial = SpatialGrid( units )
+	center = ( size // 2, size // 2 )
+	yield "SpatialGrid.units_within", lambda: spatial.units_within( center, 5 ), 1000
+	yield "SpatialGrid.nearest", lambda: spatial.nearest( center, 3 ), 1000
+
+def render_cases( size, radius ):
+	"""Yields the draw and get_cell paths of each Render layer."""
+	m = Map( ( size, size ) )
+	cells = m.cells()
+	grid = RenderGrid( m, radius=radius )
+	units = RenderUnits( m, radius=radius )
+	sprites = RenderUnits( Map( m.size ), radius=radius )
+	fog = RenderFog( m, radius=radius )
+	for cell in cells[::5]:
+		m.units[ cell ] = Unit( m.units )
+		sprites.map.units[ cell ] = Sprite( sprites.map.units )
+	point = grid.geometry.center( cells[ len( cells ) // 2 ] )
+	point = ( int( point[0] ), int( point[1] ) )
+
+	def draw_grid():
+		grid.invalidate()
+		grid.draw()
+	def draw_fog():
+		fog.invalidate()
+		fog.draw()
+	def draw_fog_dirty():
+		for cell in cells[:10]:
+			m.fog[ cell ] = fog.SEEN
+		fog.draw()
+
+	yield "RenderGrid.draw", draw_grid, 1
+	yield "RenderGrid.draw cached", grid.draw, 100
+	yield "RenderUnits.draw", units.draw, 1
+	yield "RenderUnits.draw sprites", sprites.draw, 1
+	yield "RenderFog.draw", draw_fog, 1
+	yield "RenderFog.draw dirty", draw_fog_dirty, 10
+	for render in ( grid, units, fog ):
+		yield "%s.get_cell" % type( render ).__name__, lambda render=render: render.get_cell( point ), 10000
+
+def cases( sizes=SIZES, radii=RADII ):
+	"""Yields ( name, statement, number ) for every case of the matrix."""
+	for size in sizes:
+		for name, statement, number in map_cases( size ):
+			yield "%s [%dx%d]" % ( name, size, size ), statement, number
+		for name, statement, number in grid_cases( size ):
+			yield "%s [%d units]" % ( name, size ), statement, number
+		for radius in radii:
+			for name, statement, number in render_cases( size, radius ):
+				yield "%s [%dx%d r=%d]" % ( name, size, size, radius ), statement, number
+
+def measure( sizes=SIZES, radii=RADII, pattern=None, repeat=5, scale=1.0 ):
+	"""Runs the matching cases, returning a dict of case name to best seconds per call."""
+	results = {}
+	for name, statement, number in cases( sizes, radii ):
+		if pattern and pattern not in name:
+			continue
+		results[ name ] = best( statement, number=max( int( number * scale ), 1 ), repeat=repeat )
+		print( "%-60s %12.3f us" % ( name, results[ name ] * 1e6 ) )
+	return results
+
+def compare( results, baseline, threshold ):
+	"""
+	Returns ( name, baseline seconds, seconds ) for every case more than
+	threshold, a fraction, slower than its baseline.
+	"""
+	return [ ( name, baseline[ name ], seconds ) for name, seconds in sorted( results.items() )
+		if name in baseline and seconds > baseline[ name ] * ( 1 + threshold ) ]
+
+def main( argv=None ):
+	parser = argparse.ArgumentParser( prog='python -m benchmarks', description=__doc__.strip().split( '\n' )[0] )
+	parser.add_argument( '--sizes', type=int, nargs='+', default=SIZES, help="Map sizes to run." )
+	parser.add_argument( '--radii', type=int, nargs='+', default=RADII, help="Render radii to run." )
+	parser.add_argument( '-k', '--pattern', help="Only run cases whose name contains PATTERN." )
+	parser.add_argument( '--repeat', type=int, default=5, help="Timings per case, the best is kept." )
+	parser.add_argument( '--scale', type=float, default=1.0, help="Multiplier for the iterations per timing." )
+	parser.add_argument( '-o', '--output', help="Write the results as JSON to OUTPUT." )
+	parser.add_argument( '--baseline', default=BASELINE, help="Baseline JSON to compare against." )
+	parser.add_argument( '--save', action='store_true', help="Store the results as the new baseline." )
+	parser.add_argument( '--threshold', type=float, default=0.25,
+		help="Fail when a case is slower than its baseline by more than this fraction." )
+	args = parser.parse_args( argv )
+
+	pygame.display.init()
+	try:
+		results = measure( args.sizes, args.radii, args.pattern, args.repeat, args.scale )
+	finally:
+		pygame.display.quit()
+
+	document = {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'results': results,
+	}
+	if args.output:
+		with open( args.output, 'w' ) as output:
+			json.dump( document, output, indent=1, sort_keys=True )
+	if args.save:
+		with open( args.baseline, 'w' ) as output:
+			json.dump( document, output, indent=1, sort_keys=True )
+		return 0
+
+	if not os.path.exists( args.baseline ):
+		print( "No baseline at %s, run with --save to record one." % args.baseline )
+		return 0
+	with open( args.baseline ) as source:
+		baseline = json.load( source )[ 'results' ]
+
+	regressions = compare( results, baseline, args.threshold )
+	for name, before, after in regressions:
+		print( "REGRESSION %-49s %9.3f us -> %9.3f us (%+.0f%%)" %
+			( name, before * 1e6, after * 1e6, ( after / before - 1 ) * 100 ) )
+	print( "%d of %d cases compared, %d regressed by more than %.0f%%." %
+		( len( set( results ) & set( baseline ) ), len( results ), len( regressions ), args.threshold * 100 ) )
+	return 1 if regressions else 0
+
+if __name__ == '__main__':
+	sys.exit( main() )
@@ -0,0 +1,242 @@
+"""
+Runs batches of Map queries, like find_path, reachable or fov, on a pool of
+worker processes.  The map and the layers the queries use are pickled once
+into a snapshot file; workers load it on their first task and keep the few
+snapshots they used last, so only the queries and their results cross the
+process boundary.
+"""
+from collections import OrderedDict
+import atexit
+import multiprocessing
+import os
+import pickle
+import tempfile
+import weakref
+
+import logging
+logger = logging.getLogger( __name__ )
+
+WORKER_SNAPSHOTS = 4		# Number of loaded snapshots each worker keeps
+
+
+class BatchExecutor( object ):
+	"""
+	A persistent pool of worker processes answering Map queries.
+
+	A query is a tuple ( method, args ) or ( method, args, keywords ) naming a
+	Map method.  Strings among the arguments that name an attribute of the
+	map, like 'terrain' for map.terrain, stand for that layer, which is then
+	included in the snapshot; a named layer passed as blocked is used as a
+	predicate.  Callables such as lambdas cannot be sent to workers, so name
+	a layer instead.
+
+	Each map has its own current snapshot, so batches of several maps do not
+	replace each other's.  A new one is written whenever the map size, or the
+	identity or version of a named layer, changes.  Layers without a version,
+	like numpy arrays, are only compared by identity.  A replaced snapshot is
+	removed once every batch using it has been consumed or discarded.
+	"""
+
+	def __init__( self, processes=None ):
+		self.processes = processes
+		self.pool = None
+		self._current = {}		# id( map ) -> the map's current _Snapshot
+		self._live = set()		# every _Snapshot whose file exists
+		self._watches = {}		# id( map ) -> weak reference to the map
+
+	def __repr__( self ):
+		return "BatchExecutor(%s)" % self.processes
+
+	def run( self, map, queries, chunksize=64 ):
+		"""Lazily yields the result of each query, in order."""
+		queries = [ _normalize( query ) for query in queries ]
+		names = sorted( set( name for query in queries for name in _names( map, query ) ) )
+		snapshot = self._snapshot( map, names )
+		if self.pool is None:
+			self.pool = multiprocessing.Pool( self.processes )
+		tasks = ( ( snapshot.path, ) + query for query in queries )
+		return _Results( self, snapshot, self.pool.imap( _run, tasks, chunksize ) )
+
+	def snapshot( self, map, names ):
+		"""Returns the path of a snapshot of map holding the named layers, writing it if needed."""
+		return self._snapshot( map, names ).path
+
+	def _snapshot( self, map, names ):
+		layers = dict( ( name, getattr( map, name ) ) for name in names )
+		key = ( map.rows, map.cols, type( map ) ) + tuple(
+			( name, id( layer ), getattr( layer, 'version', None ) ) for name, layer in sorted( layers.items() ) )
+		current = self._current.get( id( map ) )
+		if current is not None and current.key == key:
+			return current
+
+		handle, path = tempfile.mkstemp( prefix='hexmap-', suffix='.snapshot' )
+		with os.fdopen( handle, 'wb' ) as output:
+			pickler = pickle.Pickler( output, pickle.HIGHEST_PROTOCOL )
+			# Layers refer back to their map, which must not drag the rest of it along
+			pickler.persistent_id = lambda obj: 'map' if obj is map else None
+			pickler.dump( ( type( map ), map.rows, map.cols ) )
+			pickler.dump( layers )
+		logger.debug( "Wrote snapshot %s of %s with %s", path, map, names )
+
+		snapshot = _Snapshot( path, key )
+		self._live.add( snapshot )
+		if current is not None:
+			self._retire( current )
+		else:
+			# Retire the map's snapshot once the map is collected
+			owner = id( map )
+			self._watches[ owner ] = weakref.ref( map, lambda ref: self._forget( owner ) )
+		self._current[ id( map ) ] = snapshot
+		return snapshot
+
+	def _forget( self, owner ):
+		self._watches.pop( owner, None )
+		snapshot = self._current.pop( owner, None )
+		if snapshot is not None:
+			self._retire( snapshot )
+
+	def _retire( self, snapshot ):
+		"""Marks a snapshot as replaced, removing it unless a batch still uses it."""
+		snapshot.current = False
+		if not snapshot.users:
+			self._remove( snapshot )
+
+	def _release( self, snapshot ):
+		"""Called when a batch using snapshot is done with it."""
+		snapshot.users -= 1
+		if not snapshot.users and not snapshot.current:
+			self._remove( snapshot )
+
+	def close( self ):
+		"""Stops the worker processes and removes the snapshot files."""
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+		for snapshot in list( self._live ):
+			self._remove( snapshot )
+		self._current = {}
+		self._watches = {}
+
+	def _remove( self, snapshot ):
+		self._live.discard( snapshot )
+		if os.path.exists( snapshot.path ):
+			os.remove( snapshot.path )
+
+class _Snapshot( object ):
+	"""A snapshot file, with the number of batches still reading it."""
+
+	def __init__( self, path, key ):
+		self.path = path
+		self.key = key
+		self.users = 0
+		self.current = True
+
+	def __repr__( self ):
+		return "_Snapshot(%r, users=%d)" % ( self.path, self.users )
+
+class _Results( object ):
+	"""
+	The lazy results of a batch, which keep its snapshot alive until they are
+	exhausted or garbage collected, as queued tasks still have to load it.
+	"""
+
+	def __init__( self, executor, snapshot, results ):
+		self.executor = executor
+		self.snapshot = snapshot
+		self.results = results
+		snapshot.users += 1
+
+	def __iter__( self ):
+		return self
+
+	def next( self ):
+		if self.results is None:
+			raise StopIteration
+		try:
+			return next( self.results )
+		except StopIteration:
+			self._done()
+			raise
+
+	def _done( self ):
+		if self.results is not None:
+			self.results = None
+			self.executor._release( self.snapshot )
+
+	def __del__( self ):
+		self._done()
+
+# Process count -> BatchExecutor, the most recently used last
+_executors = OrderedDict()
+
+def executor( processes=None ):
+	"""
+	Returns the shared BatchExecutor used by Map.batch for a number of worker
+	processes, creating it on first use.  None reuses the executor used last.
+	Each count keeps its own pool, so asking for another count never stops a
+	pool whose results are still being read.
+	"""
+	if processes is None and _executors:
+		processes = next( reversed( _executors ) )
+	executor = _executors.pop( processes, None )
+	if executor is None:
+		executor = BatchExecutor( processes )
+	_executors[ processes ] = executor
+	return executor
+
+@atexit.register
+def _shutdown():
+	for executor in _executors.values():
+		executor.close()
+
+def _normalize( query ):
+	"""Returns ( method, args, keywords ) for a query."""
+	method, args = query[0], tuple( query[1] ) if len( query ) > 1 else ()
+	keywords = dict( query[2] ) if len( query ) > 2 else {}
+	return ( method, args, keywords )
+
+def _names( map, ( method, args, keywords ) ):
+	"""Yields the arguments of a query naming a layer held by map."""
+	for value in args + tuple( keywords.values() ):
+		if isinstance( value, basestring ) and value not in ( 'rows', 'cols' ) and value in map.__dict__:
+			yield value
+
+def _load( path ):
+	"""Rebuilds a map, holding only its size and layers, from a snapshot file."""
+	with open( path, 'rb' ) as source:
+		unpickler = pickle.Unpickler( source )
+		cls, rows, cols = unpickler.load()
+		map = cls.__new__( cls )
+		unpickler.persistent_load = lambda pid: map
+		state = { 'rows': rows, 'cols': cols }
+		state.update( unpickler.load() )
+	map.__setstate__( state )
+	return map
+
+# Worker side: path -> map of the snapshots last loaded by this process
+_loaded = OrderedDict()
+
+def _run( ( path, method, args, keywords ) ):
+	map = _loaded.pop( path, None )
+	if map is None:
+		map = _load( path )
+		while len( _loaded ) >= WORKER_SNAPSHOTS:
+			_loaded.popitem( last=False )
+	_loaded[ path ] = map
+
+	def resolve( value ):
+		if isinstance( value, basestring ) and value in map.__dict__:
+			return map.__dict__[ value ]
+		return value
+	args = [ resolve( value ) for value in args ]
+	keywords = dict( ( key, resolve( value ) ) for key, value in keywords.items() )
+	blocked = keywords.get( 'blocked' )
+	if blocked is not None and not callable( blocked ) and hasattr( blocked, '__getitem__' ):
+		keywords[ 'blocked' ] = blocked.__getitem__
+
+	result = getattr( map, method )( *args, **keywords )
+	# Generators, like ring and range, cannot be pickled
+	if hasattr( result, 'next' ) and not isinstance( result, ( list, dict, set ) ):
+		result = list( result )
+	return result
@@ -0,0 +1,316 @@
+"""
+Opt in instrumentation of Map queries and Render layers, aggregated per
+frame.  Nothing is wrapped until a Profiler is enabled, and disabling it puts
+the original methods back, so a disabled profiler costs nothing.
+
+	profiler = Profiler( RingBuffer( 600 ), JsonLines( 'frames.jsonl' ) )
+	profiler.enable()
+	while running:
+		...
+		grid.draw(); units.draw(); fog.draw()
+		profiler.frame()
+		profiler.overlay( window )
+
+Every public Map method, and the draw, get_cell, get_cells, get_surface and
+view methods of Render and each of its subclasses, is timed while enabled.
+Times include nested calls, so RenderUnits.draw includes the Render.draw it
+calls through super.  For each name a frame records the calls, the seconds
+spent and the longest call; Render draws also record the cells they painted
+(see Render.cells_drawn) and the pygame.draw polygons and lines issued.
+
+Calls are credited to the frame they finish in, so a generator consumed
+across frames counts towards the later one.  Each thread keeps its own stack
+of timed calls, so pygame.draw calls are counted against the method that made
+them in that thread.
+
+A sink is any object with a write( record ) method taking the dict of a
+finished frame, like RingBuffer or JsonLines.
+"""
+from collections import deque
+import inspect
+import json
+import sys
+import threading
+from timeit import default_timer as clock
+
+from hexmap.map import Map
+
+import logging
+logger = logging.getLogger( __name__ )
+
+RENDER_METHODS = ( 'draw', 'get_cell', 'get_cells', 'get_surface', 'view' )
+
+# The enabled profiler, only one may patch the classes at a time
+_active = None
+
+
+class Profiler( object ):
+	"""
+	Times Map and Render methods while enabled, and hands a record of each
+	frame to its sinks when frame is called.
+	"""
+
+	def __init__( self, *sinks ):
+		self.sinks = list( sinks )
+		self.frames = 0
+		self.last = None
+		self._stats = {}
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._patched = []
+		self._start = clock()
+
+	def __repr__( self ):
+		return "Profiler(%s)" % ", ".join( repr( sink ) for sink in self.sinks )
+
+	def __enter__( self ):
+		self.enable()
+		return self
+
+	def __exit__( self, *error ):
+		self.disable()
+
+	@property
+	def enabled( self ):
+		return _active is self
+
+	def enable( self ):
+		"""Wraps the Map and Render methods.  Render subclasses must be defined first."""
+		global _active
+		if _active is self:
+			return
+		if _active is not None:
+			raise ValueError( "%s is already enabled." % _active )
+		_active = self
+		for name in vars( Map ).keys():
+			if not name.startswith( '_' ):
+				self._patch( Map, name )
+		# Render layers are only instrumented once something has loaded them
+		render = sys.modules.get( 'hexmap.render' )
+		if render is not None:
+			Render = render.Render
+			for cls in [ Render ] + _subclasses( Render ):
+				for name in RENDER_METHODS:
+					# Render.draw only fills the background, its subclasses count the cells
+					self._patch( cls, name, draw=name == 'draw' and cls is not Render )
+			import pygame.draw
+			for name in ( 'polygon', 'line' ):
+				self._patch_draw( pygame.draw, name )
+		self._start = clock()
+		logger.debug( "Enabled %s, wrapped %d methods", self, len( self._patched ) )
+
+	def disable( self ):
+		"""Restores the original methods."""
+		global _active
+		if _active is not self:
+			return
+		for owner, name, original in reversed( self._patched ):
+			setattr( owner, name, original )
+		self._patched = []
+		self._local = threading.local()
+		_active = None
+
+	def frame( self ):
+		"""Ends the current frame, writing its record to every sink, and returns the record."""
+		with self._lock:
+			now = clock()
+			stats, self._stats = self._stats, {}
+			record = {
+				'frame': self.frames,
+				'seconds': now - self._start,
+				'calls': dict( ( name, _summary( stat ) ) for name, stat in stats.items() ),
+			}
+			self.frames += 1
+			self.last = record
+			self._start = now
+		for sink in self.sinks:
+			sink.write( record )
+		return record
+
+	def overlay( self, surface, position=( 4, 4 ), lines=8, color=( 255, 255, 0 ) ):
+		"""
+		Draws the slowest entries of the last frame onto a pygame surface, one
+		line each, and returns the rect covered.
+		"""
+		import pygame
+		if not pygame.font.get_init():
+			pygame.font.init()
+		font = pygame.font.Font( None, 16 )
+		text = [ "frame %d  %.1f ms" % ( self.last[ 'frame' ], self.last[ 'seconds' ] * 1e3 ) ] if self.last else [ "no frames" ]
+		if self.last:
+			calls = sorted( self.last[ 'calls' ].items(), key=lambda item: -item[1][ 'seconds' ] )
+			for name, stat in calls[ :lines ]:
+				text.append( "%-24s %4d x %7.2f ms%s" % ( name, stat[ 'calls' ], stat[ 'seconds' ] * 1e3,
+					"  %d cells %d polys" % ( stat.get( 'cells', 0 ), stat.get( 'polygons', 0 ) + stat.get( 'lines', 0 ) )
+						if 'cells' in stat else "" ) )
+
+		rect = pygame.Rect( position, ( 0, 0 ) )
+		left, top = position
+		for line in text:
+			rendered = font.render( line, True, color, ( 0, 0, 0 ) )
+			rect.union_ip( surface.blit( rendered, ( left, top ) ) )
+			top += rendered.get_height()
+		return rect
+
+	def _stat( self, name ):
+		# calls, seconds, longest call, cells drawn, polygons, lines
+		stat = self._stats.get( name )
+		if stat is None:
+			stat = self._stats[ name ] = [ 0, 0.0, 0.0, None, 0, 0 ]
+		return stat
+
+	def _calls( self ):
+		"""The labels of the timed calls in progress on the current thread, innermost last."""
+		try:
+			return self._local.stack
+		except AttributeError:
+			stack = self._local.stack = []
+			return stack
+
+	def _record( self, label, elapsed, cells=None ):
+		"""Adds a finished call to the current frame."""
+		with self._lock:
+			stat = self._stat( label )
+			stat[0] += 1
+			stat[1] += elapsed
+			if elapsed > stat[2]:
+				stat[2] = elapsed
+			if cells is not None:
+				stat[3] = ( stat[3] or 0 ) + cells
+
+	def _patch( self, cls, name, draw=False ):
+		"""Wraps cls.name, if cls defines it, with a timer.  draw methods also count cells_drawn."""
+		value = cls.__dict__.get( name )
+		label = "%s.%s" % ( cls.__name__, name )
+		if isinstance( value, classmethod ):
+			wrapped = classmethod( self._timer( label, value.__func__ ) )
+		elif isinstance( value, staticmethod ):
+			wrapped = staticmethod( self._timer( label, value.__func__ ) )
+		elif inspect.isfunction( value ):
+			wrapped = self._timer( label, value, draw )
+		else:
+			return
+		self._patched.append( ( cls, name, value ) )
+		setattr( cls, name, wrapped )
+
+	def _timer( self, label, function, draw=False ):
+		profiler = self
+
+		if inspect.isgeneratorfunction( function ):
+			# Time the work done while the generator is consumed, recorded once it finishes
+			def timed( *args, **keywords ):
+				iterator = function( *args, **keywords )
+				spent = 0.0
+				try:
+					while True:
+						stack = profiler._calls()
+						stack.append( label )
+						start = clock()
+						try:
+							value = next( iterator )
+						except StopIteration:
+							break
+						finally:
+							spent += clock() - start
+							stack.pop()
+						yield value
+				finally:
+					profiler._record( label, spent )
+		else:
+			def timed( *args, **keywords ):
+				stack = profiler._calls()
+				stack.append( label )
+				start = clock()
+				try:
+					return function( *args, **keywords )
+				finally:
+					elapsed = clock() - start
+					stack.pop()
+					profiler._record( label, elapsed, args[0].cells_drawn if draw else None )
+
+		timed.__name__ = function.__name__
+		timed.__doc__ = function.__doc__
+		timed.__wrapped__ = function
+		return timed
+
+	def _patch_draw( self, module, name ):
+		"""Counts calls to a pygame.draw function against the innermost timed method."""
+		original = getattr( module, name )
+		column = { 'polygon': 4, 'line': 5 }[ name ]
+		profiler = self
+
+		def counted( *args, **keywords ):
+			stack = profiler._calls()
+			if stack:
+				with profiler._lock:
+					profiler._stat( stack[-1] )[ column ] += 1
+			return original( *args, **keywords )
+
+		self._patched.append( ( module, name, original ) )
+		setattr( module, name, counted )
+
+def _summary( stat ):
+	calls, seconds, longest, cells, polygons, lines = stat
+	summary = { 'calls': calls, 'seconds': seconds, 'longest': longest }
+	if cells is not None:
+		summary[ 'cells' ] = cells
+	if polygons:
+		summary[ 'polygons' ] = polygons
+	if lines:
+		summary[ 'lines' ] = lines
+	return summary
+
+def _subclasses( cls ):
+	"""Every subclass of cls, at any depth."""
+	result = []
+	for subclass in cls.__subclasses__():
+		result.append( subclass )
+		result.extend( _subclasses( subclass ) )
+	return result
+
+class RingBuffer( object ):
+	"""Keeps the records of the last size frames in memory."""
+
+	def __init__( self, size=600 ):
+		self.records = deque( maxlen=size )
+
+	def __repr__( self ):
+		return "RingBuffer(%d)" % self.records.maxlen
+
+	def __len__( self ):
+		return len( self.records )
+
+	def __iter__( self ):
+		return iter( self.records )
+
+	def write( self, record ):
+		self.records.append( record )
+
+	def totals( self ):
+		"""Returns the calls and seconds of each name summed over the kept frames."""
+		totals = {}
+		for record in self.records:
+			for name, stat in record[ 'calls' ].items():
+				total = totals.setdefault( name, { 'calls': 0, 'seconds': 0.0 } )
+				total[ 'calls' ] += stat[ 'calls' ]
+				total[ 'seconds' ] += stat[ 'seconds' ]
+		return totals
+
+class JsonLines( object ):
+	"""Appends each record as a line of JSON to a file, given as a path or a file like object."""
+
+	def __init__( self, output ):
+		self.path = output if isinstance( output, basestring ) else None
+		self.output = open( output, 'a' ) if self.path else output
+
+	def __repr__( self ):
+		return "JsonLines(%r)" % ( self.path or self.output )
+
+	def write( self, record ):
+		self.output.write( json.dumps( record, sort_keys=True ) + "\n" )
+
+	def close( self ):
+		if self.path:
+			self.output.close()
+		else:
+			self.output.flush()
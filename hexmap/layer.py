@@ -0,0 +1,366 @@
+from collections import OrderedDict
+import numpy
+import os
+import tempfile
+
+import logging
+logger = logging.getLogger( __name__ )
+
+
+class DenseLayer( object ):
+	"""
+	A per cell layer stored in a contiguous numpy array, for data that covers
+	most of a map, like fog or terrain costs.  It can be used in place of a
+	Grid: looking up a cell returns its value, or the default for cells that
+	are not on the map.
+
+	Cell (row, col) is stored at array[ row - ceil( col / 2 ), col ], so the
+	array has the shape (map.rows, map.cols).  Layers of arbitrary objects,
+	like pygame.Color fog states, can pass a palette of the values they will
+	hold; the array then stores small integer codes into the palette.
+
+	As with Grid, setting dirty to a set records every cell written to, and
+	version is incremented by every write made through the layer.  Increment
+	it after modifying array directly.
+	"""
+
+	version = 0
+
+	def __init__( self, map, default=0, dtype=None, palette=None ):
+		self.map = map
+		self.default = default
+		self.palette = None
+		if palette is not None:
+			self.palette = list( palette )
+			if default not in self.palette:
+				self.palette.insert( 0, default )
+			dtype = numpy.uint8 if len( self.palette ) <= 256 else numpy.uint16
+		self.array = numpy.empty( ( map.rows, map.cols ), dtype=dtype )
+		self.array.fill( self.encode( default ) )
+		self.dirty = None		# Set to a set() to collect the cells written to
+
+	def __repr__( self ):
+		return "DenseLayer(%s, %s)" % ( self.map, self.array.dtype )
+
+	@property
+	def nbytes( self ):
+		"""The number of bytes used by the layer's values."""
+		return self.array.nbytes
+
+	# Conversion between cells, array indices and stored values
+	def lookup( self, value ):
+		"""Returns the value stored in the array for value, or None if the palette does not hold it."""
+		if self.palette is None:
+			return value
+		for code, entry in enumerate( self.palette ):
+			if entry == value:
+				return code
+		return None
+
+	def encode( self, value ):
+		"""Returns the value stored in the array for value, adding it to the palette if needed."""
+		if self.palette is None:
+			if value is None:
+				raise ValueError( "%s has no palette and cannot store None, use a sentinel such as inf" % self )
+			return value
+		code = self.lookup( value )
+		if code is not None:
+			return code
+		if len( self.palette ) > numpy.iinfo( self.array.dtype ).max:
+			raise ValueError( "Palette of %s is full, cannot add %s" % ( self, value ) )
+		self.palette.append( value )
+		return len( self.palette ) - 1
+
+	def decode( self, code ):
+		"""Returns the value represented by a stored array value."""
+		return code if self.palette is None else self.palette[ code ]
+
+	def index( self, cell ):
+		"""Returns the array index of a cell, or None if the cell is not on the map."""
+		row, col = cell
+		i = row - ( col + 1 ) // 2
+		if col < 0 or col >= self.map.cols or i < 0 or i >= self.map.rows:
+			return None
+		return ( i, col )
+
+	def indices( self, cells ):
+		"""
+		Converts a sequence or (N,2) array of cells into a pair of index arrays
+		usable on self.array.  Cells that are not on the map are dropped.
+		"""
+		cells = numpy.asarray( cells, dtype=numpy.intp ).reshape( -1, 2 )
+		rows, cols = cells[:, 0], cells[:, 1]
+		i = rows - ( cols + 1 ) // 2
+		valid = ( cols >= 0 ) & ( cols < self.map.cols ) & ( i >= 0 ) & ( i < self.map.rows )
+		return ( i[valid], cols[valid] )
+
+	def cells( self, i, j ):
+		"""Converts a pair of index arrays back into an (N,2) array of cells."""
+		i, j = numpy.asarray( i ), numpy.asarray( j )
+		return numpy.column_stack( ( i + ( j + 1 ) // 2, j ) )
+
+	# Grid compatible accessors
+	def __getitem__( self, cell ):
+		index = self.index( cell )
+		if index is None:
+			return self.default
+		return self.decode( self.array[ index ] )
+
+	def get( self, cell, default=None ):
+		index = self.index( cell )
+		return default if index is None else self.decode( self.array[ index ] )
+
+	def __setitem__( self, cell, value ):
+		index = self.index( cell )
+		if index is None:
+			raise KeyError( cell )
+		self.array[ index ] = self.encode( value )
+		self.version += 1
+		if self.dirty is not None:
+			self.dirty.add( cell )
+
+	def __delitem__( self, cell ):
+		self[ cell ] = self.default
+
+	def __contains__( self, cell ):
+		"""Every cell on the map is part of a dense layer."""
+		return self.index( cell ) is not None
+
+	def __len__( self ):
+		return self.array.size
+
+	def __iter__( self ):
+		return iter( self.keys() )
+
+	def keys( self ):
+		return [ tuple( cell ) for cell in self.cells( *numpy.indices( self.array.shape ).reshape( 2, -1 ) ).tolist() ]
+
+	def values( self ):
+		return [ self.decode( code ) for code in self.array.ravel().tolist() ]
+
+	def items( self ):
+		return zip( self.keys(), self.values() )
+
+	def find( self, item ):
+		"""Returns the first cell holding item, or None if no cell does."""
+		cells = self.where( item )
+		return tuple( cells[0].tolist() ) if len( cells ) else None
+
+	# Vectorized bulk operations
+	def mask( self, value ):
+		"""Returns a boolean array, shaped like self.array, of the cells holding value."""
+		code = self.lookup( value )
+		if code is None:
+			# Not in the palette, so no cell holds it
+			return numpy.zeros( self.array.shape, dtype=bool )
+		return self.array == code
+
+	def where( self, condition ):
+		"""
+		Returns an (N,2) array of the cells matching condition, which is either
+		a boolean array shaped like self.array, or a value to compare against.
+		"""
+		if not ( isinstance( condition, numpy.ndarray ) and condition.dtype == bool ):
+			condition = self.mask( condition )
+		return self.cells( *numpy.nonzero( condition ) )
+
+	def apply( self, mask, value ):
+		"""Sets every cell selected by a boolean mask, shaped like self.array, to value."""
+		self.array[ mask ] = self.encode( value )
+		self.version += 1
+		if self.dirty is not None:
+			self.dirty.update( map( tuple, self.where( mask ).tolist() ) )
+
+	def fill( self, value, cells=None ):
+		"""
+		Sets every cell in cells, e.g. the result of Map.spread, to value.
+		Fills the whole layer if no cells are given.
+		"""
+		self.version += 1
+		if cells is None:
+			self.array.fill( self.encode( value ) )
+			if self.dirty is not None:
+				self.dirty.update( self.keys() )
+		else:
+			indices = self.indices( list( cells ) )
+			self.array[ indices ] = self.encode( value )
+			if self.dirty is not None:
+				self.dirty.update( map( tuple, self.cells( *indices ).tolist() ) )
+
+
+class ChunkedLayer( object ):
+	"""
+	A per cell layer for very large, mostly untouched maps.  Cells are stored
+	in square chunks of size x size array cells, using the same array indices
+	as DenseLayer, and a chunk is only allocated when one of its cells is
+	written.  Reading an unallocated cell returns the default.
+
+	With a path, the chunks live in a numpy file opened as a memory map, and
+	at most limit chunks are held in memory; the least recently used one is
+	written back when another has to be paged in.  A limit without a path
+	pages to an anonymous temporary file.  Call flush to write every chunk,
+	and the record of which chunks are allocated, to the file so that a new
+	ChunkedLayer with the same path reopens it.
+
+	Iterating a chunked layer, or calling keys, values or items, lazily visits
+	the allocated chunks only.  As with DenseLayer, version is incremented by
+	every write.
+	"""
+
+	version = 0
+
+	def __init__( self, map, size=64, default=0, dtype=None, path=None, limit=None ):
+		self.map = map
+		self.size = size
+		self.default = default
+		self.dtype = numpy.dtype( dtype if dtype is not None else type( default ) )
+		self.limit = limit
+		self.path = path
+		self.shape = ( -( -map.rows // size ), -( -map.cols // size ) )
+		self.resident = OrderedDict()	# Chunk key to array, least recently used first
+		self.modified = set()
+		self.dirty = None		# Set to a set() to collect the cells written to
+
+		full = self.shape + ( size, size )
+		if path is not None and os.path.exists( path ):
+			self.file = numpy.lib.format.open_memmap( path, mode='r+' )
+			if self.file.shape != full or self.file.dtype != self.dtype:
+				raise ValueError( "%s holds %s %s chunks, expected %s %s" %
+					( path, self.file.shape, self.file.dtype, full, self.dtype ) )
+			if os.path.exists( path + '.chunks' ):
+				self.allocated = numpy.load( path + '.chunks' )
+			else:
+				# Never flushed, so no chunk was recorded as written
+				self.allocated = numpy.zeros( self.shape, dtype=bool )
+		else:
+			if path is not None:
+				self.file = numpy.lib.format.open_memmap( path, mode='w+', dtype=self.dtype, shape=full )
+			elif limit is not None:
+				self.file = numpy.memmap( tempfile.TemporaryFile(), mode='w+', dtype=self.dtype, shape=full )
+			else:
+				self.file = None
+			self.allocated = numpy.zeros( self.shape, dtype=bool )
+
+	def __repr__( self ):
+		return "ChunkedLayer(%s, %s, %s)" % ( self.map, self.size, self.dtype )
+
+	@property
+	def nbytes( self ):
+		"""The number of bytes used by the chunks held in memory."""
+		return sum( chunk.nbytes for chunk in self.resident.values() )
+
+	# Chunk management
+	def locate( self, cell ):
+		"""Returns the chunk key and the index within it of a cell, or None if the cell is not on the map."""
+		row, col = cell
+		i = row - ( col + 1 ) // 2
+		if col < 0 or col >= self.map.cols or i < 0 or i >= self.map.rows:
+			return None
+		return ( i // self.size, col // self.size ), ( i % self.size, col % self.size )
+
+	def chunk( self, key, create=False ):
+		"""
+		Returns the array holding a chunk, paging it in if needed.  Returns None
+		for chunks that were never written, unless create is set.
+		"""
+		chunk = self.resident.pop( key, None )
+		if chunk is None:
+			if not self.allocated[ key ]:
+				if not create:
+					return None
+				chunk = numpy.empty( ( self.size, self.size ), dtype=self.dtype )
+				chunk.fill( self.default )
+				self.allocated[ key ] = True
+				self.modified.add( key )
+			else:
+				chunk = numpy.array( self.file[ key ] )
+			if self.limit is not None:
+				while len( self.resident ) >= self.limit:
+					self._evict()
+		self.resident[ key ] = chunk
+		return chunk
+
+	def chunks( self ):
+		"""Yields the keys of the allocated chunks."""
+		for key in zip( *numpy.nonzero( self.allocated ) ):
+			yield tuple( int( k ) for k in key )
+
+	def chunk_cells( self, key ):
+		"""Returns the cells covered by a chunk that are on the map."""
+		return self.map.chunk_cells( key, self.size )
+
+	def _evict( self ):
+		key, chunk = self.resident.popitem( last=False )
+		if key in self.modified:
+			self.file[ key ] = chunk
+			self.modified.discard( key )
+
+	def flush( self ):
+		"""Writes the modified chunks held in memory to the backing file."""
+		if self.file is None:
+			return
+		for key in list( self.modified ):
+			self.file[ key ] = self.resident[ key ]
+		self.modified.clear()
+		self.file.flush()
+		if self.path is not None:
+			with open( self.path + '.chunks', 'wb' ) as index:
+				numpy.save( index, self.allocated )
+
+	# Grid compatible accessors
+	def __getitem__( self, cell ):
+		return self.get( cell, self.default )
+
+	def get( self, cell, default=None ):
+		location = self.locate( cell )
+		if location is None:
+			return default
+		chunk = self.chunk( location[0] )
+		return self.default if chunk is None else chunk[ location[1] ].item()
+
+	def __setitem__( self, cell, value ):
+		location = self.locate( cell )
+		if location is None:
+			raise KeyError( cell )
+		self.chunk( location[0], create=True )[ location[1] ] = value
+		self.modified.add( location[0] )
+		self.version += 1
+		if self.dirty is not None:
+			self.dirty.add( cell )
+
+	def __delitem__( self, cell ):
+		self[ cell ] = self.default
+
+	def __contains__( self, cell ):
+		"""Every cell on the map is part of a chunked layer."""
+		return self.locate( cell ) is not None
+
+	def __len__( self ):
+		return self.map.rows * self.map.cols
+
+	def __iter__( self ):
+		return self.keys()
+
+	def keys( self ):
+		for cell, value in self.items():
+			yield cell
+
+	def values( self ):
+		for cell, value in self.items():
+			yield value
+
+	def items( self ):
+		for key in self.chunks():
+			chunk = self.chunk( key )
+			for cell in self.chunk_cells( key ):
+				yield cell, chunk[ self.locate( cell )[1] ].item()
+
+	def fill( self, value, cells ):
+		"""Sets every cell in cells, e.g. the result of Map.spread, to value, a chunk at a time."""
+		self.version += 1
+		for key, group in self.map.by_chunk( cells, self.size ).items():
+			indices = numpy.array( [ self.locate( cell )[1] for cell in group ] ).reshape( -1, 2 )
+			self.chunk( key, create=True )[ indices[:, 0], indices[:, 1] ] = value
+			self.modified.add( key )
+			if self.dirty is not None:
+				self.dirty.update( group )
@@ -1,9 +1,10 @@
 from abc import ABCMeta, abstractmethod
-import argparse
+from collections import OrderedDict
+from heapq import heappush, heappop
+import itertools
 import math
-import operator
-import pygame
-import random
+import numpy
+import weakref
 
 import logging
 logger = logging.getLogger( __name__ )
@@ -14,15 +15,40 @@ class Map( object ):
 	An top level object for managing all game data related to positioning.
 	"""
 	directions = [ ( 0, 1 ), ( 1, 1 ), ( 1, 0 ), ( 0, -1 ), ( -1, -1 ), ( -1, 0 ) ]
+	flow_cache_size = 16		# Number of flow fields kept by flow_field
+	adjacency_limit = 1 << 16	# Largest map, in cells, whose cells and neighbors are served from Adjacency tables
+	shape_cache_size = 256		# Number of shape templates kept by spread, cone, slice and line
+	shape_memo_size = 0			# Number of resolved shapes kept per origin, none by default
 
 	def __init__( self, ( rows, cols ), *args, **keywords ):
 		#Map size
 		self.rows = rows
 		self.cols = cols
+		self._flow_fields = OrderedDict()
+		self._min_costs = {}
+		self._shapes = {}
+		self._resolved = {}
+		self._uses = itertools.count()
+		self._lists = None
+		self._untabled = None
 
 	def __str__( self ):
 		return "Map (%d, %d)" % ( self.rows, self.cols )
 
+	def __getstate__( self ):
+		# Cached results are rebuilt on demand rather than pickled
+		return dict( ( k, v ) for k, v in self.__dict__.items() if not k.startswith( '_' ) )
+
+	def __setstate__( self, state ):
+		self.__dict__.update( state )
+		self._flow_fields = OrderedDict()
+		self._min_costs = {}
+		self._shapes = {}
+		self._resolved = {}
+		self._uses = itertools.count()
+		self._lists = None
+		self._untabled = None
+
 	@property
 	def size( self ):
 		"""Returns the size of the grid as a tuple (row, col)"""
@@ -31,14 +57,34 @@ class Map( object ):
 	@classmethod
 	def distance( self, start, destination ):
 		"""Takes two hex coordinates and determine the distance between them."""
-		logger.debug( "Start: %s, Dest: %s", start, destination )
+		if isinstance( start, _INTS ):
+			start = unpack( start )
+		if isinstance( destination, _INTS ):
+			destination = unpack( destination )
 		diffX = destination[0] - start[0]
 		diffY = destination[1] - start[1]
+		return max( abs( diffX ), abs( diffY ), abs( diffX - diffY ) )
 
-		distance = min( abs( diffX ), abs( diffY ) ) + abs( diffX - diffY )
+	@classmethod
+	def distances( self, starts, destinations, pairwise=False ):
+		"""
+		Vectorized distance.  Takes two (N,2) arrays of hex coordinates and
+		returns an array of the N distances between them.  If pairwise is True,
+		destinations may be (M,2) and an (N,M) matrix of every start to every
+		destination is returned instead.
+		"""
+		diff = self._offsets( starts, destinations, pairwise )
+		diffX, diffY = diff[..., 0], diff[..., 1]
+		return numpy.maximum( numpy.maximum( abs( diffX ), abs( diffY ) ), abs( diffX - diffY ) )
 
-		logger.debug( "diffX: %d, diffY: %d, distance: %d", diffX, diffY, distance )
-		return distance
+	@staticmethod
+	def _offsets( origins, destinations, pairwise=False ):
+		"""Returns destinations - origins as an integer array, broadcasting every pair if pairwise."""
+		origins = numpy.asarray( origins, dtype=numpy.intp ).reshape( -1, 2 )
+		destinations = numpy.asarray( destinations, dtype=numpy.intp ).reshape( -1, 2 )
+		if pairwise:
+			return destinations[ numpy.newaxis, :, : ] - origins[ :, numpy.newaxis, : ]
+		return destinations - origins
 
 	@classmethod
 	def direction( self, origin, destination ):
@@ -51,6 +97,7 @@ class Map( object ):
 		if scale == 0:
 			return ( 0, 0 )
 		direction = ( offset[0] / scale, offset[1] / scale )
+		import random		# Imported on use, to keep the core quick to import
 
 		#Handle special cases
 		if direction == ( 1, -1 ):
@@ -69,83 +116,225 @@ class Map( object ):
 
 		return ( choose( direction[0] ), choose( direction[1] ) )
 
-	def ascii( self, numbers=True ):
+	@classmethod
+	def directions_between( self, origins, destinations, pairwise=False, rng=None ):
+		"""
+		Vectorized direction.  Takes two (N,2) arrays of hex coordinates and
+		returns an (N,2) array of the dominating direction from each origin to
+		its destination, or an (N,M,2) array if pairwise is True.  Ties are
+		broken with rng, which may be a seed or a numpy RandomState, so that
+		batches can be reproduced.
+		"""
+		if not isinstance( rng, numpy.random.RandomState ):
+			rng = numpy.random.RandomState( rng )
+		offset = self._offsets( origins, destinations, pairwise )
+		scale = abs( offset ).max( axis=-1 )[ ..., numpy.newaxis ]
+		coins = rng.randint( 0, 2, size=offset.shape )
+
+		# Round each component of offset / scale, choosing randomly on a half
+		result = numpy.where( 2 * abs( offset ) > scale, numpy.sign( offset ), 0 )
+		result = numpy.where( 2 * offset == scale, coins, result )
+		result = numpy.where( 2 * offset == -scale, -coins, result )
+
+		#Handle special cases
+		for sign in ( 1, -1 ):
+			special = ( offset[..., 0] == sign * scale[..., 0] ) & ( offset[..., 1] == -sign * scale[..., 0] )
+			coin = coins[..., 0][ special ]
+			result[ special ] = numpy.column_stack( ( sign * ( 1 - coin ), -sign * coin ) )
+
+		result[ scale[..., 0] == 0 ] = 0
+		return result
+
+	def ascii( self, numbers=True, rows=None, cols=None ):
 		""" Debug method that draws the grid using ascii text """
+		return "".join( self.iter_ascii( numbers, rows, cols ) )
 
-		table = ""
+	def write_ascii( self, output, numbers=True, rows=None, cols=None ):
+		"""Writes the ascii drawing to a file like object, a line at a time."""
+		for line in self.iter_ascii( numbers, rows, cols ):
+			output.write( line )
 
-		if numbers:
-			text_length = len( 
-				str( self.rows - 1 if self.cols % 2 == 1 else self.rows ) +
-				',' +
-				str( int( self.rows - 1 + math.floor( self.cols / 2 ) ) )
-			)
-		else:
-			text_length = 3
+	def iter_ascii( self, numbers=True, rows=None, cols=None ):
+		"""
+		Lazily yields the lines of the ascii drawing, each ending in a newline.
+		rows and cols are ( start, stop ) ranges of array rows and columns (see
+		DenseLayer) to draw a window of the map; the lines of a window are
+		substrings of the lines of the whole drawing, so windows of huge maps
+		can be compared or logged without drawing everything.
+		"""
+		first, last = max( rows[0], 0 ) if rows else 0, min( rows[1], self.rows ) if rows else self.rows
+		left, right = max( cols[0], 0 ) if cols else 0, min( cols[1], self.cols ) if cols else self.cols
+		text_length = self._ascii_width( numbers )
+		edge = '_' * text_length
+		blank = ' ' * text_length
 
 		#Header for first row
-		for col in range( self.cols ):
-			if col % 2 == 0:
-				table += " " + '_' * text_length
-			else:
-				table += " " + ' ' * text_length
-		table += "\n"
+		yield "".join( " " + ( edge if col % 2 == 0 else blank ) for col in range( left, right ) ) + "\n"
 		# Each row
-		for row in range( self.rows ):
-			top = "/"
-			bottom = "\\"
+		for row in range( first, last ):
+			top = [ "/" if left % 2 == 0 else "\\" ]
+			bottom = [ "\\" if left % 2 == 0 else "/" ]
 
-			for col in range( self.cols ):
-#				unit = "U" if units and self.positions.get( ( row + col / 2, col ) ) else ""
+			for col in range( left, right ):
 				if col % 2 == 0:
 					text = "%d,%d" % ( row + col / 2, col ) if numbers else ""
-					top 	 += ( text ).center( text_length ) + "\\"
-					bottom	 += ( "" ).center( text_length, '_' ) + "/"
+					top.append( text.center( text_length ) + "\\" )
+					bottom.append( edge + "/" )
 				else:
 					text = "%d,%d" % ( 1 + row + col / 2, col ) if numbers else " "
-					top 	 += ( "" ).center( text_length, '_' ) + "/"
-					bottom	 += ( text ).center( text_length ) + "\\"
+					top.append( edge + "/" )
+					bottom.append( text.center( text_length ) + "\\" )
+			top = "".join( top )
 			# Clean up tail slashes on even numbers of columns
-			if self.cols % 2 == 0:
+			if self.cols % 2 == 0 and right == self.cols:
 				if row == 0: top = top[:-1]
-			table += top + "\n" + bottom + "\n"
+			yield top + "\n"
+			yield "".join( bottom ) + "\n"
+
+		# Footer for last row, which starts with the lower edge of an odd first column
+		footer = [ "\\" if left % 2 == 1 else " " ]
+		for col in range( left, right ):
+			if col % 2 == 1:
+				footer.append( edge + "/" )
+			elif col + 1 < right:
+				footer.append( blank + "\\" )
+		yield "".join( footer ) + "\n"
+
+	def _ascii_width( self, numbers ):
+		"""The width of a cell's label in the ascii drawing."""
+		if not numbers:
+			return 3
+		return len(
+			str( self.rows - 1 if self.cols % 2 == 1 else self.rows ) +
+			',' +
+			str( int( self.rows - 1 + math.floor( self.cols / 2 ) ) )
+		)
 
-		# Footer for last row
-		footer = " "
-		for col in range( 0, self.cols - 1, 2 ):
-			footer += " " * text_length + "\\" + '_' * text_length + "/"
-		table += footer + "\n"
-		return table
+	# Dense indexing
+	def index( self, cell ):
+		"""
+		Returns the index of a valid cell, or packed cell, among the cells
+		numbered 0 to rows * cols - 1 in the order of DenseLayer.array.ravel().
+		"""
+		if isinstance( cell, _INTS ):
+			cell = unpack( cell )
+		return ( cell[0] - ( cell[1] + 1 ) // 2 ) * self.cols + cell[1]
+
+	def cell( self, index ):
+		"""Returns the cell numbered index, the inverse of Map.index."""
+		i, j = divmod( index, self.cols )
+		return ( i + ( j + 1 ) // 2, j )
+
+	def adjacency( self ):
+		"""
+		Returns the Adjacency of this map's size: the cells by index and the
+		indices of their neighbors as arrays, for graph algorithms to run on.
+		"""
+		return Adjacency.get( self.size )
+
+	def _adjacency_lists( self ):
+		"""
+		The Adjacency lists Map.neighbors uses, or None until it has answered
+		about half as many queries as the map has cells, which pays for
+		building them, and () on maps larger than adjacency_limit.
+		"""
+		if self.rows * self.cols > self.adjacency_limit:
+			self._lists = ()
+			return self._lists
+		if self._untabled is None:
+			self._untabled = self.rows * self.cols // 2
+		self._untabled -= 1
+		if self._untabled < 0:
+			self._lists = self.adjacency().lists
+		return self._lists
 
 	def valid_cell( self, cell ):
-		row, col = cell
+		if isinstance( cell, _INTS ):
+			row, col = ( cell >> 32 ) - _BIAS, ( cell & _MASK ) - _BIAS
+		else:
+			row, col = cell
 		if col < 0 or col >= self.cols: return False
-		if row < math.ceil( col / 2.0 ) or row >= math.ceil( col / 2.0 ) + self.rows: return False
+		top = ( col + 1 ) // 2		# ceil( col / 2 ), without floats that lose precision on huge maps
+		if row < top or row >= top + self.rows: return False
 		return True
 
 	def neighbors( self, center ):
 		"""
-		Return the valid cells neighboring the provided cell.
+		Return the valid cells neighboring the provided cell.  A packed cell
+		gets packed neighbors, computed without building any tuples.  Maps of
+		up to adjacency_limit cells look the neighbors up in the Adjacency,
+		once they have been asked often enough to pay for its lists.
 		"""
-		return filter( self.valid_cell, [
-			( center[0] - 1, center[1] ), ( center[0], center[1] + 1 ),
-			( center[0] + 1, center[1] + 1 ), ( center[0] + 1, center[1] ),
-			( center[0], center[1] - 1 ), ( center[0] - 1, center[1] - 1 )
-		] )
+		rows, cols = self.rows, self.cols
+		if isinstance( center, _INTS ):
+			row, col = ( center >> 32 ) - _BIAS, ( center & _MASK ) - _BIAS
+			return [ center + delta for dr, dc, delta in _PACKED_NEIGHBORS
+				if 0 <= col + dc < cols and 0 <= row + dr - ( col + dc + 1 ) // 2 < rows ]
+		row, col = center
+		i = row - ( col + 1 ) // 2
+		tables = self._lists
+		if tables is None:
+			tables = self._adjacency_lists()
+		if tables and 0 <= col < cols and 0 <= i < rows:
+			# Look the neighbors up in the adjacency table
+			keys, offsets, targets = tables
+			node = i * cols + col
+			return [ keys[ target ] for target in targets[ offsets[ node ]:offsets[ node + 1 ] ] ]
+		return [ ( row + dr, col + dc ) for dr, dc, delta in _PACKED_NEIGHBORS
+			if 0 <= col + dc < cols and 0 <= row + dr - ( col + dc + 1 ) // 2 < rows ]
+
+	def ring( self, center, radius=1 ):
+		"""
+		Lazily yields the valid cells exactly *radius* steps away from center.
+		Starts at the corner in direction 4 and walks the six edges in order.
+		"""
+		if isinstance( center, _INTS ):
+			for cell in self.ring( unpack( center ), radius ):
+				yield pack( cell )
+			return
+		if radius == 0:
+			if self.valid_cell( center ):
+				yield center
+			return
+		row, col = center[0] - radius, center[1] - radius
+		for step in self.directions:
+			for i in range( radius ):
+				if self.valid_cell( ( row, col ) ):
+					yield ( row, col )
+				row, col = row + step[0], col + step[1]
+
+	def range( self, center, radius=1 ):
+		"""
+		Lazily yields the valid cells within *radius* steps of center, including
+		center itself.  Only columns and rows that fall on the map are visited,
+		so the cost is proportional to the number of cells yielded.
+		"""
+		if isinstance( center, _INTS ):
+			for cell in self.range( unpack( center ), radius ):
+				yield pack( cell )
+			return
+		row, col = center
+		for dcol in range( max( -radius, -col ), min( radius, self.cols - 1 - col ) + 1 ):
+			c = col + dcol
+			# Rows valid in this column, intersected with the rows within radius
+			top = ( c + 1 ) // 2
+			first = max( row + max( -radius, dcol - radius ), top )
+			last = min( row + min( radius, dcol + radius ), top + self.rows - 1 )
+			for r in range( first, last + 1 ):
+				yield ( r, c )
 
 	def spread( self, center, radius=1 ):
 		"""
-		A slice of a map is a collection of valid cells, starting at an origin, 
-		and encompassing all cells within a given radius. 
+		A slice of a map is a collection of valid cells, starting at an origin,
+		and encompassing all cells within a given radius.
 		"""
-		result = set( ( center, ) )				#Start out with this center cell
-		neighbors = self.neighbors( center )	#Get the neighbors for use later
-		if radius == 1:							#Recursion end case
-			result = result | set( neighbors )	#Return the set of this cell and its neighbors
-		else:					#Otherwise, recurse over all the neghbors, 
-			for n in neighbors:	#decrementing the radius by one.
-				result = result | set( self.spread( n, radius - 1 ) )
-		return filter( self.valid_cell, result )#filter invalid cells before returning.
+		if self.valid_cell( center ):
+			return self._shape( ( 'spread', radius ), center )
+		# An off map center only reaches the map through its valid neighbors
+		result = set()
+		for n in self.neighbors( center ):
+			result.update( self.range( n, radius - 1 ) )
+		return list( result )
 
 	def cone( self, origin, direction, length=1 ):
 		"""
@@ -161,9 +350,7 @@ class Map( object ):
 		\_____/ 1,0 \_____/
 		      \_____/
 		"""
-		result = self.slice( origin, direction, length )
-		result.extend( self.slice( origin, ( direction + 1 ) % 6, length ) )
-		return filter( self.valid_cell, set( result ) )
+		return self._shape( ( 'cone', direction % 6, length ), origin )
 
 	def slice( self, origin, direction, length=2 ):
 		"""
@@ -179,63 +366,1124 @@ class Map( object ):
 		\_____/ 1,0 \_____/
 		      \_____/
 		"""
-		# The edge wheel described in the docnotes above, used for calculating edges and steps
+		return self._shape( ( 'slice', direction % 6, length ), origin )
 
+	def line( self, origin, direction, length=3 ):
+		"""
+		Returns all the cells along a given line, starting at an origin
+		"""
+		return self._shape( ( 'line', direction % 6, length ), origin )
 
-		# edge is the step we take for each distance, 
-		# step is the increment for each cell that distance out
-		edge, step = self.directions[ direction % 6], self.directions[( direction + 2 ) % 6]
+	# Shape templates
+	def _shape( self, key, origin ):
+		"""
+		Returns the valid cells of the shape described by key placed at origin,
+		a cell or packed cell.  Offsets from the origin are the same wherever a
+		shape is placed, so each shape's offsets are computed once into a
+		_Template and only translated and bounds checked per call.  With
+		shape_memo_size set, the resolved cells are also kept per origin.
+		"""
+		if self.shape_memo_size:
+			entry = self._resolved.get( ( key, origin ) )
+			if entry is None:
+				cells = self._shape_template( key ).place( origin, self.rows, self.cols )
+				entry = self._resolved[ ( key, origin ) ] = [ 0, tuple( cells ) ]
+				_trim( self._resolved, self.shape_memo_size )
+			entry[0] = next( self._uses )
+			return list( entry[1] )
+		return self._shape_template( key ).place( origin, self.rows, self.cols )
 
-		logger.debug( "Edge: %s, Step: %s", edge, step )
+	def _shape_template( self, key ):
+		"""Returns the _Template for key, keeping about the shape_cache_size most recently used."""
+		entry = self._shapes.get( key )
+		if entry is None:
+			entry = self._shapes[ key ] = [ 0, _Template( _SHAPES[ key[0] ]( *key[1:] ) ) ]
+			_trim( self._shapes, self.shape_cache_size )
+		entry[0] = next( self._uses )
+		return entry[1]
 
-		result = [ origin ]
-		# Work each row, i units out along an edge
-		for i in range( 1, length + 1 ):
-			start = ( origin[0] + edge[0] * i, origin[1] + edge[1] * i )
-			for j in range( i + 1 ):
-				# calculate 
-				pos = ( start[0] + step[0] * j, start[1] + step[1] * j )
-				result.append( pos )
-		return filter( self.valid_cell, result )
+	def cells( self ):
+		"""Returns every cell on the map, ordered by row then column."""
+		if self.rows * self.cols > self.adjacency_limit:
+			return list( self.iter_cells() )
+		return list( self.adjacency().ordered )
 
-	def line( self, origin, direction, length=3 ):
+	def iter_cells( self, size=None ):
 		"""
-		Returns all the cells along a given line, starting at an origin
+		Lazily yields every cell on the map, ordered by row then column, or
+		when a chunk size is given, chunk by chunk (see chunks).
 		"""
-		offset = self.directions[direction]
-		results = [ origin ]
-		# Work each row, i units out along an edge
-		for i in range( 1, length + 1 ):
-			results.append( ( origin[0] + offset[0] * i, origin[1] + offset[1] * i ) )
-		return filter( self.valid_cell, results )
+		if size is not None:
+			for key in self.chunks( size ):
+				for cell in self.chunk_cells( key, size ):
+					yield cell
+			return
+		for row in range( self.rows + self.cols // 2 ):
+			# Columns where row lies within ceil( col / 2 ) and ceil( col / 2 ) + rows
+			for col in range( max( 2 * ( row - self.rows ) + 1, 0 ), min( 2 * row + 1, self.cols ) ):
+				yield ( row, col )
 
-	def cells( self ):
-		cells = []
-		for row in range( self.rows + self.cols / 2 ):
-			cells.extend( 
-				[( row, col ) for col in range( 1 + 2 * row ) ]
-			)
-		return filter( self.valid_cell, cells )
+	# Chunks
+	def chunk_of( self, cell, size ):
+		"""
+		Returns the key of the chunk holding a cell.  Chunks are size x size
+		blocks of the map's array indices, see DenseLayer.
+		"""
+		row, col = cell
+		return ( ( row - ( col + 1 ) // 2 ) // size, col // size )
+
+	def chunks( self, size ):
+		"""Yields the keys of the chunks covering the map, ordered by row then column."""
+		for i in range( -( -self.rows // size ) ):
+			for j in range( -( -self.cols // size ) ):
+				yield ( i, j )
+
+	def chunk_cells( self, ( i, j ), size ):
+		"""Returns the cells of a chunk that are on the map, ordered by column then row."""
+		return [ ( row + ( col + 1 ) // 2, col )
+			for col in range( j * size, min( ( j + 1 ) * size, self.cols ) )
+			for row in range( i * size, min( ( i + 1 ) * size, self.rows ) ) ]
+
+	def by_chunk( self, cells, size ):
+		"""
+		Groups the valid cells of an iterable, like the result of range or
+		spread, into a dict of chunk key to cells, so that a region can be
+		processed one chunk at a time.
+		"""
+		groups = {}
+		for cell in cells:
+			if self.valid_cell( cell ):
+				groups.setdefault( self.chunk_of( cell, size ), [] ).append( cell )
+		return groups
+
+	# Pathfinding
+	def find_path( self, start, goal, cost=None, max_cost=None, blocked=None ):
+		"""
+		Finds the cheapest path from start to goal using A*.  Returns the list
+		of cells from start to goal, inclusive, or None if there is no path.
+
+		cost is the price of entering each cell, either a Grid, a DenseLayer,
+		or a numpy array laid out like DenseLayer.array.  Without one, every
+		step costs 1.  Cells costing None or infinity cannot be entered, nor can
+		cells for which the blocked predicate returns True.  Paths costing more
+		than max_cost are not explored.  Packed cells give a packed path.
+		"""
+		if isinstance( start, _INTS ):
+			path = self.find_path( unpack( start ), unpack( goal ), cost, max_cost, blocked )
+			return None if path is None else [ pack( cell ) for cell in path ]
+		if not self.valid_cell( start ) or not self.valid_cell( goal ):
+			return None
+		best, parent = self._search( start, goal, cost, max_cost, blocked )
+		node = self.index( goal )
+		if node not in best:
+			return None
+		path = []
+		while node is not None:
+			path.append( self.cell( node ) )
+			node = parent[ node ]
+		path.reverse()
+		return path
+
+	def reachable( self, start, budget, cost=None, blocked=None ):
+		"""
+		Returns a dictionary of every cell reachable from start for at most
+		budget, mapped to the cheapest cost of reaching it.  Useful for
+		highlighting a unit's movement range.  cost and blocked are treated as
+		in find_path.
+		"""
+		if isinstance( start, _INTS ):
+			return dict( ( pack( cell ), g ) for cell, g in self.reachable( unpack( start ), budget, cost, blocked ).iteritems() )
+		if not self.valid_cell( start ):
+			return {}
+		best, parent = self._search( start, None, cost, budget, blocked )
+		return dict( ( self.cell( node ), g ) for node, g in best.iteritems() )
+
+	def _min_cost( self, cost, flat ):
+		"""
+		Returns the cheapest step of a cost layer, or 0 if it has none, which
+		weights the A* heuristic.  Layers with a version keep their result
+		until they change, so repeated queries do not rescan them.
+		"""
+		version = getattr( cost, 'version', None )
+		cached = self._min_costs.get( id( cost ) )
+		if version is not None and cached is not None and cached[0] is cost and cached[1] == version:
+			return cached[2]
+		if flat is not None:
+			weight = float( flat.min() )
+		else:
+			# values may be a generator, as with ChunkedLayer
+			values = [ v for v in itertools.chain( cost.values(), [ cost.default ] ) if v is not None ]
+			weight = min( values ) if values else 0
+		weight = weight if 0 < weight < INFINITY else 0
+		if version is not None:
+			if len( self._min_costs ) >= self.flow_cache_size:
+				self._min_costs.clear()
+			self._min_costs[ id( cost ) ] = ( cost, version, weight )
+		return weight
+
+	def _search( self, start, goal, cost, budget, blocked ):
+		"""
+		A* from start towards goal, or Dijkstra over everything within budget if
+		goal is None.  Cells are handled as flat indices so that expanding a node
+		allocates nothing but its heap entries.  Returns the best known cost and
+		parent of every visited node.
+		"""
+		rows, cols = self.rows, self.cols
+		flat = layer = None
+		if cost is not None:
+			array = getattr( cost, 'array', cost ) if getattr( cost, 'palette', None ) is None else None
+			if isinstance( array, numpy.ndarray ):
+				flat = array.ravel()
+			else:
+				layer = cost
+
+		# The heuristic is the hex distance scaled by the cheapest step
+		weight = goal_row = goal_col = 0
+		if goal is not None:
+			goal_row, goal_col = goal
+			weight = 1 if cost is None else self._min_cost( cost, flat )
+		node = self.index( start )
+		best = { node: 0 }
+		parent = { node: None }
+		heap = [ ( 0, 0, node ) ]
+		target = None if goal is None else self.index( goal )
+
+		while heap:
+			f, g, node = heappop( heap )
+			g = -g
+			if g > best[ node ]:
+				continue
+			if node == target:
+				break
+			i, j = divmod( node, cols )
+			for di, dj in _STEPS[ j & 1 ]:
+				ni, nj = i + di, j + dj
+				if ni < 0 or ni >= rows or nj < 0 or nj >= cols:
+					continue
+				neighbor = ni * cols + nj
+				if flat is not None:
+					step = flat.item( neighbor )
+				elif layer is not None:
+					step = layer[ ( ni + ( nj + 1 ) // 2, nj ) ]
+				else:
+					step = 1
+				if step is None or step == INFINITY:
+					continue
+				if blocked is not None and blocked( ( ni + ( nj + 1 ) // 2, nj ) ):
+					continue
+				total = g + step
+				if budget is not None and total > budget:
+					continue
+				if total < best.get( neighbor, INFINITY ):
+					best[ neighbor ] = total
+					parent[ neighbor ] = node
+					if weight:
+						dr, dc = goal_row - ni - ( nj + 1 ) // 2, goal_col - nj
+						total += weight * max( abs( dr ), abs( dc ), abs( dr - dc ) )
+						heappush( heap, ( total, -best[ neighbor ], neighbor ) )
+					else:
+						heappush( heap, ( total, -total, neighbor ) )
+		return best, parent
+
+	# Batches
+	def batch( self, queries, processes=None, chunksize=64 ):
+		"""
+		Answers many queries on a pool of worker processes, lazily yielding the
+		results in order.  Each query is a tuple ( method, args ) or ( method,
+		args, keywords ), e.g. ( 'find_path', ( start, goal ), { 'cost': 'terrain' } ).
+		Layers are passed by the name of the map attribute holding them, and are
+		sent to the workers once, along with the map size, until they change.
+		See hexmap.batch.BatchExecutor.
+		"""
+		from hexmap.batch import executor
+		return executor( processes ).run( self, queries, chunksize )
+
+	# Flow fields
+	def flow_field( self, targets, cost=None, blocked=None ):
+		"""
+		Computes, in a single multi-source Dijkstra pass, the cheapest cost from
+		every cell to the nearest of targets and the direction of the first step
+		along that path.  Returns a FlowField, so that each unit heading for the
+		targets only needs an array lookup per step.
+
+		cost and blocked are treated as in find_path.  Fields are cached per
+		targets and cost layer, and recomputed once the layer's version changes;
+		bump the version after writing to a layer's array directly.  Fields using
+		a blocked predicate or a plain numpy array cannot detect changes, so they
+		are not cached.
+		"""
+		targets = sorted( set( cell for cell in targets if self.valid_cell( cell ) ) )
+		cacheable = blocked is None and ( cost is None or hasattr( cost, 'version' ) )
+		key = ( tuple( targets ), id( cost ) )
+		if cacheable and key in self._flow_fields:
+			layer, version, field = self._flow_fields.pop( key )
+			if layer is None or layer.version == version:
+				self._flow_fields[ key ] = ( layer, version, field )
+				return field
+
+		field = self._flow( targets, cost, blocked )
+		if cacheable:
+			self._flow_fields[ key ] = ( cost, getattr( cost, 'version', None ), field )
+			while len( self._flow_fields ) > self.flow_cache_size:
+				self._flow_fields.popitem( last=False )
+		return field
+
+	def _flow( self, targets, cost, blocked ):
+		"""
+		Dijkstra outwards from every target at once.  Stepping from a cell into
+		node costs node's cost, so each settled node relaxes the neighbors that
+		could step into it.
+		"""
+		rows, cols = self.rows, self.cols
+		flat = layer = None
+		if cost is not None:
+			array = getattr( cost, 'array', cost ) if getattr( cost, 'palette', None ) is None else None
+			if isinstance( array, numpy.ndarray ):
+				flat = array.ravel()
+			else:
+				layer = cost
+
+		distance = [ INFINITY ] * ( rows * cols )
+		direction = [ -1 ] * ( rows * cols )
+		heap = []
+		for cell in targets:
+			node = self.index( cell )
+			distance[ node ] = 0
+			heap.append( ( 0, node ) )
+
+		while heap:
+			d, node = heappop( heap )
+			if d > distance[ node ]:
+				continue
+			i, j = divmod( node, cols )
+			if flat is not None:
+				step = flat.item( node )
+			elif layer is not None:
+				step = layer[ ( i + ( j + 1 ) // 2, j ) ]
+			else:
+				step = 1
+			if step is None or step == INFINITY:
+				continue
+			if blocked is not None and blocked( ( i + ( j + 1 ) // 2, j ) ):
+				continue
+			total = d + step
+			for di, dj, heading in _FLOW_STEPS[ j & 1 ]:
+				ni, nj = i + di, j + dj
+				if ni < 0 or ni >= rows or nj < 0 or nj >= cols:
+					continue
+				neighbor = ni * cols + nj
+				if total < distance[ neighbor ]:
+					distance[ neighbor ] = total
+					direction[ neighbor ] = heading
+					heappush( heap, ( total, neighbor ) )
+
+		return FlowField( self,
+			numpy.array( distance, dtype=float ).reshape( rows, cols ),
+			numpy.array( direction, dtype=numpy.int8 ).reshape( rows, cols ) )
+
+	# Field of view
+	def fov( self, observers, radius, opacity=None ):
+		"""
+		Returns the set of cells visible to any of the observer cells within
+		radius.  opacity is a Grid, DenseLayer, numpy array or predicate whose
+		value is true for cells that block sight.  Opaque cells are themselves
+		visible, but hide everything behind them.
+		"""
+		visible = set()
+		for observer in observers:
+			visible.update( self.visible( observer, radius, opacity ) )
+		return visible
+
+	def visible( self, observer, radius, opacity=None ):
+		"""
+		Returns the set of cells visible from a single observer, using ring by
+		ring shadowcasting.  Each ring of 6 * d cells is laid around the circle
+		[0, 1), cell k covering ( k +/- 0.5 ) / 6d.  A cell is visible unless its
+		center is shadowed by an opaque cell in a nearer ring.  The cost grows
+		with the visible area, not with the size of the map.
+		"""
+		if isinstance( observer, _INTS ):
+			return set( pack( cell ) for cell in self.visible( unpack( observer ), radius, opacity ) )
+		opaque = self._layer_getter( opacity )
+		visible = set()
+		if self.valid_cell( observer ):
+			visible.add( observer )
+		shadows = []
+		for d in range( 1, radius + 1 ):
+			cast = []
+			row, col = observer[0] - d, observer[1] - d
+			k = 0
+			for step in self.directions:
+				for i in range( d ):
+					cell = ( row, col )
+					if self.valid_cell( cell ):
+						center = float( k ) / ( 6 * d )
+						if not _shadowed( shadows, center ):
+							visible.add( cell )
+							if opaque is not None and opaque( cell ):
+								cast.append( ( ( k - .5 ) / ( 6 * d ), ( k + .5 ) / ( 6 * d ) ) )
+					row, col = row + step[0], col + step[1]
+					k += 1
+			for start, end in cast:
+				if start < 0:
+					_add_shadow( shadows, start + 1, 1 )
+					start = 0
+				_add_shadow( shadows, start, end )
+			if shadows == [ ( 0, 1 ) ]:
+				break
+		return visible
+
+	def _layer_getter( self, layer ):
+		"""Returns a function of a cell reading a Grid, DenseLayer, numpy array or predicate, or None."""
+		if layer is None or not isinstance( layer, numpy.ndarray ) and not hasattr( layer, '__getitem__' ):
+			return layer
+		if isinstance( layer, numpy.ndarray ):
+			flat = layer.ravel()
+			return lambda cell: flat.item( self.index( cell ) )
+		return layer.__getitem__
+
+INFINITY = float( 'inf' )
+
+# Packed cells: ( row, col ) stored as a single int, ( row + _BIAS ) << 32 | ( col + _BIAS ).
+# Rows and columns must lie within +/- 2 ** 30, which keeps packed cells
+# within a machine int.  Moving a packed cell by ( dr, dc ) is adding dr << 32 + dc.
+_BIAS = 1 << 30
+_MASK = ( 1 << 32 ) - 1
+_INTS = ( int, long )
+
+def pack( cell ):
+	"""Packs a ( row, col ) cell into a single int."""
+	return ( cell[0] + _BIAS ) << 32 | ( cell[1] + _BIAS )
+
+def unpack( key ):
+	"""Returns the ( row, col ) cell of a packed int."""
+	return ( ( key >> 32 ) - _BIAS, ( key & _MASK ) - _BIAS )
+
+def pack_cells( cells ):
+	"""Packs a sequence or (N,2) array of cells into an int64 array."""
+	cells = numpy.asarray( cells, dtype=numpy.int64 ).reshape( -1, 2 )
+	return ( cells[:, 0] + _BIAS ) << 32 | ( cells[:, 1] + _BIAS )
+
+def unpack_cells( keys ):
+	"""Converts an array of packed cells back into an (N,2) array of cells."""
+	keys = numpy.asarray( keys, dtype=numpy.int64 )
+	return numpy.column_stack( ( ( keys >> 32 ) - _BIAS, ( keys & _MASK ) - _BIAS ) )
+
+# Map.neighbors' offsets, with the amount to add to a packed cell for each
+_PACKED_NEIGHBORS = tuple( ( dr, dc, ( dr << 32 ) + dc ) for dr, dc in
+	( ( -1, 0 ), ( 0, 1 ), ( 1, 1 ), ( 1, 0 ), ( 0, -1 ), ( -1, -1 ) ) )
+
+def _shadowed( shadows, angle ):
+	"""True if angle falls strictly inside one of the sorted, disjoint shadow intervals."""
+	if angle == 0:
+		# Shadows across 0 are split in two, [x, 1] and [0, y]
+		return bool( shadows ) and shadows[0][0] == 0
+	for start, end in shadows:
+		if start >= angle:
+			return False
+		if angle < end:
+			return True
+	return False
+
+def _add_shadow( shadows, start, end ):
+	"""Merges [start, end] into a sorted list of disjoint shadow intervals, in place."""
+	merged = []
+	placed = False
+	for interval in shadows:
+		if interval[1] < start:
+			merged.append( interval )
+		elif interval[0] > end:
+			if not placed:
+				merged.append( ( start, end ) )
+				placed = True
+			merged.append( interval )
+		else:
+			start, end = min( start, interval[0] ), max( end, interval[1] )
+	if not placed:
+		merged.append( ( start, end ) )
+	shadows[:] = merged
+
+def _spread_offsets( radius ):
+	"""Offsets within radius of an origin, in the column then row order of Map.range."""
+	return [ ( dr, dcol ) for dcol in range( -radius, radius + 1 )
+		for dr in range( max( -radius, dcol - radius ), min( radius, dcol + radius ) + 1 ) ]
+
+def _slice_offsets( direction, length ):
+	"""Offsets of Map.slice: the origin, then each row i units out along the edge."""
+	# edge is the step we take for each distance, 
+	# step is the increment for each cell that distance out
+	edge, step = Map.directions[ direction ], Map.directions[ ( direction + 2 ) % 6 ]
+	result = [ ( 0, 0 ) ]
+	for i in range( 1, length + 1 ):
+		for j in range( i + 1 ):
+			result.append( ( edge[0] * i + step[0] * j, edge[1] * i + step[1] * j ) )
+	return result
+
+def _cone_offsets( direction, length ):
+	"""Offsets of the two slices making up Map.cone, without duplicates."""
+	result = OrderedDict.fromkeys( _slice_offsets( direction, length ) )
+	result.update( OrderedDict.fromkeys( _slice_offsets( ( direction + 1 ) % 6, length ) ) )
+	return result.keys()
+
+def _line_offsets( direction, length ):
+	offset = Map.directions[ direction ]
+	return [ ( offset[0] * i, offset[1] * i ) for i in range( length + 1 ) ]
+
+def _trim( cache, size ):
+	"""
+	Drops the least recently used entries of cache, a dict of key to [ last
+	use, value ], once it holds more than size.  A quarter is dropped at a
+	time, so hits only need to update the entry's last use.
+	"""
+	if len( cache ) > size:
+		for key in sorted( cache, key=lambda key: cache[ key ][0] )[ :len( cache ) - size * 3 // 4 ]:
+			del cache[ key ]
+
+_SHAPES = {
+	'spread': _spread_offsets,
+	'cone': _cone_offsets,
+	'slice': _slice_offsets,
+	'line': _line_offsets,
+}
+
+class _Template( object ):
+	"""
+	A shape's offsets from its origin, in axial coordinates, which do not
+	depend on where the shape is placed.  Also holds the offsets as packed
+	deltas and as an array, and the span of array rows and columns covered for
+	even and odd origin columns, so shapes entirely on the map skip the bounds
+	checks and large shapes crossing an edge are checked with numpy.
+	"""
+	VECTORIZE = 64		# Shapes with at least this many cells are bounds checked with numpy
+
+	def __init__( self, offsets ):
+		self.offsets = offsets
+		self.deltas = [ ( dr << 32 ) + dc for dr, dc in offsets ]
+		self.array = numpy.array( offsets, dtype=numpy.int64 ).reshape( -1, 2 )
+		if offsets:
+			self.cols = ( min( dc for dr, dc in offsets ), max( dc for dr, dc in offsets ) )
+			# The array row moves by dr less the change in ceil( col / 2 ), which depends on the parity
+			self.rows = tuple( (
+				min( dr - ( parity + dc + 1 ) // 2 + ( parity + 1 ) // 2 for dr, dc in offsets ),
+				max( dr - ( parity + dc + 1 ) // 2 + ( parity + 1 ) // 2 for dr, dc in offsets ) )
+				for parity in ( 0, 1 ) )
+
+	def __repr__( self ):
+		return "_Template(%d cells)" % len( self.offsets )
+
+	def place( self, origin, rows, cols ):
+		"""Returns the cells of the shape at origin that lie on a rows x cols map."""
+		if not self.offsets:
+			return []
+		packed = isinstance( origin, _INTS )
+		if packed:
+			row, col = ( origin >> 32 ) - _BIAS, ( origin & _MASK ) - _BIAS
+		else:
+			row, col = origin
+		i = row - ( col + 1 ) // 2
+		low, high = self.rows[ col % 2 ]
+		if 0 <= col + self.cols[0] and col + self.cols[1] < cols and 0 <= i + low and i + high < rows:
+			if packed:
+				return [ origin + delta for delta in self.deltas ]
+			return [ ( row + dr, col + dc ) for dr, dc in self.offsets ]
+
+		if len( self.offsets ) < self.VECTORIZE:
+			cells = [ ( row + dr, col + dc ) for dr, dc in self.offsets
+				if 0 <= col + dc < cols and 0 <= row + dr - ( col + dc + 1 ) // 2 < rows ]
+			return [ pack( cell ) for cell in cells ] if packed else cells
+		cells = self.array + ( row, col )
+		r, c = cells[:, 0], cells[:, 1]
+		i = r - ( c + 1 ) // 2
+		inside = ( c >= 0 ) & ( c < cols ) & ( i >= 0 ) & ( i < rows )
+		if packed:
+			return ( ( r[ inside ] + _BIAS ) << 32 | ( c[ inside ] + _BIAS ) ).tolist()
+		return map( tuple, cells[ inside ].tolist() )
+
+
+# Flat index steps to the six neighbors, in the order used by Map.neighbors,
+# for even and odd columns.  Moving across a column shifts the array row
+# depending on the column's parity.
+_STEPS = (
+	( ( -1, 0 ), ( -1, 1 ), ( 0, 1 ), ( 1, 0 ), ( 0, -1 ), ( -1, -1 ) ),
+	( ( -1, 0 ), ( 0, 1 ), ( 1, 1 ), ( 1, 0 ), ( 1, -1 ), ( 0, -1 ) ),
+)
+
+# For each column parity, the array steps from a node to its neighbors, with
+# the Map.directions index of the step from that neighbor back to the node.
+_FLOW_STEPS = tuple(
+	tuple( ( di, dj, Map.directions.index( ( -di + ( parity + 1 ) // 2 - ( parity + dj + 1 ) // 2, -dj ) ) )
+		for di, dj in _STEPS[ parity ] )
+	for parity in ( 0, 1 ) )
+
+class Adjacency( object ):
+	"""
+	The cells of a map size, numbered 0 to N - 1 as in Map.index, and their
+	neighbors as a compressed sparse row table: the neighbors of cell n are
+	targets[ offsets[ n ]:offsets[ n + 1 ] ], in the order of Map.neighbors.
+	It is built once per map size and shared by every Map of that size, so
+	use Adjacency.get or Map.adjacency.  Only the cache_size sizes used last
+	are kept.
+	"""
+
+	cache_size = 4
+	_cache = OrderedDict()
+
+	@classmethod
+	def get( cls, size ):
+		"""Returns the shared Adjacency for a map size."""
+		key = tuple( size )
+		adjacency = cls._cache.pop( key, None )
+		if adjacency is None:
+			adjacency = cls( key )
+			while len( cls._cache ) >= cls.cache_size:
+				cls._cache.popitem( last=False )
+		cls._cache[ key ] = adjacency
+		return adjacency
+
+	def __init__( self, ( rows, cols ) ):
+		self.rows, self.cols = rows, cols
+
+		i, j = numpy.indices( ( rows, cols ) ).reshape( 2, -1 )
+		self.cells = numpy.column_stack( ( i + ( j + 1 ) // 2, j ) )
+		steps = numpy.array( _STEPS )[ j & 1 ]
+		ni, nj = i[:, numpy.newaxis] + steps[..., 0], j[:, numpy.newaxis] + steps[..., 1]
+		valid = ( ni >= 0 ) & ( ni < rows ) & ( nj >= 0 ) & ( nj < cols )
+		self.offsets = numpy.concatenate( ( [ 0 ], numpy.cumsum( valid.sum( axis=1 ) ) ) )
+		self.targets = ( ni * cols + nj )[ valid ].astype( numpy.int32 if rows * cols < 2 ** 31 else numpy.int64 )
+		self._keys = self._lists = self._ordered = None
+
+	def __repr__( self ):
+		return "Adjacency(%d, %d)" % ( self.rows, self.cols )
+
+	def __len__( self ):
+		return self.rows * self.cols
+
+	def degree( self ):
+		"""Returns the number of neighbors of every cell, as an array."""
+		return numpy.diff( self.offsets )
+
+	@property
+	def keys( self ):
+		"""The cells as a list of ( row, col ) tuples, by index, built on first use."""
+		if self._keys is None:
+			self._keys = [ tuple( cell ) for cell in self.cells.tolist() ]
+		return self._keys
+
+	@property
+	def ordered( self ):
+		"""The cells as a list of tuples ordered by row then column, built on first use."""
+		if self._ordered is None:
+			order = numpy.lexsort( ( self.cells[:, 1], self.cells[:, 0] ) )
+			keys = self.keys
+			self._ordered = [ keys[ n ] for n in order.tolist() ]
+		return self._ordered
+
+	@property
+	def lists( self ):
+		"""keys, offsets and targets as Python lists, built on first use, for Map.neighbors."""
+		if self._lists is None:
+			self._lists = ( self.keys, self.offsets.tolist(), self.targets.tolist() )
+		return self._lists
+
+class FlowField( object ):
+	"""
+	The result of Map.flow_field.  distance holds the cheapest cost from each
+	cell to a target, or infinity, and direction the Map.directions index of
+	the first step towards it, or -1 on targets and unreachable cells.  Both
+	are laid out like DenseLayer.array.
+	"""
+
+	def __init__( self, map, distance, direction ):
+		self.map = map
+		self.distance = distance
+		self.direction = direction
+
+	def __repr__( self ):
+		return "FlowField(%s)" % self.map
+
+	def _index( self, cell ):
+		if not self.map.valid_cell( cell ):
+			return None
+		return ( cell[0] - ( cell[1] + 1 ) // 2, cell[1] )
+
+	def cost( self, cell ):
+		"""Returns the cost of reaching the nearest target from cell."""
+		index = self._index( cell )
+		return INFINITY if index is None else self.distance.item( index )
+
+	def heading( self, cell ):
+		"""Returns the Map.directions index to move in from cell, or None."""
+		index = self._index( cell )
+		heading = -1 if index is None else self.direction.item( index )
+		return None if heading < 0 else heading
+
+	def step( self, cell ):
+		"""Returns the next cell on the way to the nearest target, or None."""
+		heading = self.heading( cell )
+		if heading is None:
+			return None
+		offset = self.map.directions[ heading ]
+		return ( cell[0] + offset[0], cell[1] + offset[1] )
+
+	def path( self, cell ):
+		"""Returns the cells from cell to the nearest target, or None if it cannot be reached."""
+		if self.cost( cell ) == INFINITY:
+			return None
+		path = [ cell ]
+		while self.heading( cell ) is not None:
+			cell = self.step( cell )
+			path.append( cell )
+		return path
 
 class Grid( dict ):
-	"""An extension of a basic dictionary with a fast, consistent lookup by value implementation."""
+	"""
+	An extension of a basic dictionary with a fast, consistent lookup by value
+	implementation.  A reverse index from value to key is kept up to date by
+	every method that modifies the dictionary, so find is constant time.
+	Setting dirty to a set makes the grid record every key written to, so
+	renderers can repaint only what changed.
+
+	By default each value is expected to live in a single cell, like a unit.
+	Pass multi=True for layers where many cells share the same value, such as
+	fog states, to index every key holding a value.  Unhashable values, like
+	pygame.Color, are indexed by their tuple form.
+
+	version is incremented by every change, so that results computed from a
+	grid, like flow fields, can tell when they are stale.
+	"""
+
+	dirty = None	# Set to a set() to collect the keys written to
+	version = 0
+	multi = False
 
 	def __init__( self, default=None, *args, **keywords ):
-		super( Grid, self ).__init__( *args, **keywords )
+		self.multi = keywords.pop( 'multi', False )
+		super( Grid, self ).__init__()
 		self.default = default
+		self._reset()
+		self.update( *args, **keywords )
+
+	def _reset( self ):
+		"""(Re)creates the empty reverse index."""
+		self._index = {}		# value -> key, or value -> set of keys if multi
+		self._counts = {}		# value -> number of keys holding it, if not multi
+		self._unindexed = 0		# number of values that could not be indexed
+
+	def __getattr__( self, name ):
+		# Grids pickled before the reverse index existed restore their items
+		# before their __dict__, so the index is created on first use.
+		if name in ( '_index', '_counts', '_unindexed' ):
+			self._reset()
+			return self.__dict__[ name ]
+		raise AttributeError( name )
+
+	def __reduce__( self ):
+		state = dict( ( k, v ) for k, v in self.__dict__.items() if not k.startswith( '_' ) )
+		return ( _restore_grid, ( self.__class__, state ), None, None, self.iteritems() )
+
+	@staticmethod
+	def _index_key( value ):
+		"""Returns the key a value is stored under in the reverse index."""
+		try:
+			hash( value )
+			return value
+		except TypeError:
+			pass
+		try:
+			return tuple( value )
+		except TypeError:
+			return _UNINDEXED
+
+	def _add( self, key, value ):
+		"""Record that key now holds value."""
+		self.version += 1
+		if self.dirty is not None:
+			self.dirty.add( key )
+		index = self._index_key( value )
+		if index is _UNINDEXED:
+			self._unindexed += 1
+		elif self.multi:
+			keys = self._index.get( index )
+			if keys is None:
+				self._index[ index ] = set( ( key, ) )
+			else:
+				keys.add( key )
+		else:
+			# A single key is stored as is, duplicated values keep a set of keys
+			count = self._counts.get( index, 0 )
+			if count == 0:
+				self._index[ index ] = key
+			elif count == 1:
+				self._index[ index ] = set( ( self._index[ index ], key ) )
+			else:
+				self._index[ index ].add( key )
+			self._counts[ index ] = count + 1
+
+	def _remove( self, key, value ):
+		"""Record that key no longer holds value.  Must be called after the dict is updated."""
+		self.version += 1
+		if self.dirty is not None:
+			self.dirty.add( key )
+		index = self._index_key( value )
+		if index is _UNINDEXED:
+			self._unindexed -= 1
+		elif self.multi:
+			keys = self._index[ index ]
+			keys.discard( key )
+			if not keys:
+				del self._index[ index ]
+		else:
+			count = self._counts[ index ] - 1
+			if count == 0:
+				del self._index[ index ]
+				del self._counts[ index ]
+				return
+			keys = self._index[ index ]
+			keys.discard( key )
+			if count == 1:
+				self._index[ index ] = keys.pop()
+			self._counts[ index ] = count
+
+	def _indexed( self, index ):
+		"""Returns the keys the reverse index holds for index."""
+		if self.multi:
+			return self._index.get( index, () )
+		if index not in self._index:
+			return ()
+		return self._index[ index ] if self._counts[ index ] > 1 else ( self._index[ index ], )
 
 	def __getitem__( self, key ):
 		return super( Grid, self ).get( key, self.default )
 
+	def __setitem__( self, key, value ):
+		if key in self:
+			old = dict.__getitem__( self, key )
+			dict.__setitem__( self, key, value )
+			self._remove( key, old )
+		else:
+			dict.__setitem__( self, key, value )
+		self._add( key, value )
+
+	def __delitem__( self, key ):
+		value = dict.__getitem__( self, key )
+		dict.__delitem__( self, key )
+		self._remove( key, value )
+
+	def update( self, *args, **keywords ):
+		if args:
+			other = args[0]
+			if hasattr( other, 'keys' ):
+				for key in other.keys():
+					self[ key ] = other[ key ]
+			else:
+				for key, value in other:
+					self[ key ] = value
+		for key, value in keywords.items():
+			self[ key ] = value
+
+	def pop( self, key, *default ):
+		if key not in self:
+			if default:
+				return default[0]
+			raise KeyError( key )
+		value = dict.pop( self, key )
+		self._remove( key, value )
+		return value
+
+	def popitem( self ):
+		key, value = dict.popitem( self )
+		self._remove( key, value )
+		return ( key, value )
+
+	def setdefault( self, key, default=None ):
+		if key in self:
+			return dict.__getitem__( self, key )
+		self[ key ] = default
+		return default
+
+	def clear( self ):
+		self.version += 1
+		if self.dirty is not None:
+			self.dirty.update( self.iterkeys() )
+		dict.clear( self )
+		self._reset()
+
 	def find( self, item ):
 		"""
-		A fast lookup by value implementation
+		A fast lookup by value implementation.  Returns a key holding item, or
+		None if no key does.
 		"""
-		for pos, value in self.items():
-			if item == value:
-				return pos
+		index = self._index_key( item )
+		if index is not _UNINDEXED:
+			for key in self._indexed( index ):
+				# Unhashable values share their index with their tuple form
+				if dict.__getitem__( self, key ) == item:
+					return key
+		if index is _UNINDEXED or self._unindexed:
+			for pos, value in self.iteritems():
+				if item == value:
+					return pos
 		return None
 
+	def find_all( self, item ):
+		"""Returns a list of every key holding item."""
+		index = self._index_key( item )
+		if index is not _UNINDEXED and not self._unindexed:
+			return [ key for key in self._indexed( index ) if dict.__getitem__( self, key ) == item ]
+		return [ pos for pos, value in self.iteritems() if item == value ]
+
+_UNINDEXED = object()
+
+def _restore_grid( cls, state ):
+	"""Unpickling helper that rebuilds the reverse index of a Grid as items are restored."""
+	grid = cls.__new__( cls )
+	grid.__dict__.update( state )
+	grid._reset()
+	return grid
+
+class DirtyCells( object ):
+	"""
+	Stands in for the dirty set of a layer read by several renderers, passing
+	every cell written on to each reader's own set so that one reader
+	clearing its cells does not hide them from the others.  Sets given when
+	created are kept, sets handed out by subscribe are dropped once their
+	reader is garbage collected.
+	"""
+
+	def __init__( self, *sets ):
+		self.sets = list( sets )
+		self._readers = []		# weak references to the sets handed out by subscribe
+
+	def subscribe( self ):
+		"""Returns a new, empty set that collects the cells written from now on."""
+		cells = set()
+		self._readers.append( weakref.ref( cells ) )
+		return cells
+
+	def _targets( self ):
+		readers = [ reader() for reader in self._readers ]
+		if None in readers:
+			self._readers = [ reader for reader, cells in zip( self._readers, readers ) if cells is not None ]
+			readers = [ cells for cells in readers if cells is not None ]
+		return self.sets + readers
+
+	def add( self, cell ):
+		for cells in self._targets():
+			cells.add( cell )
+
+	def update( self, cells ):
+		targets = self._targets()
+		if len( targets ) > 1:
+			cells = list( cells )
+		for target in targets:
+			target.update( cells )
+
+	def __getstate__( self ):
+		# Readers belong to renderers, which are not pickled with their layers
+		return { 'sets': self.sets }
+
+	def __setstate__( self, state ):
+		self.sets = state[ 'sets' ]
+		self._readers = []
+
+class SpatialGrid( Grid ):
+	"""
+	A Grid of units that also buckets its cells into size x size blocks of
+	rows and columns, so that proximity queries only visit the blocks near
+	the query instead of every unit.  The buckets are kept up to date by the
+	same methods that maintain the reverse index, so moving a unit costs a
+	couple of set operations.  Keys must be (row, col) cells.
+	"""
+
+	def __init__( self, default=None, *args, **keywords ):
+		self.size = keywords.pop( 'size', 8 )
+		super( SpatialGrid, self ).__init__( default, *args, **keywords )
+
+	def _reset( self ):
+		super( SpatialGrid, self )._reset()
+		self._buckets = {}		# ( row // size, col // size ) -> set of keys
+
+	def _bucket( self, ( row, col ) ):
+		return ( row // self.size, col // self.size )
+
+	def _add( self, key, value ):
+		super( SpatialGrid, self )._add( key, value )
+		bucket = self._bucket( key )
+		keys = self._buckets.get( bucket )
+		if keys is None:
+			self._buckets[ bucket ] = set( ( key, ) )
+		else:
+			keys.add( key )
+
+	def _remove( self, key, value ):
+		super( SpatialGrid, self )._remove( key, value )
+		bucket = self._bucket( key )
+		keys = self._buckets[ bucket ]
+		keys.discard( key )
+		if not keys:
+			del self._buckets[ bucket ]
+
+	def units_within( self, center, radius ):
+		"""Returns a list of ( cell, unit ) for the units within radius steps of center."""
+		row, col = center
+		found = []
+		for i in range( ( row - radius ) // self.size, ( row + radius ) // self.size + 1 ):
+			for j in range( ( col - radius ) // self.size, ( col + radius ) // self.size + 1 ):
+				for key in self._buckets.get( ( i, j ), () ):
+					if Map.distance( center, key ) <= radius:
+						found.append( ( key, dict.__getitem__( self, key ) ) )
+		return found
+
+	def nearest( self, center, k=1 ):
+		"""
+		Returns a list of ( cell, unit ) for the k units nearest to center,
+		closest first.  Blocks are searched in growing squares around center
+		until no unsearched unit could be closer than the k found so far.
+		"""
+		row, col = center
+		bi, bj = self._bucket( center )
+		candidates = []
+		searched = 0
+		n = 0
+		while searched < len( self._buckets ):
+			if 8 * n > len( self._buckets ):
+				# Units are sparse around center, so checking every block is cheaper
+				candidates = [ ( Map.distance( center, key ), key ) for key in self.iterkeys() ]
+				break
+			for bucket in _square( bi, bj, n ):
+				keys = self._buckets.get( bucket )
+				if keys:
+					searched += 1
+					candidates.extend( ( Map.distance( center, key ), key ) for key in keys )
+			# Every cell outside the searched square is at least this far away
+			cover = min( row - ( bi - n ) * self.size, ( bi + n + 1 ) * self.size - row,
+				col - ( bj - n ) * self.size, ( bj + n + 1 ) * self.size - col )
+			if len( candidates ) >= k and sorted( candidates )[ k - 1 ][0] <= cover:
+				break
+			n += 1
+		return [ ( key, dict.__getitem__( self, key ) ) for distance, key in sorted( candidates )[ :k ] ]
+
+	def units_in( self, cells ):
+		"""Returns a list of ( cell, unit ) for the cells holding a unit."""
+		buckets = self._buckets
+		return [ ( cell, dict.__getitem__( self, cell ) ) for cell in cells
+			if self._bucket( cell ) in buckets and dict.__contains__( self, cell ) ]
+
+class PackedGrid( Grid ):
+	"""
+	A Grid keyed by packed cells (see pack), which hash and compare faster
+	than tuples and are cheaper to create in neighbor heavy loops.  Tuple
+	cells are packed on the way in, so either form can be used to read and
+	write, but keys() and find return packed cells.
+	"""
+
+	def __getitem__( self, key ):
+		if not isinstance( key, _INTS ):
+			key = pack( key )
+		return dict.get( self, key, self.default )
+
+	def __setitem__( self, key, value ):
+		if not isinstance( key, _INTS ):
+			key = pack( key )
+		super( PackedGrid, self ).__setitem__( key, value )
+
+	def __delitem__( self, key ):
+		if not isinstance( key, _INTS ):
+			key = pack( key )
+		super( PackedGrid, self ).__delitem__( key )
+
+	def __contains__( self, key ):
+		if not isinstance( key, _INTS ):
+			key = pack( key )
+		return dict.__contains__( self, key )
+
+	def get( self, key, default=None ):
+		if not isinstance( key, _INTS ):
+			key = pack( key )
+		return dict.get( self, key, default )
+
+	def pop( self, key, *default ):
+		if not isinstance( key, _INTS ):
+			key = pack( key )
+		return super( PackedGrid, self ).pop( key, *default )
+
+	def setdefault( self, key, default=None ):
+		if not isinstance( key, _INTS ):
+			key = pack( key )
+		return super( PackedGrid, self ).setdefault( key, default )
+
+	def cells( self ):
+		"""Returns the keys as ( row, col ) tuples."""
+		return [ unpack( key ) for key in self.iterkeys() ]
+
+def _square( i, j, n ):
+	"""Yields the buckets on the edge of the square n buckets away from ( i, j )."""
+	if n == 0:
+		yield ( i, j )
+		return
+	for dj in range( -n, n + 1 ):
+		yield ( i - n, j + dj )
+		yield ( i + n, j + dj )
+	for di in range( -n + 1, n ):
+		yield ( i + di, j - n )
+		yield ( i + di, j + n )
+
+class Vision( object ):
+	"""
+	Keeps track of what a group of observers can see, recomputing only the
+	observer that moved.  If given a fog layer, such as the one used by
+	RenderFog, cells coming into view are set to the visible state and cells
+	leaving view to the seen state.  Cells never seen keep the layer default.
+	"""
+
+	def __init__( self, map, radius, opacity=None, fog=None, visible=True, seen=False ):
+		self.map = map
+		self.radius = radius
+		self.opacity = opacity
+		self.fog = fog
+		self.VISIBLE = visible
+		self.SEEN = seen
+		self.observers = {}	# key -> ( cell, cells visible to it )
+		self.counts = {}	# cell -> number of observers seeing it
+
+	@property
+	def visible( self ):
+		"""The set of cells currently visible to any observer."""
+		return set( self.counts )
+
+	def update( self, key, cell ):
+		"""Adds an observer identified by key, or moves it to cell."""
+		old = self.observers.get( key, ( None, set() ) )[1]
+		new = self.map.visible( cell, self.radius, self.opacity )
+		self.observers[ key ] = ( cell, new )
+		self._change( old - new, new - old )
+
+	def remove( self, key ):
+		"""Removes an observer; the cells only it could see become seen."""
+		cell, old = self.observers.pop( key )
+		self._change( old, () )
+
+	def refresh( self ):
+		"""Recomputes every observer, e.g. after the opacity layer changes."""
+		for key, ( cell, old ) in self.observers.items():
+			self.update( key, cell )
+
+	def _change( self, hidden, revealed ):
+		counts = self.counts
+		for cell in hidden:
+			count = counts[ cell ] - 1
+			if count:
+				counts[ cell ] = count
+			else:
+				del counts[ cell ]
+				if self.fog is not None:
+					self.fog[ cell ] = self.SEEN
+		for cell in revealed:
+			count = counts.get( cell, 0 )
+			counts[ cell ] = count + 1
+			if not count and self.fog is not None:
+				self.fog[ cell ] = self.VISIBLE
+
 class MapUnit( object ):
 	"""
 	An abstract base class that will contain or require implementation of all 
@@ -244,6 +1492,12 @@ class MapUnit( object ):
 
 	__metaclass__ = ABCMeta
 
+	# A hashable description of how the unit looks, e.g. its team and facing.
+	# Units with a cache_key are painted once per key into RenderUnits' sprite
+	# atlas and blitted from there; None paints the unit every frame, for
+	# units that animate.  Override it with a property to follow the unit's state.
+	cache_key = None
+
 	def __init__( self, grid ):
 		self.grid = grid
 
@@ -258,7 +1512,7 @@ class MapUnit( object ):
 		pass
 
 if __name__ == '__main__':
-
+	import argparse
 
 
 	# Setup arguments for testing this code
@@ -284,7 +1538,11 @@ if __name__ == '__main__':
 			stdscr.keypad( 1 )
 
 			while True:
-				stdscr.addstr( 1, 0, m.ascii( numbers=numbers ) )
+				# Only draw the part of the map that fits on the screen
+				height, width = stdscr.getmaxyx()
+				window = ( ( 0, max( ( height - 4 ) // 2, 0 ) ), ( 0, max( ( width - 2 ) // ( m._ascii_width( numbers ) + 1 ), 0 ) ) )
+				for y, line in enumerate( m.iter_ascii( numbers, *window ) ):
+					stdscr.addstr( 1 + y, 0, line )
 				c = stdscr.getstr()
 				stdscr.clear()
 				if c == 'q': break
@@ -1,24 +1,216 @@
 from abc import ABCMeta, abstractmethod
+from collections import deque
+import numpy
 import pygame
 import math
-from hexmap.map import Grid
+import threading
+from hexmap.map import Grid, Vision, DirtyCells
+
+import logging
+logger = logging.getLogger( __name__ )
 
 SQRT3 = math.sqrt( 3 )
 
+class Geometry( object ):
+	"""
+	The pixel geometry of every cell of a map size at a given radius: the
+	polygon vertices, the bounding rect used by Render.get_surface, and the
+	center of each cell.  It is computed once per ( size, radius ) and shared
+	by every Render drawing at that size and radius, so use Geometry.get.
+
+	Cells are stored in the order of DenseLayer.array.ravel(), and index
+	converts a cell to its position in the tables.
+	"""
+
+	_cache = {}
+
+	@classmethod
+	def get( cls, size, radius ):
+		"""Returns the shared Geometry for a map size and radius."""
+		key = ( tuple( size ), radius )
+		geometry = cls._cache.get( key )
+		if geometry is None:
+			geometry = cls._cache[ key ] = cls( size, radius )
+		return geometry
+
+	def __init__( self, ( rows, cols ), radius ):
+		self.rows, self.cols = rows, cols
+		self.radius = radius
+
+		i, j = numpy.indices( ( rows, cols ) ).reshape( 2, -1 )
+		self.cells = numpy.column_stack( ( i + ( j + 1 ) // 2, j ) )
+		self.polygons, self.rects, self.centers = _layout( i, j, radius )
+		self._points = self._keys = self._lookup = self._boxes = None
+
+	def index( self, cell ):
+		"""Returns the position of a valid cell in the tables."""
+		return ( cell[0] - ( cell[1] + 1 ) // 2 ) * self.cols + cell[1]
+
+	@property
+	def points( self ):
+		"""The polygons as nested lists, built on first use, ready to hand to pygame.draw."""
+		if self._points is None:
+			self._points = self.polygons.tolist()
+		return self._points
+
+	@property
+	def keys( self ):
+		"""The cells as a list of ( row, col ) tuples, built on first use."""
+		if self._keys is None:
+			self._keys = [ tuple( cell ) for cell in self.cells.tolist() ]
+		return self._keys
+
+	@property
+	def boxes( self ):
+		"""The bounding rects as [ left, top, width, height ] lists, built on first use."""
+		if self._boxes is None:
+			self._boxes = self.rects.tolist()
+		return self._boxes
+
+	def polygon( self, cell ):
+		"""Returns the point list of a cell's outline."""
+		return self.points[ self.index( cell ) ]
+
+	def rect( self, cell ):
+		"""Returns the bounding pygame.Rect of a cell."""
+		return pygame.Rect( self.rects[ self.index( cell ) ].tolist() )
+
+	def center( self, cell ):
+		"""Returns the pixel center of a cell."""
+		return tuple( self.centers[ self.index( cell ) ].tolist() )
+
+	def pick( self, points ):
+		"""
+		Vectorized pixel to cell conversion, following the same float math as
+		Render.get_cell.  Takes an (N,2) array of pixel positions and returns
+		an (N,2) integer array of cells, along with a boolean array marking
+		the cells that are on the map.
+		"""
+		return _pick( points, self.radius, ( self.rows, self.cols ) )
+
+	@property
+	def lookup( self ):
+		"""
+		A table, built on first use, of the cell index under every whole pixel
+		of a Render surface, or -1 where there is no cell.  Indexed [y, x].
+		"""
+		if self._lookup is None:
+			width = int( self.cols * self.radius * 1.5 + self.radius / 2.0 )
+			height = int( ( self.rows + .5 ) * self.radius * SQRT3 + 1 )
+			y, x = numpy.indices( ( height, width ) )
+			cells, valid = self.pick( numpy.column_stack( ( x.ravel(), y.ravel() ) ) )
+			index = ( cells[:, 0] - ( cells[:, 1] + 1 ) // 2 ) * self.cols + cells[:, 1]
+			self._lookup = numpy.where( valid, index, -1 ).astype( numpy.int32 ).reshape( height, width )
+		return self._lookup
+
+def _layout( i, j, radius, offset=( 0, 0 ) ):
+	"""
+	Lays out the cells at array indices i, j (see DenseLayer) at a radius,
+	shifted left and up by a pixel offset.  Returns arrays of their polygon
+	vertices, bounding rects and centers.
+	"""
+	height = SQRT3 * radius
+	left = 1.5 * radius * j - offset[0]
+	top = height * i + ( j % 2 ) * height / 2 - offset[1]
+
+	shape = numpy.array( [ ( .5 * radius, 0 ),
+		( 1.5 * radius, 0 ),
+		( 2 * radius, height / 2 ),
+		( 1.5 * radius, height ),
+		( .5 * radius, height ),
+		( 0, height / 2 ) ] )
+	polygons = shape[ numpy.newaxis ] + numpy.column_stack( ( left, top ) )[ :, numpy.newaxis ]
+	rects = numpy.column_stack( ( left, top,
+		numpy.repeat( 2 * radius, len( left ) ), numpy.repeat( height, len( left ) ) ) ).astype( numpy.int32 )
+	centers = numpy.column_stack( ( left + radius, top + height / 2 ) )
+	return polygons, rects, centers
+
+def _pick( points, radius, ( rows, cols ) ):
+	"""
+	Vectorized pixel to cell conversion at a radius, following the same float
+	math as Render.get_cell.  Returns an (N,2) integer array of cells and a
+	boolean array marking those on a map of the given size.
+	"""
+	points = numpy.asarray( points, dtype=float ).reshape( -1, 2 )
+	x, y = points[:, 0], points[:, 1]
+
+	# Identify the square grid each point is in.
+	row = numpy.floor( y / ( SQRT3 * radius ) )
+	col = numpy.floor( x / ( 1.5 * radius ) )
+	x = x - col * 1.5 * radius
+	y = y - row * SQRT3 * radius
+	row = row + numpy.floor( ( col + 1 ) / 2.0 )
+
+	# Correct row and col for boundaries of a hex grid
+	half = SQRT3 * radius / 2
+	even = col % 2 == 0
+	left = x < .5 * radius
+	up_left = even & ( y < half ) & left & ( y < half - x )
+	down_left = even & ~up_left & ( y > half ) & left & ( y > half + x )
+	odd_left = ~even & left & ( abs( y - half ) < half - x )
+	odd_up = ~even & ~odd_left & ( y < half )
+	row = ( row - ( up_left | odd_left | odd_up ) ).astype( numpy.intp )
+	col = ( col - ( up_left | down_left | odd_left ) ).astype( numpy.intp )
+
+	top = ( col + 1 ) // 2
+	valid = ( col >= 0 ) & ( col < cols ) & ( row >= top ) & ( row < top + rows )
+	return numpy.column_stack( ( row, col ) ), valid
+
+class Camera( object ):
+	"""
+	A window onto a map.  Render layers given a camera allocate surfaces the
+	size of the window instead of the whole map, and only draw the cells in
+	view.  offset is the pixel position of the window's top left corner on
+	the zoomed map, and zoom scales the radius of every layer.  Share one
+	camera between layers so they pan and zoom together.
+	"""
+
+	def __init__( self, size, offset=( 0, 0 ), zoom=1.0 ):
+		self.size = tuple( size )
+		self.offset = tuple( offset )
+		self.zoom = zoom
+
+	def __repr__( self ):
+		return "Camera(%s, offset=%s, zoom=%s)" % ( self.size, self.offset, self.zoom )
+
+	@property
+	def state( self ):
+		"""Everything that affects what is drawn, for layers to compare between frames."""
+		return ( self.size, self.offset, self.zoom )
+
+	def pan( self, dx, dy ):
+		"""Moves the window by a number of screen pixels."""
+		self.offset = ( self.offset[0] + dx, self.offset[1] + dy )
+
+	def zoom_to( self, zoom, anchor=None ):
+		"""
+		Changes the zoom, keeping the map under anchor, a screen position that
+		defaults to the middle of the window, in place.
+		"""
+		if anchor is None:
+			anchor = ( self.size[0] / 2.0, self.size[1] / 2.0 )
+		scale = float( zoom ) / self.zoom
+		self.offset = tuple( ( anchor[k] + self.offset[k] ) * scale - anchor[k] for k in ( 0, 1 ) )
+		self.zoom = zoom
+
 class Render( pygame.Surface ):
 
 	__metaclass__ = ABCMeta
 
+	cells_drawn = 0		# Cells painted by the last call to draw, for hexmap.instrument
 
 
 	def __init__( self, map, radius=24, *args, **keywords ):
 		self.map = map
 		self.radius = radius
+		self.camera = keywords.pop( 'camera', None )
+		self.lookup = None
 
 		# Colors for the map
 		self.GRID_COLOR = pygame.Color( 50, 50, 50 )
 
-		super( Render, self ).__init__( ( self.width, self.height ), *args, **keywords )
+		size = self.camera.size if self.camera else ( self.width, self.height )
+		super( Render, self ).__init__( size, *args, **keywords )
 
 		self.cell = [( .5 * self.radius, 0 ),
 					( 1.5 * self.radius, 0 ),
@@ -30,6 +222,67 @@ class Render( pygame.Surface ):
 
 
 
+	@property
+	def geometry( self ):
+		"""The cell geometry shared by every Render of this map size and radius."""
+		return Geometry.get( self.map.size, self.radius )
+
+	@property
+	def scale( self ):
+		"""The radius cells are drawn at, including the camera's zoom."""
+		return self.radius * self.camera.zoom if self.camera else self.radius
+
+	def view( self ):
+		"""
+		Returns the cells drawn on this surface and their outlines, in surface
+		coordinates.  Without a camera this is every cell, from the shared
+		Geometry.  With one, only the cells in the camera's window are laid
+		out, so the cost does not depend on the size of the map.
+		"""
+		if self.camera is None:
+			return self.geometry.keys, self.geometry.points
+
+		radius, height = self.scale, SQRT3 * self.scale
+		( left, top ), ( width, bottom ) = self.camera.offset, self.camera.size
+		first = max( int( math.floor( ( left - 2 * radius ) / ( 1.5 * radius ) ) ), 0 )
+		last = min( int( math.ceil( ( left + width ) / ( 1.5 * radius ) ) ), self.map.cols - 1 )
+
+		i, j = [], []
+		for parity in ( 0, 1 ):
+			cols = numpy.arange( first + ( first + parity ) % 2, last + 1, 2 )
+			shift = top - parity * height / 2
+			rows = numpy.arange( max( int( math.floor( shift / height ) ), 0 ),
+				min( int( math.ceil( ( shift + bottom ) / height ) ), self.map.rows ) )
+			i.append( numpy.repeat( rows, len( cols ) ) )
+			j.append( numpy.tile( cols, len( rows ) ) )
+		i, j = numpy.concatenate( i ), numpy.concatenate( j )
+
+		polygons = _layout( i, j, radius, self.camera.offset )[0]
+		cells = zip( ( i + ( j + 1 ) // 2 ).tolist(), j.tolist() )
+		return cells, polygons.tolist()
+
+	def polygon( self, cell ):
+		"""Returns the outline of a cell in surface coordinates."""
+		if self.camera is None:
+			return self.geometry.polygon( cell )
+		left, top = self._position( cell )
+		zoom = self.camera.zoom
+		return [ ( x * zoom + left, y * zoom + top ) for ( x, y ) in self.cell ]
+
+	def cell_rect( self, cell ):
+		"""Returns the bounding rect of a cell in surface coordinates."""
+		if self.camera is None:
+			return self.geometry.rect( cell )
+		left, top = self._position( cell )
+		return pygame.Rect( left, top, 2 * self.scale, SQRT3 * self.scale )
+
+	def _position( self, ( row, col ) ):
+		"""The top left corner of a cell's bounding box, in camera coordinates."""
+		height = SQRT3 * self.scale
+		left = 1.5 * self.scale * col - self.camera.offset[0]
+		top = ( row - ( col + 1 ) // 2 ) * height + ( col % 2 ) * height / 2 - self.camera.offset[1]
+		return left, top
+
 	@property
 	def width( self ):
 		return	self.map.cols * self.radius * 1.5 + self.radius / 2.0
@@ -37,17 +290,15 @@ class Render( pygame.Surface ):
 	def height( self ):
 		return ( self.map.rows + .5 ) * self.radius * SQRT3 + 1
 
-	def get_surface( self, ( row, col ) ):
+	def get_surface( self, cell ):
 		"""
 		Returns a subsurface corresponding to the surface, hopefully with trim_cell wrapped around the blit method.
+		With a camera, returns None for cells that are not entirely in view.
 		"""
-		width = 2 * self.radius
-		height = self.radius * SQRT3
-
-		top = ( row - math.ceil( col / 2.0 ) ) * height + ( height / 2 if col % 2 == 1 else 0 )
-		left = 1.5 * self.radius * col
-
-		return self.subsurface( pygame.Rect( left, top, width, height ) )
+		rect = self.cell_rect( cell )
+		if self.camera is not None and not self.get_rect().contains( rect ):
+			return None
+		return self.subsurface( rect )
 
 	# Draw methods
 	@abstractmethod
@@ -70,6 +321,17 @@ class Render( pygame.Surface ):
 		"""
 		Identify the cell clicked in terms of row and column
 		"""
+		if self.camera is not None:
+			cells, valid = self.get_cells( ( x, y ) )
+			return tuple( cells[0].tolist() ) if valid[0] else None
+		if self.lookup is not None and isinstance( x, int ) and isinstance( y, int ) and x >= 0 and y >= 0:
+			try:
+				index = self.lookup.item( y, x )
+			except IndexError:
+				pass
+			else:
+				return self._lookup_keys[ index ] if index >= 0 else None
+
 		# Identify the square grid the click is in.
 		row = math.floor( y / ( SQRT3 * self.radius ) )
 		col = math.floor( x / ( 1.5 * self.radius ) )
@@ -98,15 +360,120 @@ class Render( pygame.Surface ):
 
 		return ( row, col ) if self.map.valid_cell( ( row, col ) ) else None
 
+	def get_cells( self, points ):
+		"""
+		Identify the cells under many points at once.  Takes an (N,2) array of
+		pixel positions and returns an (N,2) integer array of cells, along with
+		a boolean array that is False where get_cell would return None.
+		"""
+		points = numpy.asarray( points ).reshape( -1, 2 )
+		if self.camera is not None:
+			return _pick( points + self.camera.offset, self.scale, self.map.size )
+		if self.lookup is None:
+			return self.geometry.pick( points )
+
+		# Whole pixels on the surface come from the lookup table, the rest are computed
+		height, width = self.lookup.shape
+		x, y = points[:, 0], points[:, 1]
+		table = ( x == numpy.floor( x ) ) & ( y == numpy.floor( y ) ) & \
+			( x >= 0 ) & ( x < width ) & ( y >= 0 ) & ( y < height )
+		index = self.lookup[ y[ table ].astype( numpy.intp ), x[ table ].astype( numpy.intp ) ]
+		cells = numpy.zeros( ( len( points ), 2 ), dtype=numpy.intp )
+		valid = numpy.zeros( len( points ), dtype=bool )
+		cells[ table ] = self.geometry.cells[ index ]
+		valid[ table ] = index >= 0
+		if not table.all():
+			cells[ ~table ], valid[ ~table ] = self.geometry.pick( points[ ~table ] )
+		return cells, valid
+
+	def build_lookup( self ):
+		"""
+		Switches get_cell and get_cells to a per pixel lookup table, shared by
+		every Render of this map size and radius.  Picking a whole pixel then
+		costs a single array index.  Only available without a camera.
+		"""
+		if self.camera is not None:
+			raise ValueError( "Lookup tables cover the whole map surface, %s has a camera." % self )
+		self.lookup = self.geometry.lookup
+		self._lookup_keys = self.geometry.keys
+
 	def fit_window( self, window ):
 	   top = max( window.get_height() - self.height, 0 )
 	   left = max( window.get_width() - map.width, 0 )
 	   return ( top, left )
 
+class SpriteAtlas( object ):
+	"""
+	A surface holding painted units, one slot of a fixed size per key, so a
+	unit that looks the same every frame is only painted once.  Slots are
+	filled with the colorkey before painting, which the atlas uses as its
+	own, so blitting a sprite leaves the same pixels as painting the unit in
+	place.  Atlases are shared by every RenderUnits drawing cells of the same
+	size, so use SpriteAtlas.get.
+	"""
+
+	_cache = {}
+	COLUMNS = 16
+
+	@classmethod
+	def get( cls, size, colorkey ):
+		"""Returns the shared SpriteAtlas for a slot size and colorkey."""
+		key = ( tuple( size ), tuple( colorkey ) )
+		atlas = cls._cache.get( key )
+		if atlas is None:
+			atlas = cls._cache[ key ] = cls( *key )
+		return atlas
+
+	def __init__( self, size, colorkey ):
+		self.size = tuple( size )
+		self.colorkey = pygame.Color( *colorkey )
+		self.slots = {}
+		self.surface = None
+
+	def __repr__( self ):
+		return "SpriteAtlas(%s, %d sprites)" % ( self.size, len( self.slots ) )
+
+	def sprite( self, key, paint ):
+		"""
+		Returns the rect of key's sprite on self.surface, calling paint with a
+		blank slot to draw it the first time.
+		"""
+		area = self.slots.get( key )
+		if area is None:
+			area = self.slots[ key ] = self._allocate()
+			slot = self.surface.subsurface( area )
+			slot.fill( self.colorkey )
+			paint( slot )
+		return area
+
+	def clear( self ):
+		"""Forgets every sprite, e.g. after units change how they paint a key."""
+		self.slots = {}
+		self.surface = None
+
+	def _allocate( self ):
+		"""Returns the rect of the next free slot, growing the surface by a row of slots when full."""
+		n = len( self.slots )
+		width, height = self.size
+		row, col = divmod( n, self.COLUMNS )
+		if self.surface is None or ( row + 1 ) * height > self.surface.get_height():
+			# Double the rows.  Sprites already handed out stay valid on the old surface.
+			rows = 2 * self.surface.get_height() // height if self.surface is not None else 1
+			surface = pygame.Surface( ( width * self.COLUMNS, height * rows ) )
+			surface.fill( self.colorkey )
+			surface.set_colorkey( self.colorkey )
+			if self.surface is not None:
+				surface.blit( self.surface, ( 0, 0 ) )
+			self.surface = surface
+		return pygame.Rect( col * width, row * height, width, height )
+
 class RenderUnits( Render ):
 	"""
 	A premade render object that will automatically draw the Units from the map 
-	
+
+	Units with a cache_key are painted once into a shared SpriteAtlas and
+	composed with batched blits; the others are painted every frame.  The
+	order units are drawn in is kept either way.
 	"""
 
 	def __init__( self, map, *args, **keywords ):
@@ -114,38 +481,190 @@ class RenderUnits( Render ):
 		if not hasattr( self.map, 'units' ):
 			self.map.units = Grid()
 
+	def atlas( self, size ):
+		"""Returns the SpriteAtlas for cells of size drawn by this layer."""
+		return SpriteAtlas.get( size, self.get_colorkey() )
+
 	def draw( self ):
 		"""
 		Calls unit.paint for all units on self.map
 		"""
 		super( RenderUnits, self ).draw()
 		units = self.map.units
+		area = self.get_rect()
+		# Without a camera every cell is on the surface, and its rect is in the shared Geometry
+		boxes, cols = ( None, None ) if self.camera is not None else ( self.geometry.boxes, self.map.cols )
+		atlas = None
+		batch = []
 
+		drawn = 0
 		for position, unit in units.items():
+			key = unit.cache_key
+			if key is not None:
+				if boxes is not None:
+					rect = boxes[ ( position[0] - ( position[1] + 1 ) // 2 ) * cols + position[1] ]
+				else:
+					rect = self.cell_rect( position )
+					if not area.colliderect( rect ):
+						continue
+				if atlas is None:
+					# Every cell's rect is the same size
+					atlas = self.atlas( ( rect[2], rect[3] ) )
+				sprite = atlas.sprite( ( type( unit ), key ), unit.paint )
+				batch.append( ( atlas.surface, rect, sprite ) )
+				drawn += 1
+				continue
+
+			# Keep the drawing order: compose the sprites so far before painting live
+			if batch:
+				_blits( self, batch )
+				batch = []
 			surface = self.get_surface( position )
-			unit.paint( surface )
+			if surface is None:
+				drawn += self._paint_clipped( position, unit )
+			else:
+				unit.paint( surface )
+				drawn += 1
+		if batch:
+			_blits( self, batch )
+		self.cells_drawn = drawn
+
+	def _paint_clipped( self, position, unit ):
+		"""
+		Paints a unit partly outside the camera's window through a scratch
+		surface.  Returns whether any of it was in view.
+		"""
+		rect = self.cell_rect( position )
+		if not self.get_rect().colliderect( rect ):
+			return False
+		scratch = pygame.Surface( rect.size )
+		scratch.fill( pygame.Color( 'magenta' ) )
+		scratch.set_colorkey( pygame.Color( 'magenta' ) )
+		unit.paint( scratch )
+		self.blit( scratch, rect )
+		return True
 
 class RenderGrid( Render ):
+	"""
+	Draws the outline of every cell on the map.  The grid only depends on the
+	radius, the map size and GRID_COLOR, so it is drawn once and kept on this
+	surface until one of those changes, or invalidate is called.
+
+	With outline=True, the edges shared by neighboring cells are collected so
+	that each one is drawn a single time, instead of once per cell.  pygame
+	rasterizes some slopes differently depending on the direction a line is
+	drawn in, so for those the reverse stroke of the neighbor is kept too,
+	and the result is identical to drawing every polygon.
+
+	With a camera, only the cells in view are drawn, and moving the camera
+	redraws the grid.
+	"""
+
+	def __init__( self, map, *args, **keywords ):
+		self.outline = keywords.pop( 'outline', False )
+		super( RenderGrid, self ).__init__( map, *args, **keywords )
+		self._drawn = None
+
+	def invalidate( self ):
+		"""Forces the grid to be redrawn on the next call to draw."""
+		self._drawn = None
+
 	def draw( self ):
 		"""
 		Draws a hex grid, based on the map object, onto this Surface
 		"""
+		key = ( self.radius, self.map.size, tuple( self.GRID_COLOR ), self.outline,
+			self.camera and self.camera.state )
+		if key == self._drawn:
+			self.cells_drawn = 0
+			return
 		super( RenderGrid, self ).draw()
-		# A point list describing a single cell, based on the radius of each hex
-
-		for col in range( self.map.cols ):
-			# Alternate the offset of the cells based on column
-			offset = self.radius * SQRT3 / 2 if col % 2 else 0
-			for row in range( self.map.rows ):
-				# Calculate the offset of the cell
-				top = offset + SQRT3 * row * self.radius
-				left = 1.5 * col * self.radius
-				# Create a point list containing the offset cell
-				points = [( x + left, y + top ) for ( x, y ) in self.cell]
+
+		polygons = self.polygons()
+		if self.outline:
+			for start, end in self.strokes( self.geometry.polygons if self.camera is None else polygons ):
+				pygame.draw.line( self, self.GRID_COLOR, start, end, 1 )
+		else:
+			for points in polygons:
 				# Draw the polygon onto the surface
 				pygame.draw.polygon( self, self.GRID_COLOR, points, 1 )
+		self.cells_drawn = len( polygons )
+		self._drawn = key
+
+	def polygons( self ):
+		"""Returns the point list of each cell's outline, offset to its position."""
+		return self.view()[1]
+
+	# ( dx, dy ) -> whether a line of that extent covers the same pixels in either direction
+	_symmetric = {}
+
+	def strokes( self, polygons=None ):
+		"""
+		Returns the lines, as point pairs, that draw the same pixels as the
+		outline of every polygon, drawing each shared edge once unless its
+		two directions rasterize differently.
+		"""
+		if polygons is None:
+			polygons = self.geometry.polygons if self.camera is None else self.polygons()
+		if not len( polygons ):
+			return []
+		polygons = numpy.asarray( polygons, dtype=float )
+		starts = polygons.reshape( -1, 2 )
+		ends = numpy.roll( polygons, -1, axis=1 ).reshape( -1, 2 )
+
+		# pygame truncates the points of lines and polygons alike, so number
+		# the distinct truncated points and key each edge by its two points
+		a, b = starts.astype( numpy.int64 ), ends.astype( numpy.int64 )
+		low = min( a.min(), b.min() )
+		span = max( a.max(), b.max() ) - low + 1
+		points, number = numpy.unique( numpy.concatenate( ( a, b ) ).dot( [ span, 1 ] ) - low * ( span + 1 ), return_inverse=True )
+		pa, pb = number[ :len( a ) ], number[ len( a ): ]
+		directed = pa * len( points ) + pb
+		kept = numpy.sort( numpy.unique( directed, return_index=True )[1] )
+
+		# The reverse of an edge already kept may be dropped if it draws the same pixels
+		undirected = numpy.minimum( pa, pb )[ kept ] * len( points ) + numpy.maximum( pa, pb )[ kept ]
+		reverse = numpy.ones( len( kept ), dtype=bool )
+		reverse[ numpy.unique( undirected, return_index=True )[1] ] = False
+		# Lines crossing the surface's edge are clipped first, which depends on their direction
+		width, height = self.get_size()
+		lo, hi = numpy.minimum( a[ kept ], b[ kept ] ), numpy.maximum( a[ kept ], b[ kept ] )
+		inside = ( lo >= 0 ).all( axis=1 ) & ( hi[:, 0] < width ) & ( hi[:, 1] < height )
+		deltas = b[ kept ] - a[ kept ]
+		candidates = reverse & inside
+		symmetric = numpy.zeros( len( kept ), dtype=bool )
+		for dx, dy in set( map( tuple, deltas[ candidates ].tolist() ) ):
+			if self._is_symmetric( dx, dy ):
+				symmetric |= candidates & ( deltas[:, 0] == dx ) & ( deltas[:, 1] == dy )
+
+		kept = kept[ ~symmetric ]
+		return zip( starts[ kept ].tolist(), ends[ kept ].tolist() )
+
+	@classmethod
+	def _is_symmetric( cls, dx, dy ):
+		"""Whether pygame draws the same pixels from ( 0, 0 ) to ( dx, dy ) as back."""
+		symmetric = cls._symmetric.get( ( dx, dy ) )
+		if symmetric is None:
+			surface = pygame.Surface( ( abs( dx ) + 1, abs( dy ) + 1 ) )
+			start = ( max( -dx, 0 ), max( -dy, 0 ) )
+			end = ( start[0] + dx, start[1] + dy )
+			pixels = []
+			for line in ( ( start, end ), ( end, start ) ):
+				surface.fill( ( 0, 0, 0 ) )
+				pygame.draw.line( surface, ( 255, 255, 255 ), line[0], line[1], 1 )
+				pixels.append( pygame.image.tostring( surface, 'RGB' ) )
+			symmetric = cls._symmetric[ ( dx, dy ) ] = pixels[0] == pixels[1]
+			cls._symmetric[ ( -dx, -dy ) ] = symmetric
+		return symmetric
 
 class RenderFog( Render ):
+	"""
+	Draws map.fog, a layer holding one of OBSCURED, SEEN or VISIBLE for each
+	cell.  Writes to the fog are recorded in a dirty set of this layer's own,
+	see DirtyCells, so after the first call draw only repaints the cells that
+	changed, however many RenderFogs share the map.  With a camera, only the
+	cells in view are painted, and moving the camera repaints them all.
+	"""
 
 	OBSCURED = pygame.Color( 00, 00, 00, 255 )
 	SEEN	 = pygame.Color( 00, 00, 00, 100 )
@@ -155,32 +674,215 @@ class RenderFog( Render ):
 
 		super( RenderFog, self ).__init__( map, *args, flags=pygame.SRCALPHA, **keywords )
 		if not hasattr( self.map, 'fog' ):
-			self.map.fog = Grid( default=self.OBSCURED )
-
-	def draw( self ):
-
-		#Some constants for the math		
-		height = self.radius * SQRT3
-		width = 1.5 * self.radius
-		offset = height / 2
+			self.map.fog = Grid( default=self.OBSCURED, multi=True )
+		self._dirty = None
+		self.invalidate()
 
-		self.fill( self.OBSCURED )
-
-		for cell in self.map.cells():
-			row, col = cell
-			surface = self.get_cell( cell )
+	def vision( self, radius, opacity=None ):
+		"""
+		Returns a Vision that writes the VISIBLE and SEEN states into this
+		layer's fog as its observers move.
+		"""
+		return Vision( self.map, radius, opacity, fog=self.map.fog, visible=self.VISIBLE, seen=self.SEEN )
 
-			# Calculate the position of the cell
-			top = row * height - offset * col
-			left = width * col
+	def invalidate( self ):
+		"""Forces every cell to be repainted on the next call to draw."""
+		self._painted = None
 
-			#Determine the points that corresponds with
-			points = [( x + left, y + top ) for ( x, y ) in self.cell]
-			# Draw the polygon onto the surface
-			pygame.draw.polygon( self, self.map.fog[ cell ], points, 0 )
+	def _subscribe( self, fog ):
+		"""Returns this layer's set of the cells written to fog, and whether it was just created."""
+		if self._dirty is None or self._dirty[0] is not fog or self._dirty[1] is not fog.dirty:
+			if not isinstance( fog.dirty, DirtyCells ):
+				fog.dirty = DirtyCells() if fog.dirty is None else DirtyCells( fog.dirty )
+			self._dirty = ( fog, fog.dirty, fog.dirty.subscribe() )
+			return self._dirty[2], True
+		return self._dirty[2], False
 
+	def draw( self ):
+		"""
+		Paints the fog and returns the list of rects that changed, which can be
+		passed on to pygame.display.update.  The whole surface is painted the
+		first time, after invalidate or replacing map.fog, or when the camera
+		has moved.
+		"""
+		fog = self.map.fog
+		dirty, subscribed = self._subscribe( fog )
+
+		painted = ( fog, self.camera and self.camera.state )
+		if subscribed or self._painted is None or self._painted[0] is not fog or self._painted[1] != painted[1]:
+			dirty.clear()
+			self.fill( self.OBSCURED )
+			cells, polygons = self.view()
+			for cell, points in zip( cells, polygons ):
+				pygame.draw.polygon( self, fog[ cell ], points, 0 )
+			self.cells_drawn = len( cells )
+			self._painted = painted
+			return [ self.get_rect() ]
+
+		area = self.get_rect()
+		clip = self.get_clip()
+		rects = []
+		painted = 0
+		for cell in dirty:
+			if not self.map.valid_cell( cell ):
+				continue
+			rect = self.cell_rect( cell ).inflate( 4, 4 ).clip( area )
+			if not rect.width or not rect.height:
+				continue
+			# Neighbors share the pixels of their edges, which keep the color of
+			# whichever cell the full paint drew last, so every cell touching the
+			# changed area is repainted in the same order, clipped to that area
+			self.set_clip( rect )
+			cells = [ other for other in self.map.spread( cell, 2 )
+				if rect.colliderect( self.cell_rect( other ).inflate( 4, 4 ) ) ]
+			for other in sorted( cells, key=self._order ):
+				self.paint( other )
+			painted += len( cells )
+			rects.append( rect )
+		self.set_clip( clip )
+		dirty.clear()
+		self.cells_drawn = painted
+		return rects
+
+	def _order( self, ( row, col ) ):
+		"""Sorts cells in the order the full paint draws them, see view."""
+		i = row - ( col + 1 ) // 2
+		return ( col % 2, i, col ) if self.camera else ( i, col )
+
+	def paint( self, cell ):
+		"""Paints the fog of a single cell, returning the rect it covered."""
+		return pygame.draw.polygon( self, self.map.fog[ cell ], self.polygon( cell ), 0 )
+
+
+
+
+class Compositor( object ):
+	"""
+	Draws Render layers on a worker thread and composites them, in order,
+	into a back buffer, which is swapped with the front buffer once the frame
+	is complete.  The main thread calls request to ask for a frame and
+	present to blit the newest finished frame to the window, neither of which
+	waits on the layers drawing, so events keep being handled.
+
+	Layers are drawn while the main thread runs, so changes to the map, the
+	layers or the camera should be passed to update, which calls them on the
+	worker at the start of the next frame.  compose draws a frame on the
+	calling thread instead, e.g. without start.
+	"""
 
+	def __init__( self, layers, size=None, background=pygame.Color( 'white' ) ):
+		self.layers = list( layers )
+		self.background = background
+		size = size or self.layers[0].get_size()
+		self.buffers = [ pygame.Surface( size ), pygame.Surface( size ) ]		# front, back
+		self.frames = 0
+		self.error = None
+		self._presented = 0
+		self._updates = deque()
+		self._swap = threading.Condition()
+		self._wake = threading.Event()
+		self._thread = None
+
+	def __repr__( self ):
+		return "Compositor(%d layers, %d frames)" % ( len( self.layers ), self.frames )
+
+	def __enter__( self ):
+		self.start()
+		return self
+
+	def __exit__( self, *error ):
+		self.stop()
 
+	@property
+	def front( self ):
+		"""The last finished frame."""
+		return self.buffers[0]
+
+	def start( self ):
+		"""Starts the worker thread."""
+		if self._thread is None:
+			self._thread = threading.Thread( target=self._run, name='hexmap-compositor' )
+			self._thread.daemon = True
+			self._thread.start()
+
+	def stop( self ):
+		"""Stops the worker thread once it finishes the frame it is drawing."""
+		thread, self._thread = self._thread, None
+		if thread is not None:
+			self._wake.set()
+			thread.join()
+
+	def update( self, function, *args, **keywords ):
+		"""Calls function( *args, **keywords ) on the worker before drawing the next frame."""
+		self._updates.append( ( function, args, keywords ) )
+
+	def request( self ):
+		"""Asks the worker for a new frame, without waiting for it."""
+		self._wake.set()
+
+	def compose( self ):
+		"""Applies the pending updates, draws every layer and swaps in the new frame."""
+		while self._updates:
+			function, args, keywords = self._updates.popleft()
+			function( *args, **keywords )
+		back = self.buffers[1]
+		for layer in self.layers:
+			layer.draw()
+		back.fill( self.background )
+		for layer in self.layers:
+			back.blit( layer, ( 0, 0 ) )
+		with self._swap:
+			self.buffers.reverse()
+			self.frames += 1
+			self._swap.notify_all()
+
+	def wait( self, timeout=None ):
+		"""Waits up to timeout seconds for a frame not yet presented, returning whether there is one."""
+		with self._swap:
+			if self.frames == self._presented and self.error is None:
+				self._swap.wait( timeout )
+			self._raise()
+			return self.frames != self._presented
+
+	def present( self, surface, position=( 0, 0 ) ):
+		"""
+		Blits the newest finished frame onto surface, unless it was already
+		presented, and returns whether it did.
+		"""
+		with self._swap:
+			self._raise()
+			if self.frames == self._presented:
+				return False
+			surface.blit( self.buffers[0], position )
+			self._presented = self.frames
+		return True
+
+	def _run( self ):
+		while self._thread is not None:
+			self._wake.wait()
+			self._wake.clear()
+			if self._thread is None:
+				break
+			try:
+				self.compose()
+			except Exception as error:
+				logger.exception( "Compositing a frame failed" )
+				with self._swap:
+					self.error = error
+					self._swap.notify_all()
+				break
+
+	def _raise( self ):
+		if self.error is not None:
+			raise RuntimeError( "The compositor thread failed: %r" % self.error )
+
+def _blits( surface, batch ):
+	"""Blits a list of ( source, dest, area ) in one call, where pygame supports it."""
+	if hasattr( surface, 'blits' ):
+		surface.blits( batch, 0 )
+	else:
+		for source, dest, area in batch:
+			surface.blit( source, dest, area )
 
 def trim_cell( surface ):
 	pass
@@ -188,60 +890,72 @@ def trim_cell( surface ):
 
 if __name__ == '__main__':
 	from .map import Map, MapUnit
+	from .instrument import Profiler
 	import sys
 
 	class Unit( MapUnit ):
 		color = pygame.Color( 200, 200, 200 )
+		cache_key = 'unit'
 		def paint( self, surface ):
 			radius = surface.get_width() / 2
 			pygame.draw.circle( surface, self.color, ( radius, int( SQRT3 / 2 * radius ) ), int( radius - radius * .3 ) )
 
 	m = Map( ( 5, 5 ) )
 
-	grid = RenderGrid( m, radius=32 )
-	units = RenderUnits( m, radius=32 )
-	fog = RenderFog( m, radius=32 )
+	camera = Camera( ( 640, 480 ) )
+	grid = RenderGrid( m, radius=32, camera=camera )
+	units = RenderUnits( m, radius=32, camera=camera )
+	fog = RenderFog( m, radius=32, camera=camera )
 
 	m.units[( 0, 0 ) ] = Unit( m )
 	m.units[( 3, 2 ) ] = Unit( m )
 	m.units[( 5, 3 ) ] = Unit( m )
 	m.units[( 5, 4 ) ] = Unit( m )
 
-	for cell in m.spread( ( 3, 2 ), radius=2 ):
-		m.fog[cell] = fog.SEEN
+	walls = Grid( default=False )
+	walls[( 4, 3 ) ] = True
 
-	for cell in m.spread( ( 3, 2 ) ):
-		m.fog[cell] = fog.VISIBLE
+	vision = fog.vision( radius=2, opacity=walls )
+	vision.update( 'explorer', ( 1, 2 ) )
+	vision.update( 'explorer', ( 3, 2 ) )
 
 	print( m.ascii() )
 
+	# Layers are drawn on the compositor's thread, the loop only handles events and shows finished frames
+	compositor = Compositor( [ grid, units, fog ] )
 
 	try:
 		pygame.init()
 		fpsClock = pygame.time.Clock()
 
 		window = pygame.display.set_mode( ( 640, 480 ), 1 )
-		from pygame.locals import QUIT, MOUSEBUTTONDOWN
+		from pygame.locals import QUIT, MOUSEBUTTONDOWN, KEYDOWN, K_LEFT, K_RIGHT, K_UP, K_DOWN, K_p
+		steps = { K_LEFT: ( -16, 0 ), K_RIGHT: ( 16, 0 ), K_UP: ( 0, -16 ), K_DOWN: ( 0, 16 ) }
+		# Press p to show the time spent in each layer
+		profiler = Profiler()
+		compositor.start()
 
 		#Leave it running until exit
 		while True:
 			for event in pygame.event.get():
 				if event.type == QUIT:
-					pygame.quit()
 					sys.exit()
 				if event.type == MOUSEBUTTONDOWN:
 					print( units.get_cell( event.pos ) )
-
-			window.fill( pygame.Color( 'white' ) )
-			grid.draw()
-			units.draw()
-			fog.draw()
-			window.blit( grid, ( 0, 0 ) )
-			window.blit( units, ( 0, 0 ) )
-			window.blit( fog, ( 0, 0 ) )
-			pygame.display.update()
-			fpsClock.tick( 10 )
+				if event.type == KEYDOWN and event.key in steps:
+					compositor.update( camera.pan, *steps[ event.key ] )
+				if event.type == KEYDOWN and event.key == K_p:
+					compositor.update( profiler.disable if profiler.enabled else profiler.enable )
+
+			compositor.request()
+			if compositor.present( window ):
+				if profiler.enabled:
+					profiler.frame()
+					profiler.overlay( window )
+				pygame.display.update()
+			fpsClock.tick( 30 )
 	finally:
+		compositor.stop()
 		pygame.quit()
 
 
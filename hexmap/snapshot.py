@@ -0,0 +1,285 @@
+"""
+A versioned binary snapshot format for a Map and its layers.
+
+A snapshot starts with an 8 byte magic string, the format version and the
+length of a JSON header, all little endian.  The header describes the map
+and each layer, and gives the offset of every array stored after it.
+Arrays are written raw and aligned, so loading maps the file and wraps the
+arrays with numpy.frombuffer instead of reading or copying them:
+
+- DenseLayers are stored as their array.
+- Grids are stored as two columns sorted by cell: the packed cells (see
+  hexmap.map.pack) and the values, or codes into a table of the distinct
+  values when those are not numbers.
+
+Anything that is not an array, like the layer defaults, palettes and value
+tables, is pickled into a small blob next to the arrays.  References from
+those objects to the map or to a saved layer, like MapUnit.grid, are
+restored to point at the loaded map and layers.
+
+Loaded layers are read only views of the file, so several processes loading
+the same snapshot share its pages.  Call to_grid, or copy the array, to get
+a writable layer back.
+"""
+from cStringIO import StringIO
+import json
+import mmap
+import numbers
+import pickle
+import struct
+
+import numpy
+
+from hexmap.map import Map, Grid, PackedGrid, pack, unpack, _INTS, _UNINDEXED, _restore_grid
+from hexmap.layer import DenseLayer
+
+import logging
+logger = logging.getLogger( __name__ )
+
+MAGIC = 'HEXSNAP\0'
+VERSION = 1
+ALIGN = 64
+_PREFIX = struct.Struct( '<8sII' )		# magic, version, header length
+_MAP = '.map'							# Pickle reference to the map, never an attribute name
+
+
+class SnapshotError( ValueError ):
+	pass
+
+
+def save( map, path, layers=None ):
+	"""
+	Writes map and its layers to path.  layers is a list of attribute names;
+	by default every Grid and DenseLayer attribute of map is written.
+	"""
+	if layers is None:
+		layers = sorted( name for name, value in vars( map ).items()
+			if not name.startswith( '_' ) and isinstance( value, ( Grid, DenseLayer ) ) )
+
+	blobs = []
+	header = { 'map': { 'rows': map.rows, 'cols': map.cols }, 'layers': {} }
+	references = dict( ( id( getattr( map, name ) ), name ) for name in layers )
+	references[ id( map ) ] = _MAP
+	for name in layers:
+		layer = getattr( map, name )
+		if isinstance( layer, DenseLayer ):
+			entry = { 'kind': 'dense', 'array': _array( blobs, layer.array ),
+				'table': _pickle( blobs, ( layer.default, layer.palette ), references ) }
+		elif isinstance( layer, Grid ):
+			entry = _sparse( blobs, layer, references )
+		else:
+			raise TypeError( "Cannot snapshot %s of type %s" % ( name, type( layer ).__name__ ) )
+		header[ 'layers' ][ name ] = entry
+
+	# Offsets are relative to the end of the aligned header
+	encoded = json.dumps( header, sort_keys=True )
+	start = _aligned( _PREFIX.size + len( encoded ) )
+	with open( path, 'wb' ) as output:
+		output.write( _PREFIX.pack( MAGIC, VERSION, len( encoded ) ) )
+		output.write( encoded )
+		output.write( '\0' * ( start - _PREFIX.size - len( encoded ) ) )
+		for blob in blobs:
+			output.write( blob )
+			output.write( '\0' * ( _aligned( len( blob ) ) - len( blob ) ) )
+
+def load( path, cls=Map ):
+	"""
+	Maps the snapshot at path and returns a cls with its layers attached as
+	attributes.  DenseLayers come back as read only DenseLayers and Grids as
+	SparseLayers, both viewing the mapped file.
+	"""
+	with open( path, 'rb' ) as source:
+		buffer = mmap.mmap( source.fileno(), 0, access=mmap.ACCESS_READ )
+	if len( buffer ) < _PREFIX.size:
+		raise SnapshotError( "%s is not a hexmap snapshot" % path )
+	magic, version, length = _PREFIX.unpack_from( buffer, 0 )
+	if magic != MAGIC:
+		raise SnapshotError( "%s is not a hexmap snapshot" % path )
+	if version != VERSION:
+		raise SnapshotError( "%s is a version %d snapshot, expected %d" % ( path, version, VERSION ) )
+	header = json.loads( buffer[ _PREFIX.size:_PREFIX.size + length ] )
+	start = _aligned( _PREFIX.size + length )
+
+	def array( entry ):
+		dtype = numpy.dtype( str( entry[ 'dtype' ] ) )
+		if not entry[ 'count' ]:
+			return numpy.zeros( entry[ 'shape' ], dtype=dtype )
+		return numpy.frombuffer( buffer, dtype=dtype,
+			count=entry[ 'count' ], offset=start + entry[ 'offset' ] ).reshape( entry[ 'shape' ] )
+
+	# Create every layer before unpickling the tables, which may refer to any of them
+	map = cls( ( header[ 'map' ][ 'rows' ], header[ 'map' ][ 'cols' ] ) )
+	layers = {}
+	for name, entry in header[ 'layers' ].items():
+		if entry[ 'kind' ] == 'dense':
+			layer = DenseLayer.__new__( DenseLayer )
+			layer.map = map
+			layer.array = array( entry[ 'array' ] )
+			layer.dirty = None
+		else:
+			layer = SparseLayer( map, array( entry[ 'keys' ] ), array( entry[ 'values' ] ) )
+		layers[ str( name ) ] = layer
+
+	def reference( name ):
+		return map if name == _MAP else layers[ name ]
+	for name, entry in header[ 'layers' ].items():
+		layer = layers[ str( name ) ]
+		blob = entry[ 'table' ]
+		unpickler = pickle.Unpickler( StringIO( buffer[ start + blob[ 'offset' ]:start + blob[ 'offset' ] + blob[ 'nbytes' ] ] ) )
+		unpickler.persistent_load = reference
+		if entry[ 'kind' ] == 'dense':
+			layer.default, layer.palette = unpickler.load()
+		else:
+			layer.grid, layer.state, layer.table = unpickler.load()
+			layer.default = layer.state.get( 'default' )
+		setattr( map, str( name ), layer )
+	return map
+
+class SparseLayer( object ):
+	"""
+	A read only Grid loaded from a snapshot.  Cells are found by a binary
+	search of the sorted packed keys, so nothing is unpacked into Python
+	objects until it is asked for.  Values that are not numbers are stored as
+	codes into table.
+	"""
+
+	def __init__( self, map, keys, values, table=None, grid=Grid, state=None ):
+		self.map = map
+		self.keys_array = keys
+		self.values_array = values
+		self.table = table
+		self.grid = grid
+		self.state = state or {}
+		self.default = self.state.get( 'default' )
+
+	def __repr__( self ):
+		return "SparseLayer(%s, %d cells)" % ( self.map, len( self ) )
+
+	def _position( self, cell ):
+		key = cell if isinstance( cell, _INTS ) else pack( cell )
+		position = numpy.searchsorted( self.keys_array, key )
+		if position < len( self.keys_array ) and self.keys_array[ position ] == key:
+			return position
+		return None
+
+	def _value( self, position ):
+		value = self.values_array.item( position )
+		return value if self.table is None else self.table[ value ]
+
+	def __getitem__( self, cell ):
+		return self.get( cell, self.default )
+
+	def get( self, cell, default=None ):
+		position = self._position( cell )
+		return default if position is None else self._value( position )
+
+	def __contains__( self, cell ):
+		return self._position( cell ) is not None
+
+	def __len__( self ):
+		return len( self.keys_array )
+
+	def __iter__( self ):
+		return iter( self.keys() )
+
+	def keys( self ):
+		return [ unpack( key ) for key in self.keys_array.tolist() ]
+
+	def values( self ):
+		codes = self.values_array.tolist()
+		return codes if self.table is None else [ self.table[ code ] for code in codes ]
+
+	def items( self ):
+		return zip( self.keys(), self.values() )
+
+	def find_all( self, item ):
+		"""Returns a list of every cell holding item."""
+		if self.table is None:
+			matches = self.values_array == item
+		else:
+			codes = [ code for code, value in enumerate( self.table ) if value == item ]
+			matches = numpy.in1d( self.values_array, codes )
+		return [ unpack( key ) for key in self.keys_array[ matches ].tolist() ]
+
+	def find( self, item ):
+		"""Returns a cell holding item, or None if no cell does."""
+		cells = self.find_all( item )
+		return cells[0] if cells else None
+
+	def to_grid( self ):
+		"""Returns a writable copy of the layer as the kind of Grid it was saved from."""
+		grid = _restore_grid( self.grid, dict( self.state ) )
+		packed = issubclass( self.grid, PackedGrid )
+		for key, value in zip( self.keys_array.tolist(), self.values() ):
+			grid[ key if packed else unpack( key ) ] = value
+		return grid
+
+def _sparse( blobs, grid, references ):
+	"""Returns the header entry of a Grid, adding its columns to blobs."""
+	try:
+		keys = numpy.array( [ key if isinstance( key, _INTS ) else pack( key ) for key in grid.iterkeys() ],
+			dtype=numpy.int64 )
+	except ( TypeError, ValueError ):
+		raise TypeError( "Only Grids keyed by cells can be snapshot" )
+	order = numpy.argsort( keys, kind='mergesort' )
+	values = grid.values()
+	table = None
+	if all( isinstance( value, numbers.Number ) for value in values ):
+		column = numpy.array( values )
+		if not values or column.dtype == object:
+			column = numpy.array( values, dtype=float )
+		elif column.dtype.kind in 'iu':
+			# Store integers in the smallest type holding them
+			column = column.astype( numpy.promote_types(
+				numpy.min_scalar_type( column.min() ), numpy.min_scalar_type( column.max() ) ) )
+	else:
+		table, codes = [], {}
+		column = numpy.empty( len( values ), dtype=numpy.int32 )
+		for n, value in enumerate( values ):
+			code = _code( table, codes, value )
+			column[ n ] = code
+	state = dict( ( k, v ) for k, v in vars( grid ).items() if not k.startswith( '_' ) and k != 'dirty' )
+	return {
+		'kind': 'sparse',
+		'keys': _array( blobs, keys[ order ] ),
+		'values': _array( blobs, column[ order ] ),
+		'table': _pickle( blobs, ( type( grid ), state, table ), references ),
+	}
+
+def _code( table, codes, value ):
+	"""Returns the index of value in table, adding it if needed."""
+	index = Grid._index_key( value )
+	if index is _UNINDEXED:
+		for code, entry in enumerate( table ):
+			if entry == value:
+				return code
+	elif index in codes:
+		return codes[ index ]
+	table.append( value )
+	if index is not _UNINDEXED:
+		codes[ index ] = len( table ) - 1
+	return len( table ) - 1
+
+def _array( blobs, array ):
+	array = numpy.ascontiguousarray( array )
+	entry = { 'offset': _offset( blobs ), 'dtype': array.dtype.str, 'shape': list( array.shape ),
+		'count': int( array.size ) }
+	blobs.append( array.tostring() )
+	return entry
+
+def _pickle( blobs, value, references ):
+	"""Pickles value into blobs, replacing the map and saved layers by references."""
+	output = StringIO()
+	pickler = pickle.Pickler( output, pickle.HIGHEST_PROTOCOL )
+	pickler.persistent_id = lambda obj: references.get( id( obj ) )
+	pickler.dump( value )
+	blob = output.getvalue()
+	entry = { 'offset': _offset( blobs ), 'nbytes': len( blob ) }
+	blobs.append( blob )
+	return entry
+
+def _offset( blobs ):
+	return sum( _aligned( len( blob ) ) for blob in blobs )
+
+def _aligned( size ):
+	return -( -size // ALIGN ) * ALIGN
@@ -25,5 +25,5 @@ setup(
 		"Topic :: Games/Entertainment :: Turn Based Strategy"
         ],
     long_description=read( 'README.rst' ).read(),
-    install_requires=[ 'pygame']
+    install_requires=[ 'pygame', 'numpy' ]
  )
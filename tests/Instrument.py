@@ -0,0 +1,113 @@
+from cStringIO import StringIO
+import json
+import threading
+import unittest
+
+import pygame
+
+from hexmap.map import Map, MapUnit
+from hexmap.render import RenderGrid, RenderUnits, RenderFog
+from hexmap.instrument import Profiler, RingBuffer, JsonLines
+
+class Unit( MapUnit ):
+	def paint( self, surface ):
+		surface.fill( pygame.Color( 200, 200, 200 ) )
+
+class ThreadedUnit( Unit ):
+	def paint( self, surface ):
+		# Draws from another thread while RenderUnits.draw is timed on this one
+		thread = threading.Thread( target=pygame.draw.polygon,
+			args=( pygame.Surface( ( 8, 8 ) ), ( 255, 0, 0 ), [ ( 0, 0 ), ( 7, 0 ), ( 0, 7 ) ] ) )
+		thread.start()
+		thread.join()
+		Unit.paint( self, surface )
+
+class TestProfiler( unittest.TestCase ):
+	def setUp( self ):
+		self.map = Map( ( 5, 5 ) )
+		self.grid = RenderGrid( self.map, radius=8 )
+		self.units = RenderUnits( self.map, radius=8 )
+		self.fog = RenderFog( self.map, radius=8 )
+		self.map.units[ ( 1, 1 ) ] = Unit( self.map.units )
+		self.map.units[ ( 3, 2 ) ] = Unit( self.map.units )
+
+	def tick( self ):
+		self.grid.draw()
+		self.units.draw()
+		self.fog.draw()
+		self.map.spread( ( 2, 2 ), 1 )
+		list( self.map.ring( ( 2, 2 ), 1 ) )
+
+	def test_frames( self ):
+		buffer, output = RingBuffer( 2 ), StringIO()
+		with Profiler( buffer, JsonLines( output ) ) as profiler:
+			for n in range( 3 ):
+				self.tick()
+				profiler.frame()
+
+		self.assertEqual( len( buffer ), 2, "Ring buffer kept %d frames." % len( buffer ) )
+		first, second = [ json.loads( line ) for line in output.getvalue().splitlines() ][ :2 ]
+		calls = first[ 'calls' ]
+		self.assertEqual( calls[ 'RenderGrid.draw' ][ 'cells' ], 25 )
+		self.assertEqual( calls[ 'RenderGrid.draw' ][ 'polygons' ], 25 )
+		self.assertEqual( calls[ 'RenderUnits.draw' ][ 'cells' ], 2 )
+		self.assertEqual( calls[ 'RenderFog.draw' ][ 'cells' ], 25 )
+		self.assertEqual( calls[ 'Map.spread' ][ 'calls' ], 1 )
+		self.assertEqual( calls[ 'Map.ring' ][ 'calls' ], 1 )
+		self.assertTrue( calls[ 'Map.ring' ][ 'seconds' ] > 0, "Consuming a generator was not timed." )
+		# The grid is cached and the fog unchanged after the first frame
+		self.assertEqual( second[ 'calls' ][ 'RenderGrid.draw' ][ 'cells' ], 0 )
+		self.assertEqual( second[ 'calls' ][ 'RenderFog.draw' ][ 'cells' ], 0 )
+
+	def test_disabled( self ):
+		originals = ( Map.__dict__[ 'spread' ], Map.__dict__[ 'distance' ], RenderGrid.__dict__[ 'draw' ], pygame.draw.polygon )
+		profiler = Profiler()
+		profiler.enable()
+		self.assertRaises( ValueError, Profiler().enable )
+		self.assertEqual( Map.distance( ( 0, 0 ), ( 2, 2 ) ), 2 )
+		profiler.disable()
+		self.assertEqual( profiler.frame()[ 'calls' ][ 'Map.distance' ][ 'calls' ], 1 )
+		self.assertEqual( ( Map.__dict__[ 'spread' ], Map.__dict__[ 'distance' ], RenderGrid.__dict__[ 'draw' ], pygame.draw.polygon ),
+			originals, "Disabling the profiler did not restore the original methods." )
+
+		self.tick()
+		self.assertEqual( profiler.frame()[ 'calls' ], {}, "Calls were recorded while disabled." )
+
+	def test_generator_frames( self ):
+		with Profiler() as profiler:
+			ring = self.map.ring( ( 2, 2 ), 1 )
+			next( ring )
+			self.assertNotIn( 'Map.ring', profiler.frame()[ 'calls' ], "Unfinished generator was credited to its first frame." )
+			list( ring )
+			calls = profiler.frame()[ 'calls' ]
+		self.assertEqual( calls[ 'Map.ring' ][ 'calls' ], 1, "Finished generator was not credited to the later frame." )
+
+	def test_threads( self ):
+		self.map.units[ ( 0, 4 ) ] = ThreadedUnit( self.map.units )
+		with Profiler() as profiler:
+			self.units.draw()
+			calls = profiler.frame()[ 'calls' ]
+		self.assertNotIn( 'polygons', calls[ 'RenderUnits.draw' ],
+			"A polygon drawn by another thread was counted against RenderUnits.draw." )
+
+	def test_overlay( self ):
+		surface = pygame.Surface( ( 320, 200 ) )
+		with Profiler() as profiler:
+			self.tick()
+			profiler.frame()
+			rect = profiler.overlay( surface )
+		self.assertTrue( rect.height > 0 and surface.get_rect().contains( rect ) )
+
+def load_tests( loader, tests, pattern ):
+	tests = [ TestProfiler ]
+
+	suite = unittest.TestSuite()
+	for test_class in tests:
+		tests = loader.loadTestsFromTestCase( test_class )
+		suite.addTests( tests )
+	return suite
+
+if __name__ == '__main__':
+	loader = unittest.TestLoader()
+	tests = load_tests( loader, None, None )
+	unittest.TextTestRunner( verbosity=2 ).run( tests )
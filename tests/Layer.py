@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from hexmap.map import Map, Grid
+from hexmap.layer import DenseLayer, ChunkedLayer
+
+class TestDenseLayer( unittest.TestCase ):
+	def setUp( self ):
+		self.map = Map( ( 5, 5 ) )
+		self.layer = DenseLayer( self.map, default=1, dtype=numpy.int32 )
+
+	def test_default( self ):
+		for cell in self.map.cells():
+			self.assertEqual( self.layer[ cell ], 1,
+				"Cell %s returned %s instead of the default." % ( cell, self.layer[ cell ] ) )
+		self.assertEqual( self.layer[ ( -1, 0 ) ], 1, "Off map cell did not return the default." )
+
+	def test_assignment( self ):
+		for cell in self.map.cells():
+			self.layer[ cell ] = cell[0] * 10 + cell[1]
+		for cell in self.map.cells():
+			self.assertEqual( self.layer[ cell ], cell[0] * 10 + cell[1],
+				"Cell %s returned %s" % ( cell, self.layer[ cell ] ) )
+		self.assertRaises( KeyError, self.layer.__setitem__, ( 0, 1 ), 5 )
+
+	def test_fill( self ):
+		cells = self.map.spread( ( 3, 2 ), 1 )
+		self.layer.fill( 7, cells + [ ( -1, -1 ) ] )
+		self.assertEqual( sorted( map( tuple, self.layer.where( 7 ).tolist() ) ), sorted( cells ),
+			"Filled cells %s do not match %s" % ( self.layer.where( 7 ), cells ) )
+
+	def test_apply( self ):
+		self.layer.fill( 3, [ ( 0, 0 ), ( 1, 1 ) ] )
+		self.layer.apply( self.layer.mask( 3 ), 4 )
+		self.assertEqual( self.layer.find( 3 ), None, "Mask was not applied." )
+		self.assertEqual( len( self.layer.where( 4 ) ), 2, "Mask was applied to the wrong cells." )
+
+	def test_palette( self ):
+		layer = DenseLayer( self.map, default="OBSCURED", palette=[ "SEEN", "VISIBLE" ] )
+		layer[ ( 3, 2 ) ] = "VISIBLE"
+		self.assertEqual( layer[ ( 3, 2 ) ], "VISIBLE", "Palette value was not stored." )
+		self.assertEqual( layer[ ( 0, 0 ) ], "OBSCURED", "Palette default was not returned." )
+		self.assertEqual( layer.find( "VISIBLE" ), ( 3, 2 ), "Find returned %s" % ( layer.find( "VISIBLE" ), ) )
+		self.assertEqual( layer.array.dtype, numpy.uint8, "Palette layer did not use compact codes." )
+
+		palette = list( layer.palette )
+		for n in range( 300 ):
+			self.assertEqual( layer.find( "MISSING %d" % n ), None, "Find returned a cell for a missing value." )
+		self.assertFalse( layer.mask( "MISSING" ).any(), "Mask selected cells for a missing value." )
+		self.assertEqual( len( layer.where( "MISSING" ) ), 0, "Where returned cells for a missing value." )
+		self.assertEqual( layer.palette, palette, "Queries added %s to the palette." % layer.palette[ len( palette ): ] )
+
+	def test_none( self ):
+		self.assertRaises( ValueError, DenseLayer, self.map, default=None )
+		with self.assertRaises( ValueError ):
+			self.layer[ ( 3, 2 ) ] = None
+		layer = DenseLayer( self.map, default=None, palette=[ "SEEN" ] )
+		self.assertEqual( layer[ ( 3, 2 ) ], None, "Palette layer did not store None." )
+
+	def test_dirty( self ):
+		self.layer.dirty = set()
+		self.layer[ ( 0, 0 ) ] = 2
+		self.layer.fill( 3, [ ( 1, 1 ), ( 1, 2 ) ] )
+		self.assertEqual( self.layer.dirty, set( [ ( 0, 0 ), ( 1, 1 ), ( 1, 2 ) ] ),
+			"Dirty cells %s do not match the cells written." % self.layer.dirty )
+
+class TestChunkedLayer( unittest.TestCase ):
+	def setUp( self ):
+		self.map = Map( ( 10, 10 ) )
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown( self ):
+		shutil.rmtree( self.directory )
+
+	def test_lazy( self ):
+		layer = ChunkedLayer( self.map, size=4, default=1 )
+		self.assertEqual( layer[ ( 5, 3 ) ], 1, "Unwritten cell did not return the default." )
+		self.assertEqual( list( layer.chunks() ), [], "Reading allocated a chunk." )
+
+		layer[ ( 5, 3 ) ] = 7
+		self.assertEqual( layer[ ( 5, 3 ) ], 7, "Written value was not stored." )
+		self.assertEqual( layer[ ( 6, 3 ) ], 1, "Neighbor in the same chunk lost the default." )
+		self.assertEqual( list( layer.chunks() ), [ self.map.chunk_of( ( 5, 3 ), 4 ) ] )
+		self.assertRaises( KeyError, layer.__setitem__, ( 0, 1 ), 5 )
+
+	def test_limit( self ):
+		layer = ChunkedLayer( self.map, size=4, default=0, dtype=numpy.int32, limit=2 )
+		for cell in self.map.cells():
+			layer[ cell ] = cell[0] * 100 + cell[1]
+		self.assertTrue( len( layer.resident ) <= 2, "%d chunks held in memory." % len( layer.resident ) )
+		for cell in self.map.cells():
+			self.assertEqual( layer[ cell ], cell[0] * 100 + cell[1],
+				"Cell %s returned %s after being paged out." % ( cell, layer[ cell ] ) )
+
+	def test_reopen( self ):
+		path = os.path.join( self.directory, 'layer.npy' )
+		layer = ChunkedLayer( self.map, size=4, default=2, dtype=numpy.int16, path=path, limit=1 )
+		cells = list( self.map.spread( ( 5, 5 ), 2 ) )
+		layer.fill( 9, cells )
+		layer.flush()
+
+		reopened = ChunkedLayer( self.map, size=4, default=2, dtype=numpy.int16, path=path, limit=1 )
+		self.assertEqual( sorted( cell for cell, value in reopened.items() if value == 9 ), sorted( cells ),
+			"Reopened layer lost the filled cells." )
+		self.assertEqual( reopened[ ( 0, 0 ) ], 2, "Reopened layer lost the default." )
+		self.assertRaises( ValueError, ChunkedLayer, self.map, size=5, dtype=numpy.int16, path=path )
+
+	def test_reopen_unflushed( self ):
+		path = os.path.join( self.directory, 'layer.npy' )
+		ChunkedLayer( self.map, size=4, default=2, dtype=numpy.int16, path=path )
+		reopened = ChunkedLayer( self.map, size=4, default=2, dtype=numpy.int16, path=path )
+		self.assertEqual( list( reopened.chunks() ), [], "Unflushed layer reopened with allocated chunks." )
+		self.assertEqual( reopened[ ( 5, 5 ) ], 2, "Unflushed layer lost the default." )
+
+	def test_cost( self ):
+		layer = ChunkedLayer( self.map, size=4, default=1 )
+		layer.fill( 3, self.map.spread( ( 5, 5 ), 1 ) )
+		grid = Grid( default=1 )
+		for cell in self.map.spread( ( 5, 5 ), 1 ):
+			grid[ cell ] = 3
+		self.assertEqual( self.map.find_path( ( 0, 0 ), ( 9, 9 ), cost=layer ),
+			self.map.find_path( ( 0, 0 ), ( 9, 9 ), cost=grid ), "Chunked cost layer found a different path." )
+
+class TestChunks( unittest.TestCase ):
+	def test_chunk_cells( self ):
+		m = Map( ( 7, 5 ) )
+		cells = [ cell for key in m.chunks( 3 ) for cell in m.chunk_cells( key, 3 ) ]
+		self.assertEqual( sorted( cells ), sorted( m.cells() ), "Chunks do not cover the map exactly." )
+		self.assertEqual( list( m.iter_cells( 3 ) ), cells, "iter_cells did not go chunk by chunk." )
+
+	def test_by_chunk( self ):
+		m = Map( ( 7, 5 ) )
+		groups = m.by_chunk( m.range( ( 3, 2 ), 2 ), 3 )
+		for key, cells in groups.items():
+			for cell in cells:
+				self.assertEqual( m.chunk_of( cell, 3 ), key, "Cell %s grouped into chunk %s" % ( cell, key ) )
+		self.assertEqual( sum( len( cells ) for cells in groups.values() ), len( list( m.range( ( 3, 2 ), 2 ) ) ) )
+
+def load_tests( loader, tests, pattern ):
+	tests = [ TestDenseLayer, TestChunkedLayer, TestChunks ]
+
+	suite = unittest.TestSuite()
+	for test_class in tests:
+		tests = loader.loadTestsFromTestCase( test_class )
+		suite.addTests( tests )
+	return suite
+
+if __name__ == '__main__':
+	loader = unittest.TestLoader()
+	tests = load_tests( loader, None, None )
+	unittest.TextTestRunner( verbosity=2 ).run( tests )
@@ -1,6 +1,12 @@
+from cStringIO import StringIO
+import copy_reg
+import os
+import pickle
+import subprocess
+import sys
 import unittest
 
-from hexmap.Map import Map, Grid, MapUnit
+from hexmap.Map import Map, Adjacency, Grid, SpatialGrid, PackedGrid, MapUnit, Vision, pack, unpack, pack_cells, unpack_cells
 
 class TestMap( unittest.TestCase ):
 	def setUp( self ):
@@ -27,6 +33,8 @@ class TestMap( unittest.TestCase ):
 			( ( 5, 3 ), ( 9, 5 ), 4 ),
 			( ( 9, 5 ), ( 5, 3 ), 4 ),
 			( ( 7, 4 ), ( 3, 2 ), 4 ),
+			( ( 0, 0 ), ( 1, -1 ), 2 ),
+			( ( 4, 1 ), ( 2, 3 ), 4 ),
 		]
 
 		m = Map( ( rows, cols ) )
@@ -75,6 +83,41 @@ class TestMap( unittest.TestCase ):
 				"Direction between %s, %s, expected to be in %s, got %s"
 				% ( start, end, directions, d ) )
 
+	def test_distances( self ):
+		m = Map( ( 8, 8 ) )
+		cells = m.cells()
+		starts = [ cells[0] ] * len( cells )
+		distances = m.distances( starts, cells )
+		expected = [ m.distance( cells[0], cell ) for cell in cells ]
+		self.assertEqual( distances.tolist(), expected,
+			"Distances %s did not match %s" % ( distances, expected ) )
+
+		matrix = m.distances( cells, cells, pairwise=True )
+		self.assertEqual( matrix.shape, ( len( cells ), len( cells ) ),
+			"Pairwise distances returned shape %s" % ( matrix.shape, ) )
+		self.assertEqual( matrix[ 5 ].tolist(), [ m.distance( cells[5], cell ) for cell in cells ],
+			"Pairwise distances did not match the scalar distances." )
+
+	def test_directions_between( self ):
+		m = Map( ( 8, 8 ) )
+		origins = [ ( 0, 0 ), ( 0, 0 ), ( 8, 5 ), ( 0, 0 ), ( 5, 4 ), ( 4, 4 ) ]
+		destinations = [ ( 1, 0 ), ( 3, 1 ), ( 5, 3 ), ( 2, 1 ), ( 6, 3 ), ( 4, 4 ) ]
+		expected = [ [ ( 1, 0 ) ], [ ( 1, 0 ) ], [ ( -1, -1 ) ], [ ( 1, 0 ), ( 1, 1 ) ],
+			[ ( 1, 0 ), ( 0, -1 ) ], [ ( 0, 0 ) ] ]
+
+		directions = m.directions_between( origins, destinations, rng=1 )
+		for origin, destination, direction, choices in zip( origins, destinations, directions.tolist(), expected ):
+			self.assertTrue( tuple( direction ) in choices,
+				"Direction between %s, %s, expected to be in %s, got %s"
+				% ( origin, destination, choices, direction ) )
+
+		again = m.directions_between( origins, destinations, rng=1 )
+		self.assertEqual( directions.tolist(), again.tolist(),
+			"Seeded directions were not reproducible." )
+
+		matrix = m.directions_between( origins, destinations, pairwise=True )
+		self.assertEqual( matrix.shape, ( 6, 6, 2 ), "Pairwise directions returned shape %s" % ( matrix.shape, ) )
+
 	def test_neighbors( self ):
 		tests = {
 			( 0, 0 ) : [ ( 1, 0 ), ( 1, 1 ) ],
@@ -97,7 +140,168 @@ class TestMap( unittest.TestCase ):
 				% ( node, results, neighbors ) )
 
 	def test_spread( self ):
-		raise NotImplementedError
+		tests = [
+			( ( 0, 0 ), 1, [ ( 0, 0 ), ( 1, 0 ), ( 1, 1 ) ] ),
+			( ( 3, 2 ), 1, [ ( 3, 2 ), ( 2, 2 ), ( 3, 3 ), ( 4, 3 ), ( 4, 2 ), ( 3, 1 ), ( 2, 1 ) ] ),
+			( ( 0, 0 ), 2, [ ( 0, 0 ), ( 1, 0 ), ( 1, 1 ), ( 1, 2 ), ( 2, 0 ), ( 2, 1 ), ( 2, 2 ) ] ),
+		]
+
+		m = Map( ( 8, 8 ) )
+		for center, radius, results in tests:
+			spread = m.spread( center, radius )
+			self.assertEqual( sorted( spread ), sorted( results ),
+				"Got incorrect spread for node %s, radius %s:\n Expected: %s\nReceived: %s"
+				% ( center, radius, results, spread ) )
+
+		spread = m.spread( ( 6, 4 ), 3 )
+		self.assertEqual( len( spread ), 37,
+			"Spread of radius 3 in the middle of the map returned %s cells, expected 37." % len( spread ) )
+
+	def test_ring( self ):
+		m = Map( ( 8, 8 ) )
+		for center in [ ( 0, 0 ), ( 3, 2 ), ( 6, 4 ), ( 11, 7 ) ]:
+			for radius in range( 4 ):
+				ring = list( m.ring( center, radius ) )
+				expected = [ cell for cell in m.spread( center, radius )
+					if cell not in m.spread( center, radius - 1 ) ] if radius else [ center ]
+				self.assertEqual( sorted( ring ), sorted( expected ),
+					"Got incorrect ring for node %s, radius %s:\n Expected: %s\nReceived: %s"
+					% ( center, radius, expected, ring ) )
+
+	def test_range( self ):
+		m = Map( ( 8, 8 ) )
+		for center in [ ( 0, 0 ), ( 3, 2 ), ( 6, 4 ), ( 11, 7 ) ]:
+			cells = list( m.range( center, 2 ) )
+			self.assertEqual( len( cells ), len( set( cells ) ),
+				"Range for node %s yielded duplicate cells: %s" % ( center, cells ) )
+			self.assertTrue( all( m.valid_cell( cell ) for cell in cells ),
+				"Range for node %s yielded invalid cells: %s" % ( center, cells ) )
+
+	def test_find_path( self ):
+		m = Map( ( 8, 8 ) )
+		path = m.find_path( ( 0, 0 ), ( 4, 4 ) )
+		self.assertEqual( len( path ) - 1, m.distance( ( 0, 0 ), ( 4, 4 ) ),
+			"Open path %s is not the shortest." % path )
+		for a, b in zip( path, path[1:] ):
+			self.assertTrue( b in m.neighbors( a ), "Path %s steps from %s to %s." % ( path, a, b ) )
+
+		wall = Grid( default=1 )
+		for row in range( 0, 7 ):
+			wall[ ( row + 1, 2 ) ] = None
+		path = m.find_path( ( 0, 0 ), ( 2, 4 ), cost=wall )
+		self.assertTrue( ( 8, 2 ) in path, "Path %s did not go around the wall." % path )
+		self.assertEqual( m.find_path( ( 0, 0 ), ( 2, 4 ), cost=wall, max_cost=5 ), None,
+			"Path was found past max_cost." )
+		self.assertEqual( m.find_path( ( 0, 0 ), ( 1, 1 ), blocked=lambda cell: cell == ( 1, 1 ) ), None,
+			"Path was found into a blocked cell." )
+
+	def test_find_path_cost_changes( self ):
+		# The heuristic's cheapest step is cached, so it must follow the layer
+		m = Map( ( 8, 8 ) )
+		cost = Grid( default=3 )
+		m.find_path( ( 0, 0 ), ( 8, 4 ), cost=cost )
+		for row in range( 9 ):
+			cost[ ( row, 0 ) ] = 1
+		for col in range( 8 ):
+			cost[ ( 8 + col // 2, col ) ] = cost[ ( 9 + col // 2, col ) ] = 1
+		path = m.find_path( ( 0, 0 ), ( 10, 5 ), cost=cost )
+		self.assertEqual( sum( cost[ cell ] for cell in path[1:] ), m.reachable( ( 0, 0 ), 100, cost=cost )[ ( 10, 5 ) ],
+			"Path %s is not the cheapest after the cost layer changed." % path )
+
+	def test_reachable( self ):
+		m = Map( ( 8, 8 ) )
+		reachable = m.reachable( ( 4, 4 ), 2 )
+		self.assertEqual( sorted( reachable ), sorted( m.spread( ( 4, 4 ), 2 ) ),
+			"Reachable cells %s did not match the spread." % sorted( reachable ) )
+		self.assertEqual( reachable[ ( 5, 5 ) ], 1, "Neighbor cost %s instead of 1." % reachable[ ( 5, 5 ) ] )
+
+		swamp = Grid( default=1 )
+		swamp[ ( 5, 5 ) ] = 3
+		reachable = m.reachable( ( 4, 4 ), 2, cost=swamp )
+		self.assertFalse( ( 5, 5 ) in reachable, "Expensive cell was reachable." )
+
+	def test_flow_field( self ):
+		m = Map( ( 8, 8 ) )
+		wall = Grid( default=1 )
+		for row in range( 0, 7 ):
+			wall[ ( row + 1, 2 ) ] = None
+		targets = [ ( 2, 4 ), ( 9, 6 ) ]
+		field = m.flow_field( targets, cost=wall )
+		for cell in m.cells():
+			if wall[ cell ] is None:
+				continue
+			expected = min( len( m.find_path( cell, target, cost=wall ) ) - 1 for target in targets )
+			self.assertEqual( field.cost( cell ), expected,
+				"Flow cost from %s is %s, expected %s." % ( cell, field.cost( cell ), expected ) )
+			path = field.path( cell )
+			self.assertTrue( path[-1] in targets, "Flow from %s ended at %s." % ( cell, path[-1] ) )
+			self.assertEqual( len( path ) - 1, expected, "Flow path %s is not the cheapest." % path )
+		self.assertEqual( field.heading( ( 2, 4 ) ), None, "Target has a heading." )
+
+	def test_flow_field_cache( self ):
+		m = Map( ( 8, 8 ) )
+		swamp = Grid( default=1 )
+		field = m.flow_field( [ ( 4, 4 ) ], cost=swamp )
+		self.assertTrue( m.flow_field( [ ( 4, 4 ) ], cost=swamp ) is field, "Flow field was not cached." )
+		swamp[ ( 5, 5 ) ] = 3
+		field = m.flow_field( [ ( 4, 4 ) ], cost=swamp )
+		self.assertEqual( field.cost( ( 6, 6 ) ), 3, "Flow field was not recomputed after the cost changed." )
+
+	def test_batch( self ):
+		m = Map( ( 8, 8 ) )
+		m.swamp = Grid( default=1 )
+		m.swamp[ ( 5, 5 ) ] = 3
+		queries = [ ( 'find_path', ( ( 0, 0 ), cell ), { 'cost': 'swamp' } ) for cell in m.cells()[::5] ]
+		queries.append( ( 'range', ( ( 4, 4 ), 1 ) ) )
+		expected = [ m.find_path( ( 0, 0 ), cell, cost=m.swamp ) for cell in m.cells()[::5] ]
+		expected.append( list( m.range( ( 4, 4 ), 1 ) ) )
+		self.assertEqual( list( m.batch( queries, processes=2 ) ), expected, "Batch results differ from direct calls." )
+
+		m.swamp[ ( 5, 5 ) ] = None
+		self.assertEqual( list( m.batch( [ ( 'reachable', ( ( 4, 4 ), 1 ), { 'cost': 'swamp' } ) ], processes=2 ) ),
+			[ m.reachable( ( 4, 4 ), 1, cost=m.swamp ) ], "Workers kept a stale snapshot." )
+
+	def test_batch_pending( self ):
+		m = Map( ( 8, 8 ) )
+		m.swamp = Grid( default=1 )
+		other = Map( ( 6, 6 ) )
+		other.swamp = Grid( default=2 )
+		queries = [ ( 'find_path', ( ( 0, 0 ), cell ), { 'cost': 'swamp' } ) for cell in other.cells()[::5] ]
+		expected = [ m.find_path( ( 0, 0 ), cell, cost=m.swamp ) for cell in other.cells()[::5] ]
+		pending = m.batch( queries, processes=2 )
+		m.swamp[ ( 5, 5 ) ] = 3
+		m.batch( queries, processes=2 )
+		other.batch( queries, processes=2 )
+		self.assertEqual( list( pending ), expected, "A pending batch lost its snapshot." )
+
+	def test_batch_processes( self ):
+		m = Map( ( 8, 8 ) )
+		m.swamp = Grid( default=1 )
+		queries = [ ( 'find_path', ( ( 0, 0 ), cell ), { 'cost': 'swamp' } ) for cell in m.cells()[::3] ]
+		expected = [ m.find_path( ( 0, 0 ), cell, cost=m.swamp ) for cell in m.cells()[::3] ]
+		pending = m.batch( queries, processes=2, chunksize=1 )
+		first = next( pending )
+		self.assertEqual( list( m.batch( queries[:2], processes=3 ) ), expected[:2] )
+		self.assertEqual( [ first ] + list( pending ), expected,
+			"Changing the number of processes stopped a pending batch." )
+
+	def test_visible( self ):
+		m = Map( ( 8, 8 ) )
+		self.assertEqual( m.visible( ( 6, 4 ), 3 ), set( m.spread( ( 6, 4 ), 3 ) ),
+			"Visible cells on an open map did not match the spread." )
+
+		walls = Grid( default=False )
+		walls[ ( 6, 5 ) ] = True
+		visible = m.visible( ( 6, 4 ), 3, walls )
+		self.assertTrue( ( 6, 5 ) in visible, "Wall was not visible." )
+		self.assertFalse( ( 6, 6 ) in visible or ( 6, 7 ) in visible, "Cells behind the wall were visible." )
+		self.assertTrue( ( 7, 6 ) in visible and ( 5, 5 ) in visible, "Cells beside the wall were hidden." )
+
+	def test_fov( self ):
+		m = Map( ( 8, 8 ) )
+		visible = m.fov( [ ( 0, 0 ), ( 11, 7 ) ], 1 )
+		self.assertEqual( visible, set( m.spread( ( 0, 0 ), 1 ) + m.spread( ( 11, 7 ), 1 ) ),
+			"Field of view %s is not the union of the observers' views." % visible )
 
 	def test_cone( self ):
 		raise NotImplementedError
@@ -108,6 +312,120 @@ class TestMap( unittest.TestCase ):
 	def test_line( self ):
 		raise NotImplementedError
 
+	def test_packed( self ):
+		m = Map( ( 6, 5 ) )
+		for cell in m.cells() + [ ( -1, 0 ), ( 0, -1 ), ( 9, 4 ) ]:
+			key = pack( cell )
+			self.assertEqual( unpack( key ), cell, "Cell %s did not survive packing." % ( cell, ) )
+			self.assertEqual( m.valid_cell( key ), m.valid_cell( cell ) )
+			self.assertEqual( [ unpack( n ) for n in m.neighbors( key ) ], m.neighbors( cell ),
+				"Packed neighbors of %s differ." % ( cell, ) )
+			self.assertEqual( [ unpack( n ) for n in m.range( key, 2 ) ], list( m.range( cell, 2 ) ) )
+			self.assertEqual( [ unpack( n ) for n in m.line( key, 1, 3 ) ], m.line( cell, 1, 3 ) )
+		self.assertEqual( m.distance( pack( ( 0, 0 ) ), pack( ( 4, 1 ) ) ), 4 )
+		self.assertEqual( unpack_cells( pack_cells( m.cells() ) ).tolist(), [ list( cell ) for cell in m.cells() ],
+			"Vectorized packing did not round trip." )
+
+	def test_headless_import( self ):
+		root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+		output = subprocess.check_output( [ sys.executable, '-c',
+			"import sys, hexmap.map, hexmap.layer; print( 'pygame' in sys.modules )" ], cwd=root )
+		self.assertEqual( output.strip(), 'False', "Importing the map core loaded pygame." )
+
+	def test_shape_templates( self ):
+		m = Map( ( 8, 8 ) )
+		for center in [ ( 0, 0 ), ( 3, 2 ), ( 6, 4 ), ( 11, 7 ) ]:
+			expected = sorted( cell for cell in m.cells() if m.distance( center, cell ) <= 2 )
+			self.assertEqual( sorted( m.spread( center, 2 ) ), expected,
+				"Spread for node %s clipped to the map incorrectly." % ( center, ) )
+			self.assertEqual( m.spread( center, 2 ), list( m.range( center, 2 ) ) )
+		self.assertEqual( m.slice( ( 0, 0 ), 1, 2 ), [ ( 0, 0 ), ( 1, 1 ), ( 1, 0 ), ( 2, 2 ), ( 2, 1 ), ( 2, 0 ) ] )
+		self.assertEqual( m.line( ( 3, 2 ), 2, 10 ), [ ( row, 2 ) for row in range( 3, 9 ) ] )
+		self.assertEqual( m.line( pack( ( 3, 2 ) ), 2, 10 ), [ pack( ( row, 2 ) ) for row in range( 3, 9 ) ] )
+
+		# Memoized results match and are not shared between calls
+		cone = m.cone( ( 4, 4 ), 2, 3 )
+		m.shape_memo_size = 4
+		for n in range( 2 ):
+			result = m.cone( ( 4, 4 ), 2, 3 )
+			self.assertEqual( result, cone )
+			result.append( None )
+		for origin in m.cells():
+			m.slice( origin, 0, 1 )
+		self.assertTrue( len( m._resolved ) <= 4, "Memoized shapes were not bounded." )
+
+	def test_adjacency( self ):
+		m = Map( ( 5, 6 ) )
+		adjacency = m.adjacency()
+		self.assertTrue( adjacency is Map( ( 5, 6 ) ).adjacency(), "Adjacency was not shared by map size." )
+		self.assertEqual( len( adjacency ), 30 )
+		self.assertEqual( sorted( m.index( cell ) for cell in m.cells() ), range( 30 ) )
+		self.assertEqual( m.index( pack( ( 4, 3 ) ) ), m.index( ( 4, 3 ) ) )
+		for n in range( len( adjacency ) ):
+			cell = m.cell( n )
+			self.assertEqual( m.index( cell ), n )
+			self.assertEqual( adjacency.targets[ adjacency.offsets[n]:adjacency.offsets[n + 1] ].tolist(),
+				[ m.index( neighbor ) for neighbor in m.neighbors( cell ) ],
+				"Adjacency of %s differs from its neighbors." % ( cell, ) )
+		self.assertEqual( adjacency.degree().max(), 6 )
+
+		# Large maps compute cells and neighbors without the tables
+		m.adjacency_limit = 10
+		m._lists = None
+		self.assertEqual( m.cells(), Map( ( 5, 6 ) ).cells() )
+		self.assertEqual( m.neighbors( ( 3, 2 ) ), Map( ( 5, 6 ) ).neighbors( ( 3, 2 ) ) )
+
+	def test_adjacency_bounded( self ):
+		# A few queries are answered without building the tables
+		m = Map( ( 5, 6 ) )
+		expected = [ m.neighbors( cell ) for cell in m.cells() ]
+		self.assertEqual( Map( ( 5, 6 ) ).neighbors( ( 3, 2 ) ), expected[ 11 ] )
+		m = Map( ( 5, 6 ) )
+		m.neighbors( ( 3, 2 ) )
+		self.assertEqual( m._lists, None, "A single query built the adjacency lists." )
+		self.assertEqual( [ m.neighbors( cell ) for cell in m.cells() ], expected )
+		self.assertTrue( m._lists, "Repeated queries did not switch to the adjacency lists." )
+
+		for rows in range( 1, 2 * Adjacency.cache_size + 2 ):
+			Map( ( rows, 3 ) ).adjacency()
+		self.assertTrue( len( Adjacency._cache ) <= Adjacency.cache_size,
+			"%d adjacencies were kept." % len( Adjacency._cache ) )
+		self.assertTrue( Map( ( rows, 3 ) ).adjacency() is Map( ( rows, 3 ) ).adjacency() )
+
+	def test_ascii( self ):
+		m = Map( ( 2, 3 ) )
+		self.assertEqual( m.ascii( numbers=False ),
+			" ___     ___\n"
+			"/   \\___/   \\\n"
+			"\\___/   \\___/\n"
+			"/   \\___/   \\\n"
+			"\\___/   \\___/\n"
+			"    \\___/\n" )
+		output = StringIO()
+		m.write_ascii( output )
+		self.assertEqual( output.getvalue(), m.ascii() )
+		self.assertEqual( m.ascii( rows=( 1, 2 ), cols=( 1, 3 ) ),
+			"     ___\n"
+			"\\___/2,2\\\n"
+			"/2,1\\___/\n"
+			"\\___/\n" )
+
+		# Windows are cut out of the lines of the whole drawing
+		m = Map( ( 7, 8 ) )
+		whole = m.ascii().split( '\n' )
+		width = m._ascii_width( True ) + 1
+		for rows, cols in [ ( ( 0, 7 ), ( 0, 8 ) ), ( ( 2, 5 ), ( 1, 4 ) ), ( ( 3, 4 ), ( 6, 8 ) ), ( ( 0, 7 ), ( 3, 6 ) ), ( ( 1, 7 ), ( 2, 5 ) ) ]:
+			lines = list( m.iter_ascii( rows=rows, cols=cols ) )
+			self.assertEqual( len( lines ), 2 * ( rows[1] - rows[0] ) + 2 )
+			for n, line in enumerate( lines[1:-1] ):
+				self.assertEqual( line[:-1], whole[ 1 + 2 * rows[0] + n ][ cols[0] * width:1 + cols[1] * width ],
+					"Window %s x %s differs from the whole map." % ( rows, cols ) )
+			# The header and footer are cut from the whole map's, ending at the window's last cell
+			self.assertTrue( whole[0][ cols[0] * width: ].startswith( lines[0][:-1].rstrip() ),
+				"Header of window %s x %s differs from the whole map." % ( rows, cols ) )
+			self.assertTrue( lines[-1][:-1] in whole[-2] and whole[-2][ cols[0] * width + 1: ].startswith( lines[-1][1:-1] ),
+				"Footer of window %s x %s differs from the whole map." % ( rows, cols ) )
+
 class TestGrid( unittest.TestCase ):
 	def setUp( self ):
 		self.grid = Grid()
@@ -126,6 +444,150 @@ class TestGrid( unittest.TestCase ):
 		self.assertTrue( key == self.grid.find( value ),
 			 "Find %s did not correctly return key %s " % ( value, key ) )
 
+	def test_find_tracks_changes( self ):
+		self.grid.update( { ( 0, 0 ): "A", ( 0, 1 ): "B" } )
+		self.grid[ ( 0, 0 ) ] = "C"
+		self.grid.setdefault( ( 1, 1 ), "D" )
+		self.grid.pop( ( 0, 1 ) )
+		expected = { "A": None, "B": None, "C": ( 0, 0 ), "D": ( 1, 1 ) }
+		for value, key in expected.items():
+			self.assertEqual( self.grid.find( value ), key,
+				"Find %s returned %s instead of %s" % ( value, self.grid.find( value ), key ) )
+
+		del self.grid[ ( 0, 0 ) ]
+		self.assertEqual( self.grid.find( "C" ), None, "Find returned a deleted key." )
+		self.grid.clear()
+		self.assertEqual( self.grid.find( "D" ), None, "Find returned a key after clear." )
+
+	def test_find_duplicates( self ):
+		self.grid[ ( 0, 0 ) ] = "U"
+		self.grid[ ( 1, 0 ) ] = "U"
+		del self.grid[ self.grid.find( "U" ) ]
+		self.assertTrue( self.grid.find( "U" ) in self.grid,
+			"Find did not return the remaining key holding a duplicated value." )
+		self.assertEqual( len( self.grid.find_all( "U" ) ), 1,
+			"Find all returned %s instead of a single key." % self.grid.find_all( "U" ) )
+
+	def test_overwrite_duplicates( self ):
+		cells = [ ( i, j ) for i in range( 4 ) for j in range( 4 ) ]
+		for cell in cells:
+			self.grid[ cell ] = 3
+		for cell in cells[ :-1 ]:
+			self.grid[ cell ] = 5
+			self.assertTrue( self.grid[ self.grid.find( 3 ) ] == 3,
+				"Find returned %s, which does not hold 3." % str( self.grid.find( 3 ) ) )
+		self.assertEqual( self.grid.find( 3 ), cells[-1], "Find did not return the last key holding 3." )
+		self.assertEqual( sorted( self.grid.find_all( 5 ) ), cells[ :-1 ],
+			"Find all returned %s instead of %s" % ( self.grid.find_all( 5 ), cells[ :-1 ] ) )
+
+	def test_find_unhashable_equality( self ):
+		self.grid[ ( 0, 0 ) ] = [ 1, 2 ]
+		self.assertEqual( self.grid.find( ( 1, 2 ) ), None, "Find matched a tuple to a list." )
+		self.assertEqual( self.grid.find_all( ( 1, 2 ) ), [], "Find all matched a tuple to a list." )
+		self.grid[ ( 0, 1 ) ] = ( 1, 2 )
+		self.assertEqual( self.grid.find( ( 1, 2 ) ), ( 0, 1 ), "Find did not return the key holding the tuple." )
+		self.assertEqual( self.grid.find( [ 1, 2 ] ), ( 0, 0 ), "Find did not return the key holding the list." )
+
+	def test_multi( self ):
+		grid = Grid( multi=True )
+		cells = [ ( 0, 0 ), ( 1, 0 ), ( 1, 1 ) ]
+		for cell in cells:
+			grid[ cell ] = [ 0, 0, 0 ]
+		grid[ ( 1, 1 ) ] = [ 1, 1, 1 ]
+		self.assertEqual( sorted( grid.find_all( [ 0, 0, 0 ] ) ), cells[:2],
+			"Find all returned %s instead of %s" % ( grid.find_all( [ 0, 0, 0 ] ), cells[:2] ) )
+		self.assertEqual( grid.find( [ 1, 1, 1 ] ), ( 1, 1 ),
+			"Find did not return the key of an unhashable value." )
+
+	def test_pickle( self ):
+		self.grid[ ( 0, 0 ) ] = "U"
+		grid = pickle.loads( pickle.dumps( self.grid, 2 ) )
+		self.assertEqual( grid, self.grid, "Pickled grid %s does not match %s" % ( grid, self.grid ) )
+		self.assertEqual( grid.find( "U" ), ( 0, 0 ), "Pickled grid lost its reverse index." )
+
+	def test_old_pickle( self ):
+		# Before Grid defined __reduce__, its items were restored before its __dict__
+		class Old( object ):
+			def __reduce__( self ):
+				return ( copy_reg._reconstructor, ( Grid, dict, {} ), { 'default': 0 }, None, iter( [ ( ( 0, 0 ), "U" ) ] ) )
+		grid = pickle.loads( pickle.dumps( Old(), 2 ) )
+		self.assertEqual( grid.find( "U" ), ( 0, 0 ), "Old pickle lost its reverse index." )
+		self.assertEqual( grid[ ( 1, 1 ) ], 0, "Old pickle lost its default." )
+
+class TestPackedGrid( unittest.TestCase ):
+	def test_keys( self ):
+		grid = PackedGrid( default=0 )
+		grid[ ( 1, 1 ) ] = 5
+		grid[ pack( ( 2, 1 ) ) ] = 6
+		self.assertEqual( grid[ pack( ( 1, 1 ) ) ], 5, "Tuple key was not packed." )
+		self.assertEqual( grid[ ( 2, 1 ) ], 6, "Packed key not found by tuple." )
+		self.assertTrue( ( 1, 1 ) in grid and pack( ( 1, 1 ) ) in grid )
+		self.assertEqual( grid.find( 6 ), pack( ( 2, 1 ) ), "Find did not return a packed key." )
+		self.assertEqual( sorted( grid.cells() ), [ ( 1, 1 ), ( 2, 1 ) ] )
+		del grid[ ( 1, 1 ) ]
+		self.assertEqual( grid[ ( 1, 1 ) ], 0, "Deleted key still held a value." )
+
+class TestSpatialGrid( unittest.TestCase ):
+	def setUp( self ):
+		self.map = Map( ( 20, 20 ) )
+		self.grid = SpatialGrid( size=4 )
+		for n, cell in enumerate( self.map.cells()[::7] ):
+			self.grid[ cell ] = n
+
+	def brute( self, center, radius ):
+		return sorted( ( cell, unit ) for cell, unit in self.grid.items() if self.map.distance( center, cell ) <= radius )
+
+	def test_units_within( self ):
+		for center, radius in [ ( ( 10, 10 ), 3 ), ( ( 0, 0 ), 5 ), ( ( 20, 19 ), 0 ), ( ( 12, 4 ), 9 ) ]:
+			self.assertEqual( sorted( self.grid.units_within( center, radius ) ), self.brute( center, radius ),
+				"Units within %s of %s do not match a full scan." % ( radius, center ) )
+
+	def test_moves( self ):
+		cell, unit = self.grid.units_within( ( 10, 10 ), 3 )[0]
+		del self.grid[ cell ]
+		self.grid[ ( 0, 0 ) ] = unit
+		self.assertTrue( ( cell, unit ) not in self.grid.units_within( ( 10, 10 ), 3 ), "Moved unit left behind." )
+		self.assertTrue( ( ( 0, 0 ), unit ) in self.grid.units_within( ( 0, 0 ), 0 ), "Moved unit not found." )
+
+	def test_nearest( self ):
+		for center in [ ( 10, 10 ), ( 0, 0 ), ( 25, 19 ) ]:
+			distances = sorted( self.map.distance( center, cell ) for cell in self.grid )
+			for k in ( 1, 5, len( self.grid ) + 1 ):
+				found = [ self.map.distance( center, cell ) for cell, unit in self.grid.nearest( center, k ) ]
+				self.assertEqual( found, distances[ :k ], "Nearest %d to %s were %s" % ( k, center, found ) )
+
+	def test_units_in( self ):
+		cells = list( self.map.range( ( 10, 10 ), 4 ) )
+		self.assertEqual( sorted( self.grid.units_in( cells ) ), self.brute( ( 10, 10 ), 4 ) )
+
+	def test_pickle( self ):
+		grid = pickle.loads( pickle.dumps( self.grid, 2 ) )
+		self.assertEqual( sorted( grid.units_within( ( 10, 10 ), 5 ) ), self.brute( ( 10, 10 ), 5 ),
+			"Pickled grid lost its buckets." )
+
+class TestVision( unittest.TestCase ):
+	def setUp( self ):
+		self.map = Map( ( 8, 8 ) )
+		self.fog = Grid( default="OBSCURED", multi=True )
+		self.vision = Vision( self.map, 1, fog=self.fog, visible="VISIBLE", seen="SEEN" )
+
+	def test_update( self ):
+		self.vision.update( 'a', ( 3, 2 ) )
+		self.vision.update( 'b', ( 4, 2 ) )
+		self.assertEqual( sorted( self.fog.find_all( "VISIBLE" ) ), sorted( self.vision.visible ),
+			"Fog does not match the visible cells." )
+
+		self.vision.update( 'a', ( 6, 4 ) )
+		self.assertEqual( self.fog[ ( 2, 1 ) ], "SEEN", "Cell left behind was not marked seen." )
+		self.assertEqual( self.fog[ ( 4, 2 ) ], "VISIBLE", "Cell still seen by b was hidden." )
+		self.assertEqual( self.fog[ ( 0, 0 ) ], "OBSCURED", "Cell never seen was revealed." )
+
+	def test_remove( self ):
+		self.vision.update( 'a', ( 3, 2 ) )
+		self.vision.remove( 'a' )
+		self.assertEqual( self.vision.visible, set(), "Cells remained visible after removing the observer." )
+		self.assertEqual( self.fog[ ( 3, 2 ) ], "SEEN", "Observer's cell was not marked seen." )
+
 class TestMapUnit( unittest.TestCase ):
 
 	class TestUnit( MapUnit ):
@@ -147,7 +609,7 @@ class TestMapUnit( unittest.TestCase ):
 			"Unit %s position was returned as %s, but it should not be on the map." % ( unit, unit.position ) )
 
 def load_tests( loader, tests, pattern ):
-	tests = [ TestMap, TestGrid, TestMapUnit ]
+	tests = [ TestMap, TestGrid, TestPackedGrid, TestSpatialGrid, TestVision, TestMapUnit ]
 
 	suite = unittest.TestSuite()
 	for test_class in tests:
@@ -1,7 +1,10 @@
+import math
 import unittest
 
-from hexmap.Map import Map
-from hexmap.Render import Render, RenderUnits, RenderGrid, RenderFog
+import pygame
+
+from hexmap.Map import Map, MapUnit
+from hexmap.Render import Render, RenderUnits, RenderGrid, RenderFog, Camera, Compositor, Geometry
 
 class TestRender( unittest.TestCase ):
 
@@ -10,8 +13,290 @@ class TestRender( unittest.TestCase ):
 			super( self.TestRender, self ).draw()
 
 
+class TestRenderGrid( unittest.TestCase ):
+	def setUp( self ):
+		self.map = Map( ( 5, 5 ) )
+		self.grid = RenderGrid( self.map, radius=16 )
+
+	def test_cached( self ):
+		self.grid.draw()
+		self.grid.set_at( ( 10, 10 ), pygame.Color( 1, 2, 3 ) )
+		self.grid.draw()
+		self.assertEqual( self.grid.get_at( ( 10, 10 ) ), pygame.Color( 1, 2, 3 ),
+			"Grid was redrawn although nothing changed." )
+
+		self.grid.GRID_COLOR = pygame.Color( 60, 60, 60 )
+		self.grid.draw()
+		self.assertNotEqual( self.grid.get_at( ( 10, 10 ) ), pygame.Color( 1, 2, 3 ),
+			"Grid was not redrawn after GRID_COLOR changed." )
+
+	def test_outline( self ):
+		outline = RenderGrid( self.map, radius=16, outline=True )
+		edges = set( frozenset( tuple( int( x ) for x in point ) for point in stroke ) for stroke in outline.strokes() )
+		self.assertEqual( len( edges ), 94, "Outline of a 5x5 grid strokes %s edges, expected 94." % len( edges ) )
+
+		self.grid.draw()
+		outline.draw()
+		self.assertEqual( pygame.image.tostring( outline, 'RGB' ), pygame.image.tostring( self.grid, 'RGB' ),
+			"Outline mode drew a different grid." )
+		self.assertTrue( len( outline.strokes() ) < 6 * len( self.map.cells() ), "Outline mode drew every edge twice." )
+
+		# pygame draws some slopes differently in each direction, and clips lines crossing the surface's edge
+		for size, radius, camera in [ ( ( 10, 10 ), 17, None ), ( ( 3, 3 ), 7, None ), ( ( 4, 7 ), 10, None ),
+				( ( 6, 9 ), 13, Camera( ( 60, 50 ), offset=( 37, 29 ) ) ) ]:
+			m = Map( size )
+			grid = RenderGrid( m, radius=radius, camera=camera )
+			outline = RenderGrid( m, radius=radius, camera=camera, outline=True )
+			grid.draw()
+			outline.draw()
+			self.assertEqual( pygame.image.tostring( outline, 'RGB' ), pygame.image.tostring( grid, 'RGB' ),
+				"Outline mode drew a different %s grid at radius %d." % ( size, radius ) )
+
+class TestGeometry( unittest.TestCase ):
+	def test_shared( self ):
+		geometry = Geometry.get( ( 5, 5 ), 16 )
+		self.assertTrue( Geometry.get( [ 5, 5 ], 16 ) is geometry, "Geometry was not shared by size and radius." )
+		self.assertTrue( RenderGrid( Map( ( 5, 5 ) ), radius=16 ).geometry is geometry,
+			"Render layers of the same size and radius did not share their geometry." )
+		self.assertTrue( RenderFog( Map( ( 5, 5 ) ), radius=16 ).geometry is geometry )
+		self.assertFalse( Geometry.get( ( 5, 5 ), 17 ) is geometry, "Geometry was shared across radii." )
+		self.assertFalse( Geometry.get( ( 5, 6 ), 16 ) is geometry, "Geometry was shared across map sizes." )
+
+	def test_tables( self ):
+		# Compare with the per cell math Render used before the tables existed
+		m = Map( ( 4, 7 ) )
+		for radius in ( 7, 16, 17 ):
+			geometry = Geometry.get( m.size, radius )
+			render = RenderGrid( m, radius=radius )
+			width, height = 2 * radius, radius * math.sqrt( 3 )
+			cell = [ ( .5 * radius, 0 ), ( 1.5 * radius, 0 ), ( 2 * radius, height / 2 ),
+				( 1.5 * radius, height ), ( .5 * radius, height ), ( 0, height / 2 ) ]
+			for row, col in m.cells():
+				left = 1.5 * radius * col
+				top = ( row - math.ceil( col / 2.0 ) ) * height + ( height / 2 if col % 2 == 1 else 0 )
+				for point, expected in zip( geometry.polygon( ( row, col ) ), [ ( x + left, y + top ) for ( x, y ) in cell ] ):
+					self.assertAlmostEqual( point[0], expected[0], places=9 )
+					self.assertAlmostEqual( point[1], expected[1], places=9 )
+				rect = pygame.Rect( left, top, width, height )
+				self.assertEqual( geometry.rect( ( row, col ) ), rect,
+					"Rect of %s at radius %d is %s, expected %s" % ( ( row, col ), radius, geometry.rect( ( row, col ) ), rect ) )
+				surface = render.get_surface( ( row, col ) )
+				self.assertEqual( pygame.Rect( surface.get_offset(), surface.get_size() ), rect,
+					"Surface of %s at radius %d does not cover its rect." % ( ( row, col ), radius ) )
+				center = geometry.center( ( row, col ) )
+				self.assertAlmostEqual( center[0], left + radius, places=9 )
+				self.assertAlmostEqual( center[1], top + height / 2, places=9 )
+				self.assertEqual( geometry.cells[ geometry.index( ( row, col ) ) ].tolist(), [ row, col ] )
+
+class TestRenderFog( unittest.TestCase ):
+	def setUp( self ):
+		self.map = Map( ( 5, 5 ) )
+		self.fog = RenderFog( self.map, radius=16 )
+
+	def test_dirty( self ):
+		rects = self.fog.draw()
+		self.assertEqual( rects, [ self.fog.get_rect() ], "First draw did not paint the whole surface." )
+		self.assertEqual( self.fog.draw(), [], "Unchanged fog was repainted." )
+
+		self.map.fog[ ( 3, 2 ) ] = self.fog.VISIBLE
+		rects = self.fog.draw()
+		self.assertEqual( len( rects ), 1, "Expected one rect for one changed cell, got %s." % rects )
+		self.assertEqual( self.fog.get_at( rects[0].center ), self.fog.VISIBLE,
+			"Changed cell was not repainted." )
+		self.assertEqual( self.fog.draw(), [], "Dirty cells were not cleared after drawing." )
+
+	def test_shared( self ):
+		minimap = RenderFog( self.map, radius=4 )
+		self.fog.draw()
+		minimap.draw()
+
+		self.map.fog[ ( 2, 2 ) ] = self.fog.VISIBLE
+		for layer in ( self.fog, minimap ):
+			rects = layer.draw()
+			self.assertEqual( len( rects ), 1, "Expected one rect for one changed cell, got %s." % rects )
+			self.assertEqual( layer.get_at( layer.cell_rect( ( 2, 2 ) ).center ), self.fog.VISIBLE,
+				"Changed cell was not repainted by every layer sharing the fog." )
+			self.assertEqual( layer.draw(), [], "Dirty cells were not cleared after drawing." )
+
+	def test_incremental( self ):
+		values = [ self.fog.VISIBLE, self.fog.SEEN, self.fog.OBSCURED ]
+		for radius in ( 5, 7, 16, 17 ):
+			for camera in ( None, Camera( ( 70, 60 ), offset=( 23, 17 ) ) ):
+				map = Map( ( 8, 9 ) )
+				fog = RenderFog( map, radius=radius, camera=camera )
+				fog.draw()
+				cells = map.cells()
+				for step in range( 12 ):
+					for n, cell in enumerate( cells[ step % 5::7 ] ):
+						map.fog[ cell ] = values[ ( n + step ) % 3 ]
+					fog.draw()
+					full = RenderFog( map, radius=radius, camera=camera )
+					full.draw()
+					self.assertEqual( pygame.image.tostring( fog, 'RGBA' ), pygame.image.tostring( full, 'RGBA' ),
+						"Incremental draw at radius %d with camera %s differs from a full draw." % ( radius, camera ) )
+
+class TestPicking( unittest.TestCase ):
+	def setUp( self ):
+		self.map = Map( ( 5, 5 ) )
+		self.render = RenderGrid( self.map, radius=16 )
+		width, height = self.render.get_size()
+		self.points = [ ( x, y ) for x in range( -2, width + 2, 3 ) for y in range( -2, height + 2, 3 ) ]
+		self.points += [ ( x + .25, y + .5 ) for ( x, y ) in self.points[::5] ]
+
+	def check( self ):
+		cells, valid = self.render.get_cells( self.points )
+		for point, cell, on_map in zip( self.points, cells.tolist(), valid.tolist() ):
+			expected = self.render.get_cell( point )
+			self.assertEqual( tuple( cell ) if on_map else None, expected,
+				"Point %s picked %s, expected %s" % ( point, cell if on_map else None, expected ) )
+
+	def test_get_cells( self ):
+		self.check()
+
+	def test_lookup( self ):
+		expected = [ self.render.get_cell( point ) for point in self.points ]
+		self.render.build_lookup()
+		picked = [ self.render.get_cell( point ) for point in self.points ]
+		self.assertEqual( picked, expected, "Lookup picking disagreed with computed picking." )
+		self.check()
+
+class TestCamera( unittest.TestCase ):
+	def setUp( self ):
+		self.map = Map( ( 5, 5 ) )
+		self.full = RenderGrid( self.map, radius=16 )
+		self.full.draw()
+
+	def test_window( self ):
+		# Lines crossing the window's edge are clipped, which can move their
+		# pixels, so compare against the map's top left corner.
+		camera = Camera( ( 40, 30 ) )
+		grid = RenderGrid( self.map, radius=16, camera=camera )
+		grid.draw()
+		self.assertEqual( grid.get_size(), ( 40, 30 ), "Surface was not sized to the camera." )
+		self.assertEqual( pygame.image.tostring( grid, 'RGB' ),
+			pygame.image.tostring( self.full.subsurface( ( 0, 0, 40, 30 ) ), 'RGB' ),
+			"Camera window differs from the same area of the whole map." )
+
+	def test_culled( self ):
+		camera = Camera( ( 40, 30 ), offset=( 20, 10 ) )
+		grid = RenderGrid( self.map, radius=16, camera=camera )
+		cells = grid.view()[0]
+		self.assertTrue( len( cells ) < len( self.map.cells() ), "Camera did not cull any cells." )
+		for x in range( 0, 40, 4 ):
+			for y in range( 0, 30, 4 ):
+				cell = grid.get_cell( ( x, y ) )
+				self.assertEqual( cell, self.full.get_cell( ( x + 20, y + 10 ) ),
+					"Camera picked %s at %s." % ( cell, ( x, y ) ) )
+				self.assertTrue( cell is None or cell in cells, "Visible cell %s was culled." % ( cell, ) )
+
+	def test_zoom( self ):
+		camera = Camera( ( 100, 100 ) )
+		grid = RenderGrid( self.map, radius=16, camera=camera )
+		cell = grid.get_cell( ( 50, 40 ) )
+		camera.zoom_to( 2.0, anchor=( 50, 40 ) )
+		self.assertEqual( grid.scale, 32 )
+		self.assertEqual( grid.get_cell( ( 50, 40 ) ), cell, "Zooming moved the anchor." )
+
+		camera.pan( 10, 0 )
+		self.assertEqual( camera.offset, ( 60, 40 ) )
+
+	def test_fog( self ):
+		camera = Camera( ( 40, 30 ) )
+		fog = RenderFog( self.map, radius=16, camera=camera )
+		fog.draw()
+		self.map.fog[ ( 4, 4 ) ] = fog.VISIBLE
+		self.assertEqual( fog.draw(), [], "Repainted a cell out of view." )
+		camera.pan( 5, 0 )
+		self.assertEqual( fog.draw(), [ fog.get_rect() ], "Moving the camera did not repaint the fog." )
+
+class TestRenderUnits( unittest.TestCase ):
+	class Unit( MapUnit ):
+		def __init__( self, grid, color ):
+			super( TestRenderUnits.Unit, self ).__init__( grid )
+			self.color = color
+			self.painted = 0
+
+		def paint( self, surface ):
+			self.painted += 1
+			radius = surface.get_width() // 2
+			pygame.draw.circle( surface, self.color, ( radius, radius - 2 ), radius - 4 )
+
+	class Sprite( Unit ):
+		@property
+		def cache_key( self ):
+			return tuple( self.color )
+
+	def draw( self, classes, camera=None ):
+		"""Draws a unit on every cell, of the class chosen by classes( n ), and returns the pixels and units."""
+		m = Map( ( 6, 6 ) )
+		units = RenderUnits( m, radius=12, camera=camera )
+		colors = [ pygame.Color( 200, 40, 40 ), pygame.Color( 40, 200, 40 ), pygame.Color( 40, 40, 200 ) ]
+		for n, cell in enumerate( m.cells() ):
+			m.units[ cell ] = classes( n )( m.units, colors[ n % 3 ] )
+		units.draw()
+		units.draw()
+		return pygame.image.tostring( units, 'RGB' ), m.units.values()
+
+	def test_sprites( self ):
+		for camera in ( None, Camera( ( 50, 40 ), offset=( 7, 11 ) ) ):
+			live, painted = self.draw( lambda n: self.Unit, camera )
+			sprites, cached = self.draw( lambda n: self.Sprite, camera )
+			self.assertEqual( sprites, live, "Sprites drew different pixels than painting with camera %s." % camera )
+			self.assertTrue( sum( unit.painted for unit in cached ) <= 3, "Sprites were painted more than once." )
+			mixed, units = self.draw( lambda n: self.Unit if n % 4 == 0 else self.Sprite, camera )
+			self.assertEqual( mixed, live, "Mixing live and cached units changed the drawing order." )
+
+class TestCompositor( unittest.TestCase ):
+	def setUp( self ):
+		self.map = Map( ( 6, 6 ) )
+		self.camera = Camera( ( 60, 50 ) )
+		self.layers = [ RenderGrid( self.map, radius=12, camera=self.camera ),
+			RenderFog( self.map, radius=12, camera=self.camera ) ]
+		self.map.fog[ ( 2, 1 ) ] = RenderFog.VISIBLE
+		self.window = pygame.Surface( ( 60, 50 ) )
+
+	def expected( self ):
+		"""The layers drawn and blitted one after the other."""
+		surface = pygame.Surface( ( 60, 50 ) )
+		surface.fill( pygame.Color( 'white' ) )
+		for layer in self.layers:
+			layer.draw()
+			surface.blit( layer, ( 0, 0 ) )
+		return pygame.image.tostring( surface, 'RGB' )
+
+	def test_compose( self ):
+		compositor = Compositor( self.layers )
+		self.assertFalse( compositor.present( self.window ), "Presented a frame before one was drawn." )
+		compositor.compose()
+		self.assertTrue( compositor.present( self.window ) )
+		self.assertFalse( compositor.present( self.window ), "Presented the same frame twice." )
+		self.assertEqual( pygame.image.tostring( self.window, 'RGB' ), self.expected() )
+
+	def test_thread( self ):
+		with Compositor( self.layers ) as compositor:
+			compositor.request()
+			self.assertTrue( compositor.wait( 5 ), "No frame was drawn." )
+			compositor.present( self.window )
+			first = pygame.image.tostring( self.window, 'RGB' )
+
+			compositor.update( self.camera.pan, 10, 5 )
+			compositor.request()
+			self.assertTrue( compositor.wait( 5 ), "No frame was drawn after the update." )
+			compositor.present( self.window )
+		self.assertEqual( self.camera.offset, ( 10, 5 ), "The update was not applied." )
+		self.assertNotEqual( pygame.image.tostring( self.window, 'RGB' ), first )
+		self.assertEqual( pygame.image.tostring( self.window, 'RGB' ), self.expected() )
+
+	def test_error( self ):
+		def fail():
+			raise ValueError( "broken layer" )
+		with Compositor( self.layers ) as compositor:
+			compositor.update( fail )
+			compositor.request()
+			self.assertRaises( RuntimeError, compositor.wait, 5 )
+
 def load_tests( loader, tests, pattern ):
-	tests = [ TestRender ]
+	tests = [ TestRender, TestRenderGrid, TestGeometry, TestRenderFog, TestPicking, TestCamera, TestRenderUnits, TestCompositor ]
 
 	suite = unittest.TestSuite()
 	for test_class in tests:
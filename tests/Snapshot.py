@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from hexmap.map import Map, Grid, PackedGrid, MapUnit
+from hexmap.layer import DenseLayer
+from hexmap import snapshot
+
+class Unit( MapUnit ):
+	def paint( self, surface ):
+		pass
+
+class TestSnapshot( unittest.TestCase ):
+	def setUp( self ):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join( self.directory, 'map.snapshot' )
+		self.map = Map( ( 6, 6 ) )
+		self.map.units = Grid()
+		self.map.units[ ( 1, 1 ) ] = Unit( self.map.units )
+		self.map.units[ ( 4, 3 ) ] = Unit( self.map.units )
+		self.map.fog = Grid( default="OBSCURED", multi=True )
+		for cell in self.map.spread( ( 3, 2 ), 1 ):
+			self.map.fog[ cell ] = "VISIBLE"
+		self.map.terrain = DenseLayer( self.map, default=1.0, dtype=float )
+		self.map.terrain.fill( 3.0, self.map.spread( ( 4, 4 ), 1 ) )
+		self.map.heights = PackedGrid( default=0 )
+		self.map.heights[ ( 2, 2 ) ] = 7
+
+	def tearDown( self ):
+		shutil.rmtree( self.directory )
+
+	def test_round_trip( self ):
+		snapshot.save( self.map, self.path )
+		loaded = snapshot.load( self.path )
+		self.assertEqual( loaded.size, self.map.size )
+		for cell in self.map.cells() + [ ( -1, 0 ) ]:
+			self.assertEqual( loaded.fog[ cell ], self.map.fog[ cell ], "Fog differs at %s." % ( cell, ) )
+			self.assertEqual( loaded.terrain[ cell ], self.map.terrain[ cell ], "Terrain differs at %s." % ( cell, ) )
+			self.assertEqual( loaded.heights[ cell ], self.map.heights[ cell ], "Heights differ at %s." % ( cell, ) )
+		self.assertEqual( sorted( loaded.fog.find_all( "VISIBLE" ) ), sorted( self.map.fog.find_all( "VISIBLE" ) ) )
+
+	def test_units( self ):
+		snapshot.save( self.map, self.path, layers=[ 'units' ] )
+		loaded = snapshot.load( self.path )
+		self.assertFalse( hasattr( loaded, 'fog' ), "Unrequested layer was saved." )
+		for cell, unit in loaded.units.items():
+			self.assertTrue( unit.grid is loaded.units, "Unit does not refer to the loaded layer." )
+			self.assertEqual( unit.position, cell, "Unit at %s reports %s." % ( cell, unit.position ) )
+
+	def test_zero_copy( self ):
+		snapshot.save( self.map, self.path )
+		loaded = snapshot.load( self.path )
+		self.assertFalse( loaded.terrain.array.flags.writeable, "Loaded array is not a read only view." )
+		self.assertFalse( loaded.terrain.array.flags.owndata, "Loaded array was copied." )
+
+	def test_to_grid( self ):
+		snapshot.save( self.map, self.path )
+		loaded = snapshot.load( self.path )
+		fog = loaded.fog.to_grid()
+		self.assertTrue( type( fog ) is Grid and fog.multi, "Grid options were not restored." )
+		self.assertEqual( fog, self.map.fog )
+		fog[ ( 0, 0 ) ] = "SEEN"
+		self.assertEqual( fog.find( "SEEN" ), ( 0, 0 ), "Restored grid lost its reverse index." )
+		self.assertTrue( type( loaded.heights.to_grid() ) is PackedGrid )
+
+	def test_invalid( self ):
+		with open( self.path, 'wb' ) as output:
+			output.write( 'not a snapshot' * 4 )
+		self.assertRaises( snapshot.SnapshotError, snapshot.load, self.path )
+
+def load_tests( loader, tests, pattern ):
+	tests = [ TestSnapshot ]
+
+	suite = unittest.TestSuite()
+	for test_class in tests:
+		tests = loader.loadTestsFromTestCase( test_class )
+		suite.addTests( tests )
+	return suite
+
+if __name__ == '__main__':
+	loader = unittest.TestLoader()
+	tests = load_tests( loader, None, None )
+	unittest.TextTestRunner( verbosity=2 ).run( tests )
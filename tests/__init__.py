@@ -2,9 +2,12 @@ import unittest
 
 import tests.Map as Map
 import tests.Render as Render
+import tests.Layer as Layer
+import tests.Snapshot as Snapshot
+import tests.Instrument as Instrument
 
 def load_tests( loader, standard_tests, pattern ):
-	tests = [ Map, Render ]
+	tests = [ Map, Render, Layer, Snapshot, Instrument ]
 
 	return unittest.TestSuite( tests=[ test.load_tests( loader, standard_tests, None ) for test in tests] )
 